@@ -1,46 +1,498 @@
-import os, base64, requests
+"""
+Client de téléchargement du Copernicus Data Space (CDSE)
 
-TOKEN_URL = "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token"
+    - une requests.Session partagée, avec un pool de connexions HTTP et des
+      relances automatiques (429, 5xx)
+    - un token OAuth mis en cache et renouvelé avant son expiration
+      (expires_in), ou immédiatement si le serveur répond 401
+    - des téléchargements par plages (Range) : un fichier .part interrompu
+      reprend là où il s'était arrêté, un gros fichier peut être découpé en
+      segments téléchargés en parallèle, et la somme de contrôle est
+      vérifiée avant de renommer le fichier à sa place
+    - un pool borné de téléchargements dont les fichiers sont passés au
+      générateur de carte (generate_square_map.process_multiple_netcdf)
+
+Les URL du token et des fichiers sont de simples paramètres (CDSE_TOKEN_URL
+pour le token) : le client fonctionne aussi contre un serveur HTTP local.
+"""
+import base64
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+TOKEN_URL = os.getenv("CDSE_TOKEN_URL",
+                      "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token")
 
 CLIENT_ID = os.getenv("CDSE_CLIENT_ID", "TON_CLIENT_ID")
 CLIENT_SECRET = os.getenv("CDSE_CLIENT_SECRET", "TON_CLIENT_SECRET")
 
+# Connexions conservées par hôte, et téléchargements simultanés
+POOL_SIZE = int(os.getenv("CDSE_POOL_SIZE", 8))
+DOWNLOAD_WORKERS = int(os.getenv("CDSE_DOWNLOAD_WORKERS", 4))
+
+# Le token est renouvelé quand il lui reste moins de REFRESH_MARGIN secondes
+# (ou la moitié de sa durée de vie si elle est plus courte)
+REFRESH_MARGIN = 60
+DEFAULT_EXPIRES_IN = 300
+
+RETRIES = 3
+RETRY_STATUS = (429, 500, 502, 503, 504)
+TIMEOUT = (10, 60)
+CHUNK_SIZE = 1 << 20
+# Taille minimale d'un segment quand un fichier est découpé
+MIN_SEGMENT_SIZE = 8 << 20
+
+
+class ChecksumError(RuntimeError):
+    """Le fichier téléchargé ne correspond pas à sa somme de contrôle"""
+
+
+def make_session(pool_size=POOL_SIZE, retries=RETRIES):
+    """
+    Session HTTP avec pool de connexions et relances
+
+    Args:
+        pool_size: Connexions conservées par hôte (au moins le nombre de
+                   requêtes simultanées, sinon elles sont rouvertes)
+        retries: Relances sur erreur de connexion ou statut RETRY_STATUS
+    """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=RETRY_STATUS,
+                  allowed_methods=frozenset({'GET', 'HEAD', 'POST'}), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class TokenCache:
+    """
+    Token OAuth client_credentials, demandé une fois puis réutilisé
+
+    Args:
+        session: Session HTTP utilisée pour les requêtes de token
+        token_url, client_id, client_secret: Identifiants CDSE
+        margin: Avance du renouvellement sur l'expiration, en secondes
+    """
+
+    def __init__(self, session, token_url=TOKEN_URL, client_id=CLIENT_ID, client_secret=CLIENT_SECRET,
+                 margin=REFRESH_MARGIN):
+        self.session = session
+        self.token_url = token_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._token = None
+        self._refresh_at = 0.0
+
+    def get(self, rejected=None):
+        """
+        Token courant, renouvelé s'il arrive à expiration
+
+        Args:
+            rejected: Token refusé par le serveur (401) : renouvelé s'il est
+                      encore le token courant (une seule fois quand plusieurs
+                      téléchargements le voient refusé en même temps)
+        """
+        with self._lock:
+            if self._token is None or self._token == rejected or time.monotonic() >= self._refresh_at:
+                payload = self._request()
+                expires_in = float(payload.get('expires_in') or DEFAULT_EXPIRES_IN)
+                self._token = payload['access_token']
+                self._refresh_at = time.monotonic() + expires_in - min(self.margin, expires_in / 2)
+            return self._token
+
+    def _request(self):
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+        # 1) client_secret_post
+        data = {
+            "grant_type": "client_credentials",
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+        }
+        r = self.session.post(self.token_url, data=data, headers=headers, timeout=TIMEOUT)
+        if r.ok:
+            return r.json()
+
+        # 2) client_secret_basic (Authorization: Basic base64(client_id:client_secret))
+        basic = base64.b64encode(f"{self.client_id}:{self.client_secret}".encode()).decode()
+        r2 = self.session.post(self.token_url, data={"grant_type": "client_credentials"},
+                               headers={**headers, "Authorization": f"Basic {basic}"}, timeout=TIMEOUT)
+        if r2.ok:
+            return r2.json()
+
+        # Logs d'erreur utiles
+        try:
+            err1 = r.json()
+        except Exception:
+            err1 = r.text
+        try:
+            err2 = r2.json()
+        except Exception:
+            err2 = r2.text
+        raise RuntimeError(f"Token error. POST body auth -> {r.status_code}: {err1} | "
+                           f"Basic auth -> {r2.status_code}: {err2}")
+
+
+def parse_checksum(checksum):
+    """
+    Décode une somme de contrôle "algo:hex"
+
+    Sans préfixe, l'algorithme est déduit de la longueur (32 = md5,
+    40 = sha1, 64 = sha256).
+
+    Returns:
+        tuple: (algorithme hashlib, empreinte hexadécimale en minuscules)
+    """
+    algorithm, _, digest = checksum.rpartition(':')
+    if not algorithm:
+        algorithm = {32: 'md5', 40: 'sha1', 64: 'sha256'}.get(len(digest))
+        if algorithm is None:
+            raise ValueError(f"Algorithme de somme de contrôle inconnu: {checksum}")
+    return algorithm.lower(), digest.lower()
+
+
+def file_digest(path, algorithm):
+    """Empreinte hexadécimale d'un fichier"""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _content_range_total(response):
+    # "bytes 0-0/1234" -> 1234 ("*" si la taille est inconnue)
+    total = response.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+class CopernicusClient:
+    """
+    Client authentifié pour télécharger des produits CDSE
+
+    Args:
+        token_url, client_id, client_secret: Identifiants CDSE
+        pool_size: Connexions HTTP conservées par hôte
+        retries: Relances sur erreur HTTP, et reprises d'un téléchargement
+                 interrompu
+        authenticate: False pour un serveur sans authentification
+    """
+
+    def __init__(self, token_url=TOKEN_URL, client_id=CLIENT_ID, client_secret=CLIENT_SECRET,
+                 pool_size=POOL_SIZE, retries=RETRIES, authenticate=True):
+        self.session = make_session(pool_size, retries)
+        self.tokens = TokenCache(self.session, token_url, client_id, client_secret) if authenticate else None
+        self.retries = retries
+
+    def token(self):
+        """Token d'accès courant (voir TokenCache.get)"""
+        return self.tokens.get()
+
+    def get(self, url, headers=None):
+        """
+        GET authentifié en streaming
+
+        Sur 401, le token est renouvelé et la requête rejouée une fois.
+        """
+        token = None
+        for attempt in range(2):
+            request_headers = dict(headers or {})
+            if self.tokens is not None:
+                token = self.tokens.get(rejected=token)
+                request_headers['Authorization'] = f"Bearer {token}"
+            response = self.session.get(url, headers=request_headers, stream=True, timeout=TIMEOUT)
+            if response.status_code != 401 or self.tokens is None or attempt:
+                return response
+            response.close()
+
+    def probe(self, url):
+        """
+        Taille d'un fichier distant et support des plages
+
+        Demande le premier octet (Range: bytes=0-0) plutôt qu'un HEAD, que
+        tous les serveurs de téléchargement n'acceptent pas.
+
+        Returns:
+            tuple: (taille en octets ou None, True si Range est supporté)
+        """
+        with self.get(url, {'Range': 'bytes=0-0'}) as response:
+            if response.status_code == 206:
+                return _content_range_total(response), True
+            response.raise_for_status()
+            length = response.headers.get('Content-Length')
+            return (int(length) if length else None), False
+
+    def _fetch_range(self, url, path, start=0, end=None, segment=False):
+        # Télécharge [start, end[ dans path, en reprenant après ce que path
+        # contient déjà ; end=None : jusqu'à la fin du fichier distant.
+        # Hors segment, une réponse 200 (plages ignorées) recommence au début
+        for attempt in range(self.retries + 1):
+            offset = os.path.getsize(path) if os.path.exists(path) else 0
+            if end is not None and start + offset >= end:
+                return
+            headers = {}
+            if start + offset > 0 or end is not None:
+                headers['Range'] = f"bytes={start + offset}-{'' if end is None else end - 1}"
+            try:
+                with self.get(url, headers) as response:
+                    if response.status_code == 416 and end is None:
+                        return
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        if segment:
+                            raise RuntimeError(f"Le serveur ignore les plages (Range) pour {url}")
+                        offset = 0
+                    with open(path, 'ab' if offset else 'wb') as f:
+                        for block in response.iter_content(CHUNK_SIZE):
+                            f.write(block)
+                if end is None or start + os.path.getsize(path) >= end:
+                    return
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout):
+                if attempt == self.retries:
+                    raise
+        raise IOError(f"Téléchargement incomplet: {url}")
+
+    def _fetch_segments(self, url, part, size, segments):
+        bounds = [size * i // segments for i in range(segments + 1)]
+        paths = [f"{part}.{i}" for i in range(segments)]
+        # Segments d'un découpage différent (autre --segments) : on repart de zéro
+        stale = glob.glob(glob.escape(part) + '.*')
+        if set(stale) != set(paths):
+            for path in stale:
+                os.remove(path)
+        with ThreadPoolExecutor(max_workers=segments) as executor:
+            futures = [executor.submit(self._fetch_range, url, path, bounds[i], bounds[i + 1], True)
+                       for i, path in enumerate(paths)]
+            for future in futures:
+                future.result()
+        with open(part, 'wb') as f:
+            for path in paths:
+                with open(path, 'rb') as segment:
+                    shutil.copyfileobj(segment, f, CHUNK_SIZE)
+        for path in paths:
+            os.remove(path)
+
+    def download(self, url, dest, checksum=None, segments=1):
+        """
+        Télécharge un fichier, avec reprise et vérification
+
+        Le fichier est écrit dans dest + '.part' (ou dest + '.part.N' par
+        segment), repris à la taille déjà reçue si le téléchargement a été
+        interrompu, puis renommé en dest une fois complet et vérifié. Un
+        dest existant et conforme n'est pas retéléchargé.
+
+        Args:
+            url: URL du fichier
+            dest: Chemin de destination
+            checksum: Somme de contrôle attendue "algo:hex" (voir
+                      parse_checksum), None = taille seule
+            segments: Nombre de plages téléchargées en parallèle (si le
+                      serveur les supporte et que chaque segment fait au
+                      moins MIN_SEGMENT_SIZE)
+
+        Raises:
+            ChecksumError: si le fichier reçu ne correspond pas à checksum
+                           (le .part est supprimé)
+
+        Returns:
+            str: dest
+        """
+        expected = parse_checksum(checksum) if checksum else None
+        if expected and os.path.exists(dest) and file_digest(dest, expected[0]) == expected[1]:
+            return dest
+
+        size, ranged = self.probe(url)
+        if not expected and size is not None and os.path.exists(dest) and os.path.getsize(dest) == size:
+            return dest
+
+        part = dest + '.part'
+        segments = min(segments, size // MIN_SEGMENT_SIZE) if ranged and size else 1
+        if segments > 1 and not os.path.exists(part):
+            self._fetch_segments(url, part, size, segments)
+        else:
+            self._fetch_range(url, part, 0, size if ranged else None)
+
+        if size is not None and os.path.getsize(part) != size:
+            received = os.path.getsize(part)
+            os.remove(part)
+            raise IOError(f"Taille inattendue pour {url}: {received} octets au lieu de {size}")
+        if expected:
+            actual = file_digest(part, expected[0])
+            if actual != expected[1]:
+                os.remove(part)
+                raise ChecksumError(f"Somme de contrôle {expected[0]} invalide pour {url}: "
+                                    f"{actual} au lieu de {expected[1]}")
+        os.replace(part, dest)
+        return dest
+
+    def download_many(self, items, dest_dir, workers=DOWNLOAD_WORKERS, segments=1):
+        """
+        Télécharge plusieurs fichiers avec un pool borné
+
+        Args:
+            items: Entrées {'url', 'name' (optionnel), 'checksum' (optionnel)}
+            dest_dir: Dossier de destination
+            workers: Téléchargements simultanés
+            segments: Segments par fichier (voir download)
+
+        Yields:
+            tuple: (entrée, chemin ou None, exception ou None), dans l'ordre
+                   de fin des téléchargements
+        """
+        os.makedirs(dest_dir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(self.download, item['url'], os.path.join(dest_dir, item_name(item)),
+                                item.get('checksum'), segments): item
+                for item in items
+            }
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except Exception as e:
+                    yield futures[future], None, e
+
+
+def item_name(item):
+    """Nom de fichier d'une entrée : 'name', ou dernier segment de l'URL"""
+    return item.get('name') or os.path.basename(urlparse(item['url']).path)
+
+
+def load_manifest(path):
+    """
+    Charge une liste de fichiers à télécharger
+
+    Le manifeste est une liste JSON d'URL ou d'entrées
+    {"url": ..., "name": ..., "checksum": "md5:..."}.
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    return [{'url': entry} if isinstance(entry, str) else entry for entry in entries]
+
+
+def fetch_and_build(client, items, dest_dir, output_file=None, workers=DOWNLOAD_WORKERS, segments=1,
+                    **build_options):
+    """
+    Télécharge des fichiers NetCDF puis génère la carte
+
+    Args:
+        client: CopernicusClient
+        items: Entrées du manifeste (voir load_manifest)
+        dest_dir: Dossier des fichiers téléchargés
+        output_file: Carte à générer, None = téléchargement seul
+        workers, segments: voir CopernicusClient.download_many
+        **build_options: Arguments de generate_square_map.process_multiple_netcdf
+                         (cell_size, variables, state_dir...)
+
+    Raises:
+        RuntimeError: si un téléchargement a échoué (la carte n'est pas générée)
+
+    Returns:
+        list: Chemins des fichiers téléchargés, dans l'ordre du manifeste
+    """
+    paths = {}
+    errors = []
+    for item, path, error in client.download_many(items, dest_dir, workers, segments):
+        if error is None:
+            paths[item['url']] = path
+            print(f"   ✓ {item_name(item)}")
+        else:
+            errors.append(f"{item['url']}: {error}")
+            print(f"   ✗ {item_name(item)}: {error}")
+    if errors:
+        raise RuntimeError(f"{len(errors)} téléchargement(s) en échec:\n" + '\n'.join(errors))
+
+    files = [paths[item['url']] for item in items]
+    if output_file:
+        from generate_square_map import process_multiple_netcdf
+        process_multiple_netcdf(','.join(files), output_file, **build_options)
+    return files
+
+
+_default_client = None
+
+
 def get_token():
-    # 1) client_secret_post
-    data = {
-        "grant_type": "client_credentials",
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-    }
-    r = requests.post(TOKEN_URL, data=data, headers={"Content-Type": "application/x-www-form-urlencoded"})
-    if r.ok:
-        return r.json()["access_token"]
-
-    # 2) client_secret_basic (Authorization: Basic base64(client_id:client_secret))
-    basic = base64.b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode()
-    r2 = requests.post(
-        TOKEN_URL,
-        data={"grant_type": "client_credentials"},
-        headers={
-            "Authorization": f"Basic {basic}",
-            "Content-Type": "application/x-www-form-urlencoded"
-        },
-    )
-    if r2.ok:
-        return r2.json()["access_token"]
-
-    # Logs d'erreur utiles
-    try:
-        err1 = r.json()
-    except Exception:
-        err1 = r.text
-    try:
-        err2 = r2.json()
-    except Exception:
-        err2 = r2.text
-    raise RuntimeError(f"Token error. POST body auth -> {r.status_code}: {err1} | Basic auth -> {r2.status_code}: {err2}")
+    """Token d'accès du client par défaut (mis en cache jusqu'à expiration)"""
+    global _default_client
+    if _default_client is None:
+        _default_client = CopernicusClient()
+    return _default_client.token()
+
 
 if __name__ == "__main__":
-    print("🔑 Obtention du token…")
-    token = get_token()
-    print("✅ Token OK (longueur):", len(token))
+    args = sys.argv[1:]
+    if not args:
+        print("🔑 Obtention du token…")
+        token = get_token()
+        print("✅ Token OK (longueur):", len(token))
+        sys.exit(0)
+
+    if args[0] != 'download' or len(args) < 3:
+        print("""
+Usage: python api_fetch.py
+       python api_fetch.py download <manifest.json> <dest_dir> [options]
+
+Sans argument : vérifie les identifiants (CDSE_CLIENT_ID, CDSE_CLIENT_SECRET)
+
+download :
+  manifest.json : Liste JSON d'URL ou d'entrées
+                  {"url": ..., "name": ..., "checksum": "md5:..."}
+  dest_dir      : Dossier de destination ; les fichiers déjà présents et
+                  conformes sont conservés, les .part interrompus repris
+
+Options:
+  --workers N    : Téléchargements simultanés (défaut: CDSE_DOWNLOAD_WORKERS, 4)
+  --segments N   : Plages téléchargées en parallèle par fichier (défaut: 1)
+  --no-auth      : Pas de token (serveur local, miroir public)
+  --build OUT    : Génère ensuite la carte OUT depuis les fichiers téléchargés
+  --cell-size C  : Taille des cellules de la carte (défaut: 1.0)
+  --variables V  : Variables de la carte, séparées par des virgules
+  --time-agg T   : Agrégation temporelle de la carte (défaut: 'first')
+  --state-dir D  : Dossier d'état du générateur : seuls les fichiers
+                   nouveaux ou modifiés sont retraités
+
+Exemple:
+  python api_fetch.py download era5.json game_resources_data --workers 4 --build game_map.json --cell-size 0.5
+        """)
+        sys.exit(1)
+
+    from generate_square_map import pop_option
+    workers = int(pop_option(args, '--workers', DOWNLOAD_WORKERS))
+    segments = int(pop_option(args, '--segments', 1))
+    authenticate = '--no-auth' not in args
+    if not authenticate:
+        args.remove('--no-auth')
+    output_file = pop_option(args, '--build')
+    variables = pop_option(args, '--variables')
+    build_options = {
+        'cell_size': float(pop_option(args, '--cell-size', 1.0)),
+        'variables': variables.split(',') if variables else None,
+        'time_aggregation': pop_option(args, '--time-agg', 'first'),
+        'state_dir': pop_option(args, '--state-dir')
+    }
+
+    items = load_manifest(args[1])
+    client = CopernicusClient(pool_size=max(POOL_SIZE, workers * segments), authenticate=authenticate)
+    print(f"⬇️  {len(items)} fichier(s) vers {args[2]} ({workers} en parallèle)")
+    try:
+        fetch_and_build(client, items, args[2], output_file, workers, segments, **build_options)
+    except Exception as e:
+        print(f"\n❌ ERREUR: {e}")
+        sys.exit(1)
+    print("✅ Terminé")
@@ -1,28 +1,107 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import xarray as xr
 import numpy as np
-import tempfile
 import os
+import threading
+
+from jobs import JobQueue, QueueFull
+from map_diff import compose_diffs
+from map_format import load_map_columns
+from map_store import MapStore
+from metrics import METRICS, stage
+from netcdf_io import netcdf_loaded, open_upload, parse_bbox, parse_time_range, warm_up
+from result_cache import ResultCache, hash_stream, make_key
+from square_grid import format_keys, latlon_to_keys, tile_centers, unpack_keys
+from square_processing import CoordinatesNotFound, aggregate_dataset, iter_ndjson
+from square_stats import parse_histograms, take_columns
+from tile_index import TilePyramid
+from wire_format import FormatNotAvailable, MEDIA_TYPES, compress, encode_tiles, negotiate_encoding, negotiate_format
 
 app = Flask(__name__)
 CORS(app)
 
-def latlon_to_square(lat, lon, size):
+result_cache = ResultCache.from_env()
+# MAP_STORE : magasin publié par generate_square_map.py --store, mappé en
+# mémoire en commun par tous les workers (prioritaire sur MAP_FILE)
+tile_pyramid = TilePyramid(os.getenv('MAP_FILE', os.path.join('map', 'game_map.json')),
+                           store=MapStore(os.getenv('MAP_STORE')) if os.getenv('MAP_STORE') else None)
+# Nombre maximal de points convertis par requête /convert-to-square
+MAX_CONVERT_POINTS = int(os.getenv('MAX_CONVERT_POINTS', '100000'))
+
+job_queue = JobQueue.from_env(on_done=lambda job, body: result_cache.put(job['cache_key'], body))
+
+def prewarm():
     """
-    Convertit des coordonnées lat/lon en coordonnées de grille carrée
+    Importe la pile NetCDF (xarray, pandas...) dans un thread d'arrière-plan
+
+    Sans pré-chauffage, elle est importée par la première requête NetCDF.
+    Appelé au chargement si PREWARM=1, ou depuis un hook du serveur WSGI
+    (ex: post_fork de gunicorn) ; /health et /convert-to-square répondent
+    pendant ce temps.
+    """
+    threading.Thread(target=warm_up, name='prewarm', daemon=True).start()
+
+if os.getenv('PREWARM', '0') == '1':
+    prewarm()
+
+def json_body(data):
+    """Encode une réponse JSON une seule fois (réutilisée par le cache)"""
+    with stage('serialization'):
+        return app.json.dumps(data).encode('utf-8')
+
+def json_response(body):
+    return app.response_class(body, mimetype='application/json')
+
+def read_wire_params():
+    """
+    Format (Accept ou format=) et précision (precision=float32) des tuiles
     
-    Args:
-        lat: Latitude
-        lon: Longitude
-        size: Taille de la cellule en degrés
+    Raises:
+        FormatNotAvailable: si le format demandé est indisponible
+    """
+    fmt = negotiate_format(request.accept_mimetypes, request.values.get('format'))
+    return fmt, request.values.get('precision') == 'float32'
+
+def tiles_response(body, fmt):
+    """Réponse de tuiles encodées, compressée selon Accept-Encoding"""
+    with stage('compression'):
+        body, encoding = compress(body, negotiate_encoding(request.accept_encodings))
+    response = app.response_class(body, mimetype=MEDIA_TYPES[fmt])
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.update(['Accept', 'Accept-Encoding'])
+    return response
+
+@app.after_request
+def count_request(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    METRICS.inc('http_requests', [('route', route), ('method', request.method), ('status', response.status_code)])
+    return response
+
+def read_process_params():
+    """
+    Lit les paramètres de /process et /jobs depuis le formulaire
     
-    Returns:
-        str: Coordonnées de la cellule "x,y"
+    Raises:
+        ValueError: si bbox, time_range ou histograms est invalide
     """
-    x = int(np.floor(lon / size))
-    y = int(np.floor(lat / size))
-    return f"{x},{y}"
+    params = {
+        'cell_size': float(request.form.get('cell_size', 1.0)),
+        'variables': request.form.get('variables', '').split(','),
+        'bbox': parse_bbox(request.form.get('bbox')),
+        'time_range': parse_time_range(request.form.get('time_range'))
+    }
+    # histograms="t2m=200:330,tp=0:0.05:64" : percentiles et histogramme par tuile
+    histograms = parse_histograms(request.form.get('histograms'))
+    if histograms:
+        params['histograms'] = histograms
+    return params
+
+def wants_stream():
+    """Réponse NDJSON demandée (?stream=1 ou Accept: application/x-ndjson)"""
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    return request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
 
 @app.route('/process', methods=['POST'])
 def process_netcdf():
@@ -30,101 +109,100 @@ def process_netcdf():
         return jsonify({'error': 'No file provided'}), 400
     
     file = request.files['file']
-    cell_size = float(request.form.get('cell_size', 1.0))
-    variables = request.form.get('variables', '').split(',')
+    try:
+        params = read_process_params()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.nc') as tmp_file:
-        file.save(tmp_file.name)
-        tmp_path = tmp_file.name
+    if wants_stream():
+        return process_netcdf_stream(file, params)
     
     try:
-        ds = xr.open_dataset(tmp_path)
-        
-        lat_names = ['lat', 'latitude', 'y']
-        lon_names = ['lon', 'longitude', 'x']
-        
-        lat_var = next((name for name in lat_names if name in ds.coords), None)
-        lon_var = next((name for name in lon_names if name in ds.coords), None)
-        
-        if not lat_var or not lon_var:
-            return jsonify({'error': f'Coordonnées non trouvées. Variables: {list(ds.coords.keys())}'}), 400
-        
-        if not variables or variables == ['']:
-            variables = [var for var in ds.data_vars if len(ds[var].dims) >= 2]
-        
-        square_grid = {}
-        lats = ds[lat_var].values
-        lons = ds[lon_var].values
-        
-        for var in variables:
-            if var not in ds.variables:
-                continue
-            
-            data = ds[var].values
-            if len(data.shape) > 2:
-                data = data[0]
-            
-            for i in range(len(lats)):
-                for j in range(len(lons)):
-                    lat = float(lats[i])
-                    lon = float(lons[j])
-                    square_coord = latlon_to_square(lat, lon, cell_size)
-                    
-                    if square_coord not in square_grid:
-                        square_grid[square_coord] = {
-                            'count': 0,
-                            'lat': 0,
-                            'lon': 0
-                        }
-                    
-                    if var not in square_grid[square_coord]:
-                        square_grid[square_coord][var] = []
-                    
-                    value = data[i, j]
-                    if not np.isnan(value):
-                        square_grid[square_coord][var].append(float(value))
-                        square_grid[square_coord]['count'] += 1
-                        square_grid[square_coord]['lat'] += lat
-                        square_grid[square_coord]['lon'] += lon
-        
-        # Calculer les moyennes
-        for coord in list(square_grid.keys()):
-            tile = square_grid[coord]
-            if tile['count'] == 0:
-                del square_grid[coord]
-                continue
-                
-            tile['lat'] /= tile['count']
-            tile['lon'] /= tile['count']
-            
-            for var in variables:
-                if var in tile and isinstance(tile[var], list):
-                    if len(tile[var]) > 0:
-                        values = tile[var]
-                        tile[var] = {
-                            'mean': float(np.mean(values)),
-                            'min': float(np.min(values)),
-                            'max': float(np.max(values)),
-                            'std': float(np.std(values))
-                        }
-        
-        ds.close()
-        
-        return jsonify({
-            'tiles': square_grid,
-            'variables': variables,
-            'metadata': {
-                'tile_count': len(square_grid),
-                'cell_size': cell_size,
-                'grid_type': 'square'
-            }
-        })
+        fmt, float32 = read_wire_params()
+    except FormatNotAvailable as e:
+        return jsonify({'error': str(e)}), 406
     
+    # La clé du JSON par défaut reste celle partagée avec /jobs
+    wire_params = {'format': fmt, 'float32': float32} if fmt != 'json' or float32 else {}
+    cache_key = make_key(hash_stream(file.stream), 'process', **params, **wire_params)
+    body = result_cache.get(cache_key)
+    if body is not None:
+        return tiles_response(body, fmt)
+    
+    try:
+        with open_upload(file.stream) as ds:
+            columns, variables, metadata = aggregate_dataset(ds, **params)
+        body = encode_tiles(columns, variables, metadata, fmt, float32, include_var_count=False,
+                            empty_value=[], encode_json=json_body)
+        result_cache.put(cache_key, body)
+        return tiles_response(body, fmt)
+    
+    except CoordinatesNotFound as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-    finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+
+def process_netcdf_stream(file, params):
+    """
+    /process en NDJSON : métadonnées puis une tuile par ligne, encodées au
+    fil de l'envoi (les réponses en flux ne passent pas par le cache)
+    """
+    try:
+        with open_upload(file.stream) as ds:
+            columns, variables, metadata = aggregate_dataset(ds, **params)
+    except CoordinatesNotFound as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    return app.response_class(iter_ndjson(columns, variables, metadata), mimetype='application/x-ndjson')
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Soumet un traitement /process asynchrone et renvoie l'identifiant du job
+    """
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file provided'}), 400
+    
+    file = request.files['file']
+    try:
+        params = read_process_params()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    cache_key = make_key(hash_stream(file.stream), 'process', **params)
+    body = result_cache.get(cache_key)
+    if body is not None:
+        job = job_queue.add_done(body, cache_key)
+        return jsonify({'id': job['id'], 'status': job['status']}), 200
+    
+    try:
+        job = job_queue.submit(file.stream.read(), params, cache_key)
+    except QueueFull as e:
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = '5'
+        return response, 429
+    
+    return jsonify({'id': job['id'], 'status': job['status']}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    État, progression et résultat d'un job
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job inconnu'}), 404
+    
+    status = {'id': job['id'], 'status': job['status'], 'progress': job['progress']}
+    if job['error']:
+        status['error'] = job['error']
+    if job['body'] is None:
+        return jsonify(status)
+    
+    # Le résultat est déjà encodé : on l'insère sans le re-sérialiser
+    return json_response(json_body(status)[:-1] + b', "result": ' + job['body'] + b'}')
 
 @app.route('/info', methods=['POST'])
 def get_nc_info():
@@ -133,44 +211,140 @@ def get_nc_info():
     
     file = request.files['file']
     
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.nc') as tmp_file:
-        file.save(tmp_file.name)
-        tmp_path = tmp_file.name
+    cache_key = make_key(hash_stream(file.stream), 'info')
+    body = result_cache.get(cache_key)
+    if body is not None:
+        return json_response(body)
     
     try:
-        ds = xr.open_dataset(tmp_path)
-        
-        # Obtenir des infos détaillées sur les variables
-        variables_info = {}
-        for var in ds.data_vars:
-            variables_info[var] = {
-                'dimensions': list(ds[var].dims),
-                'shape': list(ds[var].shape),
-                'dtype': str(ds[var].dtype),
-                'attributes': dict(ds[var].attrs) if hasattr(ds[var], 'attrs') else {}
+        with open_upload(file.stream) as ds:
+            # Obtenir des infos détaillées sur les variables
+            variables_info = {}
+            for var in ds.data_vars:
+                variables_info[var] = {
+                    'dimensions': list(ds[var].dims),
+                    'shape': list(ds[var].shape),
+                    'dtype': str(ds[var].dtype),
+                    'attributes': dict(ds[var].attrs) if hasattr(ds[var], 'attrs') else {}
+                }
+            
+            info = {
+                'dimensions': dict(ds.sizes),
+                'coordinates': list(ds.coords.keys()),
+                'variables': list(ds.data_vars.keys()),
+                'variables_info': variables_info,
+                'attributes': dict(ds.attrs)
             }
-        
-        info = {
-            'dimensions': dict(ds.dims),
-            'coordinates': list(ds.coords.keys()),
-            'variables': list(ds.data_vars.keys()),
-            'variables_info': variables_info,
-            'attributes': dict(ds.attrs)
-        }
-        ds.close()
-        return jsonify(info)
+        body = json_body(info)
+        result_cache.put(cache_key, body)
+        return json_response(body)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-    finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+
+@app.route('/tiles', methods=['GET'])
+def get_tiles():
+    """
+    Tuiles d'un niveau de la pyramide de carte, restreintes à une bbox
+    
+    Paramètres: level (défaut 0), bbox "lat_min,lat_max,lon_min,lon_max"
+    """
+    try:
+        level = int(request.args.get('level', 0))
+        bbox = parse_bbox(request.args.get('bbox'))
+        fmt, float32 = read_wire_params()
+    except FormatNotAvailable as e:
+        return jsonify({'error': str(e)}), 406
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        tile_level = tile_pyramid.level(level)
+    except FileNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    except IndexError as e:
+        return jsonify({'error': str(e)}), 404
+    
+    columns = tile_level.query(bbox)
+    metadata = {
+        'level': level,
+        'cell_size': tile_level.cell_size,
+        'tile_count': len(columns['x']),
+        'bbox': list(bbox) if bbox else None,
+        'grid_type': 'square'
+    }
+    body = encode_tiles(columns, list(columns['variables']), metadata, fmt, float32, encode_json=json_body)
+    return tiles_response(body, fmt)
+
+@app.route('/tiles/diff', methods=['GET'])
+def get_tiles_diff():
+    """
+    Tuiles ajoutées, modifiées et supprimées d'un niveau depuis une version
+
+    Paramètres: since (version connue du client, voir /health), level
+    (défaut 0). Les tuiles ajoutées puis modifiées sont dans 'tiles', les
+    coordonnées des tuiles supprimées dans metadata['removed'].
+    Réponse 410 si la version n'est plus couverte par les diffs conservés :
+    le client recharge alors le niveau complet (/tiles).
+    """
+    if tile_pyramid.store is None:
+        return jsonify({'error': 'Diffs disponibles uniquement avec MAP_STORE'}), 404
+
+    try:
+        since = request.args.get('since')
+        if not since:
+            raise ValueError("Paramètre 'since' requis")
+        level = int(request.args.get('level', 0))
+        fmt, float32 = read_wire_params()
+    except FormatNotAvailable as e:
+        return jsonify({'error': str(e)}), 406
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        tile_level = tile_pyramid.level(level)
+    except FileNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    except IndexError as e:
+        return jsonify({'error': str(e)}), 404
+
+    version = tile_pyramid.version
+    paths = tile_pyramid.store.diff_paths(since, level, version)
+    try:
+        if paths is None:
+            raise ValueError(f"Version {since} inconnue ou trop ancienne : recharger la carte")
+        if paths:
+            with stage('merge'):
+                columns, info = compose_diffs([load_map_columns(path) for path in paths])
+        else:
+            columns, info = take_columns(tile_level.columns, slice(0, 0)), {'added': 0, 'changed': 0, 'removed': []}
+    except ValueError as e:
+        return jsonify({'error': str(e), 'version': version}), 410
+
+    metadata = {
+        'level': level,
+        'cell_size': tile_level.cell_size,
+        'base_version': since,
+        'version': version,
+        'tile_count': len(columns['x']),
+        **info,
+        'grid_type': 'square'
+    }
+    body = encode_tiles(columns, list(columns['variables']), metadata, fmt, float32, encode_json=json_body)
+    return tiles_response(body, fmt)
 
 @app.route('/convert-to-square', methods=['POST'])
 def convert_to_square():
     """
     Endpoint pour convertir directement des coordonnées lat/lon en grille carrée
+    
+    Forme simple : {"lat": 48.8, "lon": 2.3, "cell_size": 1.0}
+    Forme par lot : {"lat": [...], "lon": [...], "cell_size": 1.0}
+                    ou {"points": [[lat, lon], ...], "cell_size": 1.0}
     """
-    data = request.get_json()
+    data = request.get_json(silent=True)
+    
+    if data and ('points' in data or isinstance(data.get('lat'), list)):
+        return convert_to_square_batch(data)
     
     if not data or 'lat' not in data or 'lon' not in data:
         return jsonify({'error': 'lat and lon required'}), 400
@@ -179,20 +353,71 @@ def convert_to_square():
     lon = float(data['lon'])
     cell_size = float(data.get('cell_size', 1.0))
     
-    square_coord = latlon_to_square(lat, lon, cell_size)
-    x, y = map(int, square_coord.split(','))
+    key = latlon_to_keys(lat, lon, cell_size)
+    x, y = unpack_keys(key)
     
     return jsonify({
-        'square_coord': square_coord,
-        'x': x,
-        'y': y,
+        'square_coord': format_keys(key)[0],
+        'x': int(x),
+        'y': int(y),
         'cell_size': cell_size,
         'original': {'lat': lat, 'lon': lon}
     })
 
+def convert_to_square_batch(data):
+    """
+    Conversion vectorisée d'un lot de points : listes alignées sur l'ordre
+    des points ('square_coords', 'x', 'y' et centre de chaque tuile)
+    """
+    try:
+        cell_size = float(data.get('cell_size', 1.0))
+        if 'points' in data:
+            points = np.asarray(data['points'], dtype=np.float64).reshape(-1, 2)
+            lats, lons = points[:, 0], points[:, 1]
+        else:
+            lats = np.asarray(data['lat'], dtype=np.float64)
+            lons = np.asarray(data['lon'], dtype=np.float64)
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'points ([[lat, lon], ...]) or lat and lon lists required'}), 400
+    
+    if lats.ndim != 1 or lats.shape != lons.shape:
+        return jsonify({'error': 'lat and lon must be lists of the same length'}), 400
+    if len(lats) > MAX_CONVERT_POINTS:
+        return jsonify({'error': f'Too many points ({len(lats)} > {MAX_CONVERT_POINTS})'}), 413
+    if cell_size <= 0 or not np.all(np.isfinite(lats) & np.isfinite(lons)):
+        return jsonify({'error': 'cell_size must be positive and coordinates finite'}), 400
+    
+    keys = latlon_to_keys(lats, lons, cell_size)
+    x, y = unpack_keys(keys)
+    center_lat, center_lon = tile_centers(keys, cell_size)
+    
+    return json_response(json_body({
+        'count': len(keys),
+        'cell_size': cell_size,
+        'square_coords': format_keys(keys),
+        'x': x.tolist(),
+        'y': y.tolist(),
+        'center': {'lat': center_lat.tolist(), 'lon': center_lon.tolist()}
+    }))
+
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({'status': 'ok', 'grid_type': 'square'})
+    return jsonify({
+        'status': 'ok',
+        'grid_type': 'square',
+        'cache': result_cache.stats(),
+        'jobs': job_queue.stats(),
+        'map_version': tile_pyramid.version,
+        'netcdf_loaded': netcdf_loaded()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Durées par étape et compteurs de requêtes au format Prometheus
+    (les étapes des jobs asynchrones sont ajoutées quand ils se terminent)
+    """
+    return app.response_class(METRICS.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
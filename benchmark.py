@@ -0,0 +1,350 @@
+"""
+Benchmarks de la chaîne de génération de carte et du backend
+
+Génère localement des fichiers NetCDF synthétiques (grilles de 1° à 0.1°,
+variables 2D et 3D, masque océan plein de NaN, latitudes croissantes ou
+décroissantes) puis mesure pour chacun :
+    process_single_file : agrégation d'un fichier (mode 'all')
+    merge_file_data     : fusion de deux fichiers et calcul des tuiles
+    json_dump           : sérialisation de game_map.json
+    process_endpoint    : POST /process via le client de test Flask
+    info_endpoint       : POST /info via le client de test Flask
+ainsi que le pic de mémoire (RSS) du processus qui exécute le cas.
+
+Le démarrage à froid du backend est mesuré à part, dans un interpréteur
+neuf : import de backend.py (import_backend) et réponse au premier /health
+(first_health). Le cas échoue si l'import charge xarray, qui doit rester
+paresseux (voir netcdf_io.load_xarray).
+
+Chaque cas tourne dans un processus neuf, pour que le pic RSS et les
+imports ne dépendent pas des cas précédents. Les résultats sont écrits en
+JSON et comparés à une référence : un temps plus lent que la référence de
+plus du seuil (défaut: 25 %) est signalé et le script sort en erreur.
+"""
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+from generate_square_map import merge_file_data, pop_option, process_single_file
+
+RESOLUTIONS = [1.0, 0.5, 0.25, 0.1]
+QUICK_RESOLUTIONS = [1.0, 0.5]
+LAT_ORDERS = ['ascending', 'descending']
+TIME_STEPS = 4
+STAGES = ['process_single_file', 'merge_file_data', 'json_dump', 'process_endpoint', 'info_endpoint']
+STARTUP_STAGES = ['import_backend', 'first_health']
+
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import backend
+imported = time.perf_counter()
+response = backend.app.test_client().get('/health')
+print(json.dumps({'import_backend': imported - start, 'first_health': time.perf_counter() - start,
+                  'status': response.status_code, 'netcdf_loaded': 'xarray' in sys.modules}))
+'''
+
+
+def fixture_path(data_dir, resolution, lat_order):
+    return Path(data_dir) / f"bench_{resolution:g}deg_{lat_order}.nc"
+
+
+def make_fixture(path, resolution, lat_order, time_steps=TIME_STEPS):
+    """
+    Écrit un fichier NetCDF synthétique
+
+    Variables :
+        orography (lat, lon)        : champ 2D sans NaN
+        t2m       (time, lat, lon)  : champ 3D sans NaN
+        sst       (time, lat, lon)  : champ 3D, NaN sur les terres (~40 %)
+
+    Args:
+        path: Fichier à écrire
+        resolution: Pas de la grille en degrés
+        lat_order: 'ascending' ou 'descending'
+        time_steps: Nombre de pas de temps des variables 3D
+    """
+    lats = np.linspace(-90, 90, int(round(180 / resolution)) + 1)
+    if lat_order == 'descending':
+        lats = lats[::-1]
+    lons = np.arange(0, 360, resolution)
+    times = np.arange('2024-01', '2025-01', dtype='datetime64[M]')[:time_steps].astype('datetime64[ns]')
+
+    lat_grid, lon_grid = np.meshgrid(np.radians(lats), np.radians(lons), indexing='ij')
+    base = (np.cos(lat_grid) * 30 + np.sin(3 * lon_grid) * 5).astype(np.float32)
+    land = (np.sin(2 * lon_grid) * np.cos(3 * lat_grid) + np.sin(5 * lat_grid + lon_grid) * 0.5) > 0.3
+
+    rng = np.random.default_rng(0)
+    t2m = base[None] + rng.normal(0, 1, size=(time_steps,) + base.shape).astype(np.float32)
+    sst = t2m.copy()
+    sst[:, land] = np.nan
+
+    ds = xr.Dataset(
+        {
+            'orography': (('latitude', 'longitude'), base * 100),
+            't2m': (('time', 'latitude', 'longitude'), t2m),
+            'sst': (('time', 'latitude', 'longitude'), sst)
+        },
+        coords={'time': times, 'latitude': lats, 'longitude': lons}
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    ds.to_netcdf(path)
+
+
+def peak_rss_mb():
+    """Pic de mémoire résidente du processus courant, en Mo"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss est en octets sur macOS, en kilo-octets ailleurs
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def best_time(function, repeat):
+    """
+    Meilleur temps de `repeat` exécutions
+
+    Returns:
+        tuple: (secondes, résultat de la dernière exécution)
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_case(path, cell_size, repeat):
+    """
+    Mesure toutes les étapes sur un fichier (exécuté dans un processus dédié)
+
+    Returns:
+        dict: {étape: secondes, 'peak_rss_mb': Mo}
+    """
+    # Pas de cache de résultats : chaque requête doit refaire le calcul
+    os.environ['RESULT_CACHE_MEMORY_MB'] = '0'
+    os.environ.pop('RESULT_CACHE_DIR', None)
+    import backend
+
+    client = backend.app.test_client()
+    data = Path(path).read_bytes()
+    timings = {}
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        timings['process_single_file'], file_data = best_time(
+            lambda: process_single_file(path, cell_size, time_aggregation='all'), repeat)
+        timings['merge_file_data'], tiles = best_time(lambda: merge_file_data([file_data, file_data]), repeat)
+    timings['json_dump'], _ = best_time(
+        lambda: json.dumps({'metadata': {'cell_size': cell_size}, 'tiles': tiles}, indent=2), repeat)
+
+    def post(route):
+        response = client.post(route, data={'file': (io.BytesIO(data), Path(path).name),
+                                            'cell_size': str(cell_size)},
+                               content_type='multipart/form-data')
+        if response.status_code != 200:
+            raise RuntimeError(f"{route}: HTTP {response.status_code} {response.get_data(as_text=True)[:200]}")
+        return response
+
+    timings['process_endpoint'], _ = best_time(lambda: post('/process'), repeat)
+    timings['info_endpoint'], _ = best_time(lambda: post('/info'), repeat)
+    timings['peak_rss_mb'] = peak_rss_mb()
+    return timings
+
+
+def run_startup(repeat):
+    """
+    Mesure le démarrage à froid du backend, un interpréteur neuf par exécution
+
+    Returns:
+        dict: {étape de STARTUP_STAGES: secondes (meilleur temps)}
+
+    Raises:
+        RuntimeError: si /health échoue ou si l'import charge xarray
+    """
+    best = {}
+    env = {**os.environ, 'PREWARM': '0', 'RESULT_CACHE_MEMORY_MB': '0'}
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], capture_output=True, text=True,
+                                check=True, cwd=Path(__file__).resolve().parent, env=env).stdout
+        measures = json.loads(output.strip().splitlines()[-1])
+        if measures['status'] != 200:
+            raise RuntimeError(f"/health: HTTP {measures['status']}")
+        if measures['netcdf_loaded']:
+            raise RuntimeError("import backend charge xarray : l'import de la pile NetCDF n'est plus paresseux")
+        for name in STARTUP_STAGES:
+            best[name] = min(best.get(name, measures[name]), measures[name])
+    return best
+
+
+def run_benchmarks(data_dir='bench_data', resolutions=None, cell_size=1.0, repeat=3, startup_only=False):
+    """
+    Génère les fichiers manquants et exécute tous les cas
+
+    Args:
+        data_dir: Dossier des fichiers synthétiques (réutilisés d'une exécution à l'autre)
+        resolutions: Pas de grille en degrés (défaut: RESOLUTIONS)
+        cell_size: Taille des cellules de la carte en degrés
+        repeat: Nombre d'exécutions par étape (le meilleur temps est gardé)
+        startup_only: Mesure seulement le démarrage du backend
+
+    Returns:
+        dict: {'environment', 'parameters', 'startup': mesures,
+               'results': {cas: mesures}}
+    """
+    print("⏱️  démarrage du backend...")
+    startup = run_startup(repeat)
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for resolution in [] if startup_only else resolutions or RESOLUTIONS:
+        for lat_order in LAT_ORDERS:
+            path = fixture_path(data_dir, resolution, lat_order)
+            if not path.exists():
+                print(f"🧪 Génération de {path}...")
+                make_fixture(path, resolution, lat_order)
+
+            case = f"{resolution:g}deg_{lat_order}"
+            print(f"⏱️  {case}...")
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                results[case] = executor.submit(run_case, str(path), cell_size, repeat).result()
+
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'xarray': xr.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')
+        },
+        'parameters': {'cell_size': cell_size, 'repeat': repeat, 'time_steps': TIME_STEPS},
+        'startup': startup,
+        'results': results
+    }
+
+
+def compare(results, baseline, threshold=0.25):
+    """
+    Compare des mesures à une référence
+
+    Args:
+        results: Sortie de run_benchmarks
+        baseline: Sortie de run_benchmarks enregistrée comme référence
+        threshold: Ralentissement relatif toléré (0.25 = +25 %)
+
+    Returns:
+        list: Régressions [(cas, étape, référence, mesure, rapport)]
+    """
+    regressions = []
+    reference = baseline.get('startup') or {}
+    for stage in STARTUP_STAGES:
+        if reference.get(stage) and stage in results.get('startup', {}):
+            ratio = results['startup'][stage] / reference[stage]
+            if ratio > 1 + threshold:
+                regressions.append(('startup', stage, reference[stage], results['startup'][stage], ratio))
+    for case, measures in results['results'].items():
+        reference = baseline['results'].get(case)
+        if not reference:
+            continue
+        for stage in STAGES + ['peak_rss_mb']:
+            if stage not in measures or not reference.get(stage):
+                continue
+            ratio = measures[stage] / reference[stage]
+            if ratio > 1 + threshold:
+                regressions.append((case, stage, reference[stage], measures[stage], ratio))
+    return regressions
+
+
+def print_table(results, baseline=None):
+    reference = (baseline or {}).get('startup') or {}
+    cells = []
+    for name in STARTUP_STAGES:
+        value = f"{name} {results['startup'][name] * 1000:.1f}ms"
+        if reference.get(name):
+            value += f" ({results['startup'][name] / reference[name]:.2f}x)"
+        cells.append(value)
+    print(f"\n{'démarrage':<24}" + '   '.join(cells))
+    if not results['results']:
+        return
+
+    columns = STAGES + ['peak_rss_mb']
+    print(f"\n{'cas':<24}" + ''.join(f"{name:>20}" for name in columns))
+    for case, measures in results['results'].items():
+        reference = (baseline or {}).get('results', {}).get(case, {})
+        cells = []
+        for name in columns:
+            value = f"{measures[name]:.1f}" if name == 'peak_rss_mb' else f"{measures[name] * 1000:.1f}ms"
+            if reference.get(name):
+                value += f" ({measures[name] / reference[name]:.2f}x)"
+            cells.append(f"{value:>20}")
+        print(f"{case:<24}" + ''.join(cells))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if '--help' in args or '-h' in args:
+        print("""
+Usage: python benchmark.py [options]
+
+Options:
+  --quick             : Grilles de 1° et 0.5° seulement, une exécution par étape
+  --startup           : Mesure seulement le démarrage à froid du backend
+  --data-dir D        : Dossier des fichiers synthétiques (défaut: bench_data)
+  --cell-size S       : Taille des cellules de la carte (défaut: 1.0)
+  --repeat N          : Exécutions par étape, le meilleur temps est gardé (défaut: 3)
+  --output F          : Fichier de résultats JSON (défaut: bench_results.json)
+  --baseline F        : Référence à comparer (défaut: bench_baseline.json si présent)
+  --threshold T       : Ralentissement toléré avant régression (défaut: 0.25)
+  --save-baseline     : Enregistre aussi les résultats comme nouvelle référence
+
+Exemples:
+  python benchmark.py --quick --save-baseline
+  python benchmark.py --quick --threshold 0.5
+        """)
+        sys.exit(0)
+
+    quick = '--quick' in args
+    save_baseline = '--save-baseline' in args
+    startup_only = '--startup' in args
+    args = [arg for arg in args if arg not in ('--quick', '--save-baseline', '--startup')]
+    data_dir = pop_option(args, '--data-dir', 'bench_data')
+    cell_size = float(pop_option(args, '--cell-size', 1.0))
+    repeat = int(pop_option(args, '--repeat', 1 if quick else 3))
+    output_file = pop_option(args, '--output', 'bench_results.json')
+    baseline_file = pop_option(args, '--baseline', 'bench_baseline.json')
+    threshold = float(pop_option(args, '--threshold', 0.25))
+
+    results = run_benchmarks(data_dir, QUICK_RESOLUTIONS if quick else RESOLUTIONS, cell_size, repeat, startup_only)
+    with open(output_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\n💾 Résultats: {output_file}")
+
+    baseline = None
+    if Path(baseline_file).exists():
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+
+    if save_baseline:
+        with open(baseline_file, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\n📌 Nouvelle référence: {baseline_file}")
+    elif baseline:
+        regressions = compare(results, baseline, threshold)
+        if regressions:
+            print(f"\n❌ {len(regressions)} régression(s) au-delà de +{threshold:.0%}:")
+            for case, stage, reference, measure, ratio in regressions:
+                print(f"   {case} / {stage}: {reference:.4g} -> {measure:.4g} ({ratio:.2f}x)")
+            sys.exit(1)
+        print(f"\n✅ Aucune régression au-delà de +{threshold:.0%}")
@@ -0,0 +1,110 @@
+"""
+Classification vectorisée des tuiles en biomes
+
+Reprend le score de calculateBiomeScore (server.js) : pour chaque variable
+climatique présente à la fois dans la tuile et dans le biome, 1 si la
+moyenne est dans l'intervalle [min, max] du biome, sinon
+max(0, 1 - distance / (max - min)). Le score du biome est la moyenne sur
+ces variables (0 si aucune).
+
+Les intervalles de mapping/var_biome_map.json sont chargés en deux
+matrices (biomes, variables) et toutes les tuiles sont évaluées contre
+tous les biomes en une opération NumPy diffusée, par blocs de tuiles.
+"""
+import json
+
+import numpy as np
+
+BIOME_VARIABLES = ('t2m', 'd2m', 'tp', 'ssr', 'sst', 'msl', 'cl', 'u10', 'v10')
+
+# Tuiles évaluées par bloc : borne la matrice (tuiles, biomes, variables)
+BLOCK_SIZE = 65536
+
+
+class BiomeRanges:
+    """
+    Intervalles de variables des biomes sous forme matricielle
+
+    Attributes:
+        names: Noms des biomes, dans l'ordre du fichier
+        variables: Variables climatiques utilisées (BIOME_VARIABLES)
+        mins, maxs: Matrices (biomes, variables), NaN si le biome ne
+                    contraint pas la variable
+    """
+
+    def __init__(self, mapping):
+        self.names = list(mapping)
+        self.variables = BIOME_VARIABLES
+        shape = (len(self.names), len(self.variables))
+        self.mins = np.full(shape, np.nan)
+        self.maxs = np.full(shape, np.nan)
+        for i, name in enumerate(self.names):
+            for j, var in enumerate(self.variables):
+                bounds = mapping[name].get(var)
+                if bounds:
+                    self.mins[i, j] = bounds['min']
+                    self.maxs[i, j] = bounds['max']
+
+    @classmethod
+    def load(cls, path):
+        """Charge var_biome_map.json"""
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def score(self, means):
+        """
+        Score de chaque tuile pour chaque biome
+
+        Args:
+            means: Matrice (tuiles, variables) des moyennes, NaN si la
+                   variable est absente de la tuile
+
+        Returns:
+            np.ndarray: Scores (tuiles, biomes) entre 0 et 1
+        """
+        scores = np.empty((len(means), len(self.names)))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for start in range(0, len(means), BLOCK_SIZE):
+                values = means[start:start + BLOCK_SIZE, None, :]
+                below = (self.mins - values) / (self.maxs - self.mins)
+                above = (values - self.maxs) / (self.maxs - self.mins)
+                inside = (values >= self.mins) & (values <= self.maxs)
+                partial = np.where(inside, 1.0, np.maximum(0, 1 - np.where(values < self.mins, below, above)))
+                # Intervalle vide (min == max) hors de l'intervalle : distance infinie
+                partial = np.nan_to_num(partial, nan=0.0)
+
+                used = ~np.isnan(values) & ~np.isnan(self.mins)
+                total = used.sum(axis=2)
+                block_scores = np.where(used, partial, 0).sum(axis=2)
+                scores[start:start + BLOCK_SIZE] = np.where(total > 0, block_scores / np.maximum(total, 1), 0)
+        return scores
+
+    def classify(self, columns, top_k=3):
+        """
+        Meilleurs biomes de chaque tuile
+
+        Args:
+            columns: Colonnes au format de square_stats.tile_columns
+            top_k: Nombre de biomes conservés par tuile
+
+        Returns:
+            dict: {'names': noms des biomes,
+                   'index': (tuiles, top_k) indices dans names, par score décroissant,
+                   'score': (tuiles, top_k) scores}
+        """
+        count = len(columns['x'])
+        means = np.full((count, len(self.variables)), np.nan)
+        for j, var in enumerate(self.variables):
+            var_columns = columns['variables'].get(var)
+            if var_columns is not None:
+                means[:, j] = np.where(np.asarray(var_columns['count']) > 0, var_columns['mean'], np.nan)
+
+        scores = self.score(means)
+        top_k = min(top_k, len(self.names))
+        # Tri stable : à score égal, l'ordre du fichier est conservé (comme en JS)
+        index = np.argsort(-scores, axis=1, kind='stable')[:, :top_k]
+        return {
+            'names': self.names,
+            'index': index.astype(np.int16),
+            'score': np.take_along_axis(scores, index, axis=1)
+        }
@@ -0,0 +1,128 @@
+"""
+État persistant d'une construction de carte, pour les reconstructions
+incrémentales de generate_square_map.py
+
+Le dossier d'état contient :
+    manifest.json : paramètres de la construction et, par fichier source,
+                    sa taille, sa date de modification et son agrégat
+    partials/     : agrégats partiels par fichier (VarStats en .npz)
+
+Un fichier dont la taille et la date de modification n'ont pas changé
+n'est pas relu : son agrégat est rechargé depuis le dossier d'état. Les
+fichiers disparus sont retirés de l'état. Changer un paramètre de
+construction (taille de cellule, variables...) invalide tout l'état.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from square_stats import load_stats, save_stats
+
+MANIFEST_NAME = 'manifest.json'
+STATE_VERSION = 1
+
+
+def file_signature(file_path):
+    """Signature d'un fichier source : taille et date de modification"""
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class BuildState:
+    """
+    Agrégats partiels des fichiers déjà traités
+
+    Args:
+        state_dir: Dossier de l'état
+        params: Paramètres de la construction (dict sérialisable en JSON)
+    """
+
+    def __init__(self, state_dir, params):
+        self.state_dir = Path(state_dir)
+        self.partials_dir = self.state_dir / 'partials'
+        self.params = json.loads(json.dumps(params))
+        self.files = {}
+
+        manifest_path = self.state_dir / MANIFEST_NAME
+        if manifest_path.exists():
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == STATE_VERSION and manifest.get('params') == self.params:
+                self.files = manifest['files']
+            else:
+                for path in self.partials_dir.glob('*.npz'):
+                    path.unlink()
+
+    def _partial_path(self, file_path):
+        name = hashlib.sha1(str(Path(file_path).resolve()).encode('utf-8')).hexdigest()
+        return self.partials_dir / f"{name}.npz"
+
+    def plan(self, files):
+        """
+        Répartit les fichiers entre ceux à relire et ceux à recharger
+
+        Returns:
+            tuple: (fichiers à traiter, fichiers inchangés, fichiers retirés)
+        """
+        wanted = {str(Path(f).resolve()): f for f in files}
+        changed, unchanged = [], []
+        for key, file_path in wanted.items():
+            entry = self.files.get(key)
+            if entry and entry['signature'] == file_signature(file_path) and self._partial_path(key).exists():
+                unchanged.append(file_path)
+            else:
+                changed.append(file_path)
+        removed = [key for key in self.files if key not in wanted]
+        return changed, unchanged, removed
+
+    def signatures(self, files):
+        """
+        Signatures des fichiers à traiter, à prendre avant leur traitement
+
+        Returns:
+            dict: {fichier: signature}, None pour un fichier illisible
+        """
+        signatures = {}
+        for file_path in files:
+            try:
+                signatures[file_path] = file_signature(file_path)
+            except OSError:
+                signatures[file_path] = None
+        return signatures
+
+    def load(self, file_path):
+        """Recharge l'agrégat d'un fichier inchangé"""
+        return load_stats(self._partial_path(Path(file_path).resolve()))
+
+    def store(self, file_path, file_data, signature):
+        """
+        Enregistre l'agrégat d'un fichier qui vient d'être traité
+
+        Args:
+            signature: Signature du fichier prise avant son traitement (voir
+                       file_signature) : un fichier modifié pendant le
+                       traitement ne correspond plus et sera relu
+        """
+        key = str(Path(file_path).resolve())
+        self.partials_dir.mkdir(parents=True, exist_ok=True)
+        path = self._partial_path(key)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            save_stats(f, file_data)
+        os.replace(tmp_path, path)
+        self.files[key] = {'signature': signature, 'variables': sorted(file_data)}
+
+    def remove(self, key):
+        """Retire un fichier source disparu de l'état"""
+        self.files.pop(key, None)
+        self._partial_path(key).unlink(missing_ok=True)
+
+    def save(self):
+        """Écrit le manifeste (atomiquement)"""
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        manifest_path = self.state_dir / MANIFEST_NAME
+        tmp_path = manifest_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': STATE_VERSION, 'params': self.params, 'files': self.files}, f, indent=2)
+        os.replace(tmp_path, manifest_path)
@@ -1,27 +1,28 @@
 import xarray as xr
 import numpy as np
 import json
+import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
 from pathlib import Path
 from glob import glob
 
-def latlon_to_square(lat, lon, size):
-    """
-    Convertit des coordonnées lat/lon en coordonnées de grille carrée
-    
-    Args:
-        lat: Latitude
-        lon: Longitude
-        size: Taille de la cellule en degrés
-    
-    Returns:
-        str: Coordonnées de la cellule "x,y"
-    """
-    x = int(np.floor(lon / size))
-    y = int(np.floor(lat / size))
-    return f"{x},{y}"
+from biomes import BiomeRanges
+from build_state import BuildState
+from map_format import pyramid_path, write_binary_map
+from map_store import MapStore
+from metrics import METRICS, run_with_metrics, stage
+from netcdf_catalog import NetCDFCatalog
+from netcdf_io import find_lat_lon, parse_bbox, parse_time_range, subset_dataset
+from spill_store import ColumnSpool, SpillStore
+from square_stats import (HISTOGRAM_BINS, GridAccumulator, SeriesAccumulator, build_tiles, histogram_edges,
+                          iter_tiles, merge_stats_dicts, parse_histograms, tile_columns, tiles_from_columns,
+                          time_labels, tree_reduce)
 
-def process_single_file(file_path, cell_size, variables=None, time_aggregation='first'):
+def process_single_file(file_path, cell_size, variables=None, time_aggregation='first', chunk_size=None,
+                        bbox=None, time_range=None, series_freq='step', histograms=None):
     """
     Traite un seul fichier NetCDF
     
@@ -29,26 +30,41 @@ def process_single_file(file_path, cell_size, variables=None, time_aggregation='
         file_path: Chemin vers le fichier .nc
         cell_size: Taille des cellules en degrés
         variables: Liste des variables à extraire (None = toutes)
-        time_aggregation: 'first', 'mean', 'all'
+        time_aggregation: 'first', 'mean', 'all', 'series'
+        chunk_size: Lignes de latitude lues par bloc (None = variable entière)
+        bbox: (lat_min, lat_max, lon_min, lon_max) à lire, None = tout
+        time_range: (début, fin) à lire, None = toutes les périodes
+        series_freq: Périodes de la série en mode 'series' : 'step',
+                     'month', 'season' ou 'rolling:N' (calculé par pas)
+        histograms: {variable: [min, max, classes]} des variables dont on
+                    garde un histogramme par cellule (voir
+                    square_stats.parse_histograms)
     
     Returns:
-        dict: {variable: {square_coord: [values]}}
+        dict: {variable: VarStats}, SeriesVarStats en mode 'series'
     """
     print(f"\n📂 Lecture de {Path(file_path).name}...")
-    ds = xr.open_dataset(file_path)
+    with stage('dataset_open'):
+        ds = xr.open_dataset(file_path)
     
     # Détecter les coordonnées
-    lat_names = ['lat', 'latitude', 'y']
-    lon_names = ['lon', 'longitude', 'x']
-    
-    lat_var = next((name for name in lat_names if name in ds.coords), None)
-    lon_var = next((name for name in lon_names if name in ds.coords), None)
+    lat_var, lon_var = find_lat_lon(ds)
     
     if not lat_var or not lon_var:
         raise ValueError(f"❌ Coordonnées non trouvées dans {file_path}. Disponibles: {list(ds.coords.keys())}")
     
     print(f"   ✅ Coordonnées: {lat_var}, {lon_var}")
     
+    # Restreindre la lecture à la zone / période demandée
+    if bbox or time_range:
+        try:
+            ds = subset_dataset(ds, lat_var, lon_var, bbox, time_range)
+        except ValueError as e:
+            print(f"   ⚠️  {e}")
+            ds.close()
+            return {}
+        print(f"   ✂️  Sous-ensemble: {dict(ds.sizes)}")
+    
     # Sélectionner les variables
     if variables is None:
         variables = [var for var in ds.data_vars if len(ds[var].dims) >= 2]
@@ -67,89 +83,144 @@ def process_single_file(file_path, cell_size, variables=None, time_aggregation='
     lats = ds[lat_var].values
     lons = ds[lon_var].values
     
-    total_points = len(lats) * len(lons)
-    
     # Traiter chaque variable
     for var in variables:
         print(f"   🔄 Traitement de {var}...")
-        data = ds[var].values
+        field = ds[var]
+        edges = histogram_edges((histograms or {}).get(var))
         
         # Gérer les dimensions temporelles
-        if len(data.shape) > 2:
+        if len(field.dims) > 2:
+            periods = field.shape[0]
             if time_aggregation == 'mean':
-                print(f"      Moyenne temporelle ({data.shape[0]} périodes)")
-                data = np.mean(data, axis=0)
+                print(f"      Moyenne temporelle ({periods} périodes)")
             elif time_aggregation == 'first':
-                print(f"      Première période ({data.shape[0]} disponibles)")
-                data = data[0]
+                print(f"      Première période ({periods} disponibles)")
+                field = field.isel({dim: 0 for dim in field.dims[:-2]})
             elif time_aggregation == 'all':
-                print(f"      Conservation de toutes les périodes ({data.shape[0]})")
-                # On garde la structure 3D
-                pass
-        
-        file_data[var] = {}
-        processed = 0
+                print(f"      Conservation de toutes les périodes ({periods})")
         
-        # Cas 2D (ou déjà agrégé)
-        if len(data.shape) == 2:
-            for i in range(len(lats)):
-                for j in range(len(lons)):
-                    lat = float(lats[i])
-                    lon = float(lons[j])
-                    square_coord = latlon_to_square(lat, lon, cell_size)
-                    
-                    if square_coord not in file_data[var]:
-                        file_data[var][square_coord] = []
-                    
-                    value = data[i, j]
-                    if not np.isnan(value):
-                        file_data[var][square_coord].append({
-                            'value': float(value),
-                            'lat': lat,
-                            'lon': lon
-                        })
-                    
-                    processed += 1
-                    if processed % 100000 == 0:
-                        print(f"      {processed}/{total_points} ({processed*100//total_points}%)")
+        if time_aggregation == 'series' and len(field.dims) > 2:
+            time_dim = field.dims[0]
+            times = ds[time_dim].values if time_dim in ds.coords else np.arange(periods)
+            labels = time_labels(times, 'step' if series_freq.startswith('rolling') else series_freq)
+            print(f"      Série temporelle ({periods} périodes, {len(np.unique(labels))} pas '{series_freq}')")
+            with stage('binning'):
+                accumulator = SeriesAccumulator(lats, lons, cell_size, labels, edges)
+        else:
+            with stage('binning'):
+                accumulator = GridAccumulator(lats, lons, cell_size, edges)
+        last_start = None
+        for lat_start, block in iter_blocks(field, time_aggregation, chunk_size):
+            with stage('variable_read'):
+                values = block.values
+            with stage('reduction'):
+                accumulator.add(values, lat_start)
+            if chunk_size and lat_start != last_start:
+                last_start = lat_start
+                print(f"      Lignes {lat_start}/{len(lats)} ({lat_start*100//len(lats)}%)")
         
-        # Cas 3D (toutes les périodes)
-        elif len(data.shape) == 3:
-            for t in range(data.shape[0]):
-                for i in range(len(lats)):
-                    for j in range(len(lons)):
-                        lat = float(lats[i])
-                        lon = float(lons[j])
-                        square_coord = latlon_to_square(lat, lon, cell_size)
-                        
-                        if square_coord not in file_data[var]:
-                            file_data[var][square_coord] = []
-                        
-                        value = data[t, i, j]
-                        if not np.isnan(value):
-                            file_data[var][square_coord].append({
-                                'value': float(value),
-                                'lat': lat,
-                                'lon': lon,
-                                'time': t
-                            })
+        with stage('reduction'):
+            file_data[var] = accumulator.result()
     
     ds.close()
     return file_data
 
-def merge_file_data(all_files_data):
+def iter_blocks(field, time_aggregation='first', chunk_size=None):
     """
-    Fusionne les données de plusieurs fichiers
+    Découpe une variable en blocs de lignes de latitude (lecture paresseuse)
+    
+    Seule la tranche demandée est lue depuis le fichier à chaque bloc. En
+    mode 'all', chaque période est en plus lue séparément ; en mode
+    'series', chaque bloc garde toutes les périodes.
+    
+    Args:
+        field: DataArray dont les deux derniers axes sont lat, lon
+        time_aggregation: 'first', 'mean', 'all', 'series'
+        chunk_size: Nombre de lignes de latitude par bloc (None = tout)
+    
+    Yields:
+        (indice de la première ligne, bloc)
+    """
+    lat_dim = field.dims[-2]
+    n_lats = field.sizes[lat_dim]
+    rows = chunk_size or n_lats
+    
+    for lat_start in range(0, n_lats, rows):
+        block = field.isel({lat_dim: slice(lat_start, lat_start + rows)})
+        if len(block.dims) > 2 and time_aggregation == 'mean':
+            yield lat_start, block.mean(dim=block.dims[0], skipna=False)
+        elif len(block.dims) > 2 and chunk_size and time_aggregation != 'series':
+            for t in range(block.shape[0]):
+                yield lat_start, block.isel({block.dims[0]: t})
+        else:
+            yield lat_start, block
+
+def iter_file_results(files, cell_size, variables=None, time_aggregation='first', chunk_size=None, workers=None,
+                      bbox=None, time_range=None, series_freq='step', histograms=None, file_variables=None):
+    """
+    Traite une liste de fichiers, en parallèle si plusieurs processus
+    
+    Chaque processus ne renvoie que ses agrégats partiels par cellule, pas
+    les valeurs brutes : le coût du transfert dépend du nombre de cellules.
+    file_variables ({fichier: variables}, voir NetCDFCatalog.select)
+    remplace variables pour les fichiers qu'il liste.
+    
+    Yields:
+        (fichier, {variable: VarStats}) pour chaque fichier traité sans
+        erreur, dans l'ordre où ils se terminent
+    """
+    if not files:
+        return
+    workers = min(workers or os.cpu_count() or 1, len(files))
+    
+    def collect(file_path, get_result):
+        try:
+            return get_result()
+        except Exception as e:
+            print(f"   ⚠️  Erreur avec {file_path}: {e}")
+            return None
+    
+    def worker_result(future):
+        # Les mesures des workers sont ajoutées à celles du processus principal
+        file_data, snapshot = future.result()
+        METRICS.merge(snapshot)
+        return file_data
+    
+    def variables_of(f):
+        return file_variables[f] if file_variables and f in file_variables else variables
+    
+    if workers <= 1:
+        for f in files:
+            file_data = collect(f, lambda: process_single_file(f, cell_size, variables_of(f), time_aggregation,
+                                                               chunk_size, bbox, time_range, series_freq, histograms))
+            if file_data is not None:
+                yield f, file_data
+            # Ne pas garder l'agrégat du fichier précédent pendant le suivant
+            del file_data
+    else:
+        print(f"\n⚙️  Traitement parallèle sur {workers} processus")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run_with_metrics, process_single_file, f, cell_size, variables_of(f),
+                                       time_aggregation, chunk_size, bbox, time_range, series_freq, histograms): f
+                       for f in files}
+            for future in as_completed(futures):
+                file_data = collect(futures[future], lambda: worker_result(future))
+                if file_data is not None:
+                    yield futures[future], file_data
+
+def merge_file_stats(all_files_data):
+    """
+    Fusionne les agrégats partiels de plusieurs fichiers
     
     Args:
-        all_files_data: Liste de dict {variable: {square_coord: [values]}}
+        all_files_data: Liste de dict {variable: VarStats}
     
     Returns:
-        dict: square_grid fusionné
+        dict: {variable: VarStats} fusionné, variables triées
     """
     print("\n🔀 Fusion des données de tous les fichiers...")
     
-    square_grid = {}
     all_variables = set()
     
     # Collecter toutes les variables
@@ -158,73 +229,87 @@ def merge_file_data(all_files_data):
     
     print(f"   Variables totales: {sorted(all_variables)}")
     
-    # Fusionner les données par cellule
-    for file_data in all_files_data:
-        for var, square_data in file_data.items():
-            for square_coord, values in square_data.items():
-                if square_coord not in square_grid:
-                    square_grid[square_coord] = {
-                        'count': 0,
-                        'lat': 0,
-                        'lon': 0
-                    }
-                
-                if var not in square_grid[square_coord]:
-                    square_grid[square_coord][var] = []
-                
-                square_grid[square_coord][var].extend(values)
-    
-    # Calculer les moyennes
+    # Fusionner les agrégats partiels (réduction en arbre, O(cellules))
+    with stage('merge'):
+        merged = tree_reduce(all_files_data, merge_stats_dicts)
+    return {var: merged[var] for var in sorted(merged)}
+
+def merge_file_data(all_files_data):
+    """
+    Fusionne les données de plusieurs fichiers
+    
+    Args:
+        all_files_data: Liste de dict {variable: VarStats}
+    
+    Returns:
+        dict: square_grid fusionné
+    """
+    merged = merge_file_stats(all_files_data)
+    
+    # Calculer les statistiques
     print("   📈 Calcul des statistiques...")
-    for coord in list(square_grid.keys()):
-        tile = square_grid[coord]
-        
-        # Calculer lat/lon moyen
-        all_lats = []
-        all_lons = []
-        
-        for var in all_variables:
-            if var in tile and isinstance(tile[var], list):
-                for item in tile[var]:
-                    all_lats.append(item['lat'])
-                    all_lons.append(item['lon'])
-        
-        if all_lats:
-            tile['lat'] = float(np.mean(all_lats))
-            tile['lon'] = float(np.mean(all_lons))
-            tile['count'] = len(all_lats)
-        else:
-            del square_grid[coord]
-            continue
-        
-        # Calculer les statistiques pour chaque variable
-        for var in all_variables:
-            if var in tile and isinstance(tile[var], list):
-                values = [item['value'] for item in tile[var]]
-                if values:
-                    tile[var] = {
-                        'mean': float(np.mean(values)),
-                        'min': float(np.min(values)),
-                        'max': float(np.max(values)),
-                        'std': float(np.std(values)),
-                        'count': len(values)
-                    }
-                else:
-                    tile[var] = None
-    
-    return square_grid
+    with stage('tile_build'):
+        return build_tiles(merged, include_var_count=True, empty_value=None)
 
-def process_multiple_netcdf(input_pattern, output_file, cell_size=1.0, variables=None, time_aggregation='first'):
+def process_multiple_netcdf(input_pattern, output_file, cell_size=1.0, variables=None, time_aggregation='first',
+                            chunk_size=None, workers=None, output_format='json', bbox=None, time_range=None,
+                            pyramid_levels=0, state_dir=None, series_freq='step', biome_map=None, biome_top_k=3,
+                            store_dir=None, histograms=None, spill_dir=None, diff_tolerance=0.0,
+                            catalog_file=None):
     """
     Traite plusieurs fichiers NetCDF et les fusionne en une grille carrée
     
     Args:
         input_pattern: Pattern glob ou liste de fichiers (ex: "*.nc" ou "file1.nc,file2.nc")
-        output_file: Chemin vers le fichier JSON de sortie
+        output_file: Chemin vers le fichier de sortie
         cell_size: Taille des cellules en degrés
         variables: Liste des variables à extraire (None = toutes)
-        time_aggregation: 'first', 'mean', 'all'
+        time_aggregation: 'first', 'mean', 'all', 'series' ('all' + série
+                          temporelle par cellule)
+        chunk_size: Lignes de latitude lues par bloc (None = variable entière)
+        workers: Nombre de processus (None = nombre de cœurs, 1 = séquentiel)
+        output_format: 'json' (game_map.json) ou 'binary' (voir map_format.py)
+        bbox: (lat_min, lat_max, lon_min, lon_max) à lire, None = tout
+        time_range: (début, fin) à lire, None = toutes les périodes
+        pyramid_levels: Nombre de niveaux grossiers (x2, x4, ...) à écrire en
+                        plus de la carte, voir map_format.pyramid_path
+        state_dir: Dossier d'état pour la reconstruction incrémentale (voir
+                   build_state.py), None = tout retraiter
+        series_freq: Périodes de la série en mode 'series' : 'step' (chaque
+                     pas de temps), 'month', 'season' ou 'rolling:N'
+                     (moyenne glissante sur N pas)
+        biome_map: Chemin de var_biome_map.json pour classer chaque tuile en
+                   biomes (voir biomes.py), None = pas de classification
+        biome_top_k: Nombre de biomes (les mieux notés) écrits par tuile
+        store_dir: Magasin de cartes (voir map_store.py) où publier aussi
+                   tous les niveaux, None = pas de publication
+        histograms: {variable: [min, max, classes]} : histogramme par
+                    cellule et percentiles p10/p50/p90 de ces variables
+                    (voir square_stats.parse_histograms)
+        spill_dir: Dossier où accumuler les agrégats hors mémoire (voir
+                   spill_store.py), pour les tailles de cellule très fines ;
+                   None = tout en mémoire
+        diff_tolerance: Écart relatif toléré par les diffs publiés dans
+                        store_dir depuis la version précédente (voir
+                        map_diff.py), 0 = toute différence
+        catalog_file: Catalogue des métadonnées des fichiers (voir
+                      netcdf_catalog.py), None = pas de catalogue
+    
+    Returns:
+        dict: {'metadata', 'tiles'} en JSON, {'metadata', 'columns'} en
+              binaire ou avec spill_dir
     """
+    if output_format not in ('json', 'binary'):
+        raise ValueError(f"❌ Format de sortie inconnu: {output_format}")
+    rolling_window = parse_series_freq(series_freq) if time_aggregation == 'series' else None
+    biome_ranges = BiomeRanges.load(biome_map) if biome_map else None
+    
+    def classify(columns):
+        if biome_ranges:
+            with stage('classification'):
+                columns['biomes'] = biome_ranges.classify(columns, biome_top_k)
+        return columns
+    
     print("=" * 70)
     print("🗺️  GÉNÉRATEUR DE CARTE EN GRILLE CARRÉE MULTI-FICHIERS NetCDF")
     print("=" * 70)
@@ -244,57 +329,314 @@ def process_multiple_netcdf(input_pattern, output_file, cell_size=1.0, variables
     for f in files:
         print(f"   • {Path(f).name}")
     
-    # Traiter chaque fichier
-    all_files_data = []
-    for file_path in files:
+    # Catalogue : seuls les fichiers nouveaux ou modifiés sont rouverts pour
+    # leurs métadonnées, et les fichiers sans donnée utile ne sont pas lus
+    file_variables = None
+    if catalog_file:
+        catalog = NetCDFCatalog(catalog_file)
+        scanned = catalog.refresh(files, workers)
+        file_variables, skipped = catalog.select(files, variables, bbox, time_range)
+        catalog.prune()
         try:
-            file_data = process_single_file(file_path, cell_size, variables, time_aggregation)
-            if file_data:
-                all_files_data.append(file_data)
-        except Exception as e:
-            print(f"   ⚠️  Erreur avec {file_path}: {e}")
-            continue
-    
-    if not all_files_data:
-        raise ValueError("❌ Aucun fichier n'a pu être traité avec succès")
-    
-    # Fusionner toutes les données
-    square_grid = merge_file_data(all_files_data)
-    
-    # Créer la structure de sortie
-    output_data = {
-        'metadata': {
+            catalog.save()
+        except OSError as e:
+            print(f"   ⚠️  Catalogue non enregistré ({catalog.path}): {e}")
+        print(f"\n🗂️  Catalogue {catalog.path}: {len(scanned)} fichier(s) scanné(s), {len(skipped)} écarté(s)")
+        for f, reason in skipped.items():
+            print(f"   • {Path(f).name}: {reason}")
+        files = [f for f in files if f in file_variables]
+        if not files:
+            raise ValueError("❌ Aucun fichier ne contient les variables, la zone ou la période demandées")
+    
+    # Reconstruction incrémentale : seuls les fichiers nouveaux ou modifiés sont relus
+    state = None
+    to_process, unchanged = files, []
+    if state_dir:
+        params = {
+            'cell_size': cell_size,
+            'variables': variables,
+            'time_aggregation': time_aggregation,
+            'bbox': bbox,
+            'time_range': time_range
+        }
+        if time_aggregation == 'series':
+            # La fenêtre glissante est appliquée après fusion, les agrégats restent par pas
+            params['series_freq'] = 'step' if rolling_window else series_freq
+        if histograms:
+            params['histograms'] = histograms
+        state = BuildState(state_dir, params)
+        to_process, unchanged, removed = state.plan(files)
+        # Avant traitement : un fichier modifié pendant la construction sera relu
+        signatures = state.signatures(to_process)
+        for key in removed:
+            state.remove(key)
+        print(f"\n♻️  État {state_dir}: {len(to_process)} à traiter, "
+              f"{len(unchanged)} inchangé(s), {len(removed)} retiré(s)")
+    
+    # Traiter chaque fichier (un processus par fichier)
+    file_results = iter_file_results(to_process, cell_size, variables, time_aggregation, chunk_size, workers,
+                                     bbox, time_range, series_freq, histograms, file_variables)
+    spill = SpillStore(Path(spill_dir) / f".build-{os.getpid()}-{time.time_ns()}") if spill_dir else None
+    with spill or nullcontext():
+        if spill:
+            # Hors mémoire : chaque fichier est déversé sur disque dès qu'il est traité
+            print(f"\n💽 Agrégats accumulés sur disque dans {spill.root}")
+            for file_path, file_data in file_results:
+                if state:
+                    state.store(file_path, file_data, signatures[file_path])
+                spill.add(file_data)
+                del file_data
+            for file_path in unchanged:
+                spill.add(state.load(file_path))
+            if state:
+                state.save()
+            if not spill.runs:
+                raise ValueError("❌ Aucun fichier n'a pu être traité avec succès")
+            variable_names = spill.variables
+            print(f"   Variables totales: {variable_names}")
+            levels = spilled_levels(spill, pyramid_levels, rolling_window, classify)
+        else:
+            results = dict(file_results)
+            if state:
+                for file_path, file_data in results.items():
+                    state.store(file_path, file_data, signatures[file_path])
+                for file_path in unchanged:
+                    results[file_path] = state.load(file_path)
+                state.save()
+            
+            all_files_data = [results[f] for f in files if results.get(f)]
+            
+            if not all_files_data:
+                raise ValueError("❌ Aucun fichier n'a pu être traité avec succès")
+            
+            # Fusionner toutes les données
+            merged = merge_file_stats(all_files_data)
+            if rolling_window:
+                print(f"   📉 Moyenne glissante sur {rolling_window} pas")
+                with stage('merge'):
+                    merged = {var: stats.rolling(rolling_window) if hasattr(stats, 'rolling') else stats
+                              for var, stats in merged.items()}
+            variable_names = list(merged)
+            levels = stats_levels(merged, pyramid_levels, classify)
+        
+        if biome_ranges:
+            print(f"   🌍 Classification en {len(biome_ranges.names)} biomes (top {biome_top_k})")
+        columns = next(levels)
+        tile_count = len(columns['x'])
+        
+        # Créer la structure de sortie
+        metadata = {
             'source_files': [str(Path(f).name) for f in files],
             'cell_size': cell_size,
-            'tile_count': len(square_grid),
+            'tile_count': tile_count,
             'time_aggregation': time_aggregation,
-            'variables': sorted(set(var for file_data in all_files_data for var in file_data.keys())),
+            'variables': variable_names,
             'grid_type': 'square'
-        },
-        'tiles': square_grid
-    }
-    
-    # Sauvegarder en JSON
-    print(f"\n💾 Sauvegarde vers {output_file}...")
-    with open(output_file, 'w') as f:
-        json.dump(output_data, f, indent=2)
+        }
+        if bbox:
+            metadata['bbox'] = list(bbox)
+        if time_range:
+            metadata['time_range'] = list(time_range)
+        if time_aggregation == 'series':
+            metadata['series_freq'] = series_freq
+            metadata['series_labels'] = columns['series_labels']
+        if columns['histogram_edges']:
+            metadata['histogram_edges'] = columns['histogram_edges']
+        if biome_ranges:
+            metadata['biomes'] = {
+                'names': biome_ranges.names,
+                'top_k': int(columns['biomes']['index'].shape[1]),
+                'source': Path(biome_map).name
+            }
+        
+        store = MapStore(store_dir, diff_tolerance=diff_tolerance) if store_dir else None
+        with store.publish() if store else nullcontext() as publication:
+            output_data = write_map(metadata, columns, output_file, output_format, stream=spill is not None)
+            if publication:
+                publication.add_level(metadata, columns)
+            
+            # Niveaux plus grossiers : fusion des agrégats des cellules enfants
+            for level, level_columns in enumerate(levels, 1):
+                level_metadata = {
+                    **metadata,
+                    'cell_size': cell_size * 2 ** level,
+                    'tile_count': len(level_columns['x']),
+                    'pyramid_level': level
+                }
+                write_map(level_metadata, level_columns, pyramid_path(output_file, level), output_format,
+                          stream=spill is not None)
+                if publication:
+                    publication.add_level(level_metadata, level_columns)
+                print(f"   🔺 Niveau {level}: {level_metadata['tile_count']} cellules de {level_metadata['cell_size']}°")
+        if publication:
+            print(f"   📌 Version {publication.name} publiée dans {store_dir}")
+            if publication.diffs:
+                diff = publication.diffs[0]
+                print(f"   🧩 Diff depuis {diff['base_version']}: {diff['added']} tuiles ajoutées, "
+                      f"{diff['changed']} modifiées, {len(diff['removed'])} supprimées")
     
     file_size = Path(output_file).stat().st_size / 1024 / 1024
     
     print("\n" + "=" * 70)
     print("✅ TERMINÉ !")
     print("=" * 70)
-    print(f"🎯 Cellules générées: {len(square_grid)}")
+    print(f"🎯 Cellules générées: {tile_count}")
     print(f"📦 Taille du fichier: {file_size:.2f} MB")
     print(f"📊 Variables: {', '.join(output_data['metadata']['variables'])}")
     print("=" * 70)
     
     return output_data
 
+def stats_levels(merged, pyramid_levels=0, classify=None):
+    """
+    Colonnes de la carte puis de chaque niveau de pyramide, depuis les
+    agrégats fusionnés en mémoire
+    
+    Yields:
+        dict: Colonnes (voir square_stats.tile_columns) du niveau 0, 1, ...
+    """
+    print("   📈 Calcul des statistiques...")
+    for level in range(pyramid_levels + 1):
+        if level:
+            with stage('merge'):
+                merged = {var: stats.coarsen(2) for var, stats in merged.items()}
+        with stage('tile_build'):
+            columns = tile_columns(merged)
+        yield classify(columns) if classify else columns
+
+def spilled_levels(spill, pyramid_levels=0, rolling_window=None, classify=None):
+    """
+    Colonnes de la carte et de chaque niveau de pyramide, calculées tranche
+    par tranche depuis un SpillStore
+    
+    Tous les niveaux sont calculés en un seul passage sur les tranches et
+    écrits sur disque (ColumnSpool) : la mémoire dépend de la taille d'une
+    tranche, pas de la résolution.
+    
+    Yields:
+        dict: Colonnes en mémoire mappée du niveau 0, 1, ...
+    """
+    spools = [ColumnSpool(spill.root / f"columns_{level}") for level in range(pyramid_levels + 1)]
+    print("   📈 Calcul des statistiques par tranches...")
+    for chunk in spill.chunks(align=2 ** pyramid_levels):
+        if rolling_window:
+            with stage('merge'):
+                chunk = {var: stats.rolling(rolling_window) if hasattr(stats, 'rolling') else stats
+                         for var, stats in chunk.items()}
+        for level, spool in enumerate(spools):
+            if level:
+                with stage('merge'):
+                    chunk = {var: stats.coarsen(2) for var, stats in chunk.items()}
+            with stage('tile_build'):
+                columns = tile_columns(chunk)
+            spool.append(classify(columns) if classify else columns)
+    for spool in spools:
+        yield spool.columns()
+
+def write_map(metadata, columns, output_file, output_format='json', stream=False):
+    """
+    Écrit une carte au format JSON ou binaire
+    
+    Args:
+        stream: En JSON, écrit les tuiles par paquets sans construire le
+                dictionnaire complet (même fichier) ; le résultat contient
+                alors les colonnes au lieu des tuiles
+    
+    Returns:
+        dict: {'metadata', 'tiles'} en JSON, {'metadata', 'columns'} en
+              binaire ou en flux
+    """
+    print(f"\n💾 Sauvegarde vers {output_file}...")
+    if output_format == 'binary':
+        with stage('serialization'):
+            write_binary_map(metadata, columns, output_file)
+        return {'metadata': metadata, 'columns': columns}
+    
+    if stream:
+        with stage('serialization'), open(output_file, 'w') as f:
+            write_json_stream(metadata, columns, f)
+        return {'metadata': metadata, 'columns': columns}
+    
+    with stage('tile_build'):
+        output_data = {
+            'metadata': metadata,
+            'tiles': tiles_from_columns(columns, include_var_count=True, empty_value=None)
+        }
+    with stage('serialization'), open(output_file, 'w') as f:
+        json.dump(output_data, f, indent=2)
+    return output_data
+
+def write_json_stream(metadata, columns, f):
+    """
+    Écrit game_map.json par paquets de tuiles (voir square_stats.iter_tiles)
+    
+    Le texte produit est celui de json.dump({'metadata', 'tiles'}, indent=2).
+    """
+    f.write('{\n  "metadata": ' + json.dumps(metadata, indent=2).replace('\n', '\n  ') + ',\n  "tiles": {')
+    empty = True
+    for tiles in iter_tiles(columns, include_var_count=True, empty_value=None):
+        if not tiles:
+            continue
+        # Contenu de l'objet sans ses accolades, indenté d'un niveau de plus
+        body = json.dumps(tiles, indent=2)[2:-2]
+        f.write(('\n' if empty else ',\n') + '  ' + body.replace('\n', '\n  '))
+        empty = False
+    f.write('}\n}' if empty else '\n  }\n}')
+
+def parse_series_freq(series_freq):
+    """
+    Vérifie une fréquence de série
+    
+    Returns:
+        int: Taille de la fenêtre pour 'rolling:N', None sinon
+    """
+    if series_freq in ('step', 'month', 'season'):
+        return None
+    name, _, window = series_freq.partition(':')
+    if name != 'rolling' or not window.isdigit() or int(window) < 1:
+        raise ValueError(f"❌ Fréquence de série inconnue: {series_freq} (step, month, season, rolling:N)")
+    return int(window)
+
+def pop_option(args, name, default=None):
+    """
+    Retire une option "--name valeur" de la liste d'arguments
+    
+    Returns:
+        str: Valeur de l'option, ou default si absente
+    """
+    if name not in args:
+        return default
+    index = args.index(name)
+    if index + 1 >= len(args):
+        raise ValueError(f"❌ Valeur manquante pour {name}")
+    value = args[index + 1]
+    del args[index:index + 2]
+    return value
+
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print("""
-Usage: python generate_square_map.py <input_pattern> <output.json> [cell_size] [variables] [time_agg]
+    args = sys.argv[1:]
+    profile = '--profile' in args
+    if profile:
+        args.remove('--profile')
+    chunk_size = pop_option(args, '--chunk-size')
+    workers = pop_option(args, '--workers')
+    output_format = pop_option(args, '--format', 'json')
+    bbox = parse_bbox(pop_option(args, '--bbox'))
+    time_range = parse_time_range(pop_option(args, '--time-range'))
+    pyramid_levels = int(pop_option(args, '--pyramid', 0))
+    state_dir = pop_option(args, '--state-dir')
+    series_freq = pop_option(args, '--series-freq', 'step')
+    biome_map = pop_option(args, '--biomes')
+    biome_top_k = int(pop_option(args, '--biome-top', 3))
+    store_dir = pop_option(args, '--store')
+    histograms = parse_histograms(pop_option(args, '--histogram'), int(pop_option(args, '--histogram-bins', HISTOGRAM_BINS)))
+    spill_dir = pop_option(args, '--spill')
+    diff_tolerance = float(pop_option(args, '--diff-tolerance', 0.0))
+    catalog_file = pop_option(args, '--catalog')
+    
+    if len(args) < 2:
+        print(f"""
+Usage: python generate_square_map.py <input_pattern> <output.json> [cell_size] [variables] [time_agg] [options]
 
 Arguments:
   input_pattern : Pattern glob ou liste de fichiers séparés par des virgules
@@ -302,15 +644,74 @@ Arguments:
                            "data/*.nc"
                            "file1.nc,file2.nc,file3.nc"
   
-  output.json   : Fichier de sortie JSON
+  output.json   : Fichier de sortie (JSON, ou binaire avec --format binary)
   
   cell_size     : Taille des cellules carrées en degrés (défaut: 1.0)
   
   variables     : Variables à extraire, séparées par des virgules
                   (défaut: toutes les variables)
   
-  time_agg      : Agrégation temporelle: 'first', 'mean', 'all'
-                  (défaut: 'first')
+  time_agg      : Agrégation temporelle: 'first', 'mean', 'all', 'series'
+                  (défaut: 'first') ; 'series' calcule les mêmes
+                  statistiques que 'all' et ajoute à chaque cellule la
+                  moyenne de chaque période ('series')
+
+Options:
+  --chunk-size N : Lit chaque variable par blocs de N lignes de latitude
+                   (et une période à la fois en mode 'all') ; la mémoire
+                   dépend alors de N et du nombre de cellules, pas du
+                   nombre de pixels
+  --workers N    : Nombre de processus pour traiter les fichiers en
+                   parallèle (défaut: nombre de cœurs, 1 = séquentiel)
+  --format F     : Format de sortie: 'json' ou 'binary' (défaut: 'json')
+                   Le format binaire est colonnaire et mappable en
+                   mémoire (voir map_format.py pour le chargeur et la
+                   conversion JSON <-> binaire)
+  --bbox B       : Zone à lire "lat_min,lat_max,lon_min,lon_max" en degrés
+                   (longitudes -180/180 ou 0/360, quel que soit le fichier)
+  --time-range T : Périodes à lire "début,fin" (ex: "2024-06-01,2024-08-31",
+                   une borne peut être vide)
+  --pyramid N    : Écrit aussi N niveaux plus grossiers (cellules x2, x4,
+                   x8...) calculés depuis les agrégats, sans relire les
+                   données : map_z1.json, map_z2.json...
+  --state-dir D  : Conserve les agrégats par fichier dans D ; les
+                   exécutions suivantes ne relisent que les fichiers
+                   nouveaux ou modifiés et oublient les fichiers retirés
+  --series-freq F: Périodes de la série en mode 'series' : 'step' (chaque
+                   pas de temps, défaut), 'month', 'season' (DJF, MAM,
+                   JJA, SON) ou 'rolling:N' (moyenne glissante sur N pas)
+  --biomes F     : Classe chaque tuile en biomes d'après F
+                   (mapping/var_biome_map.json) : les --biome-top
+                   meilleurs biomes et leurs scores sont écrits dans
+                   'biomes' de chaque tuile, pour que server.js n'ait
+                   plus à les calculer
+  --biome-top K  : Nombre de biomes écrits par tuile (défaut: 3)
+  --histogram H  : Histogramme par cellule et percentiles p10/p50/p90
+                   des variables "var=min:max[:classes],..." (ex:
+                   "t2m=200:330,tp=0:0.05:64") ; les classes sont fixes,
+                   donc fusionnables entre fichiers et blocs en mémoire
+                   constante, et les valeurs hors bornes comptent dans la
+                   première ou la dernière classe
+  --histogram-bins N : Nombre de classes par défaut (défaut: {HISTOGRAM_BINS})
+  --store D      : Publie aussi la carte et ses niveaux dans le magasin D
+                   (voir map_store.py) : les workers du backend lancés
+                   avec MAP_STORE=D la mappent en mémoire en commun et
+                   basculent sur la nouvelle version sans redémarrer ;
+                   le diff depuis la version précédente est publié avec
+                   (route /tiles/diff du backend)
+  --diff-tolerance T : Écart relatif sous lequel une statistique n'est
+                   pas considérée modifiée dans ce diff (défaut: 0)
+  --catalog F    : Catalogue des métadonnées des fichiers dans F (ex: à
+                   côté de --state-dir) : seuls les fichiers nouveaux ou
+                   modifiés sont rouverts, et ceux sans variable demandée,
+                   hors bbox ou hors période ne sont pas lus
+  --spill D      : Accumule les agrégats de chaque fichier sur disque dans
+                   D au lieu de la mémoire, puis calcule et écrit les tuiles
+                   par tranches : la mémoire reste stable quelle que soit
+                   la taille de cellule (ex: 0.05°)
+  --profile      : Affiche à la fin le temps et la hausse du pic mémoire
+                   de chaque étape (ouverture, lecture, affectation aux
+                   cellules, réduction, fusion, tuiles, sérialisation)
 
 Exemples:
   # Tous les fichiers .nc du dossier
@@ -322,24 +723,49 @@ Exemples:
   # Avec pattern et variables spécifiques
   python generate_square_map.py "copernicus_*.nc" map.json 1.0 temperature,precipitation first
   
+  # Fichiers horaires globaux, lecture par blocs de 64 lignes
+  python generate_square_map.py "era5_*.nc" map.json 0.25 t2m all --chunk-size 64
+  
+  # Grille très fine, agrégats accumulés sur disque
+  python generate_square_map.py "era5_*.nc" map.json 0.05 t2m all --chunk-size 64 --spill /tmp/spill
+  
+  # Cycle saisonnier de la température
+  python generate_square_map.py "era5_*.nc" map.json 1.0 t2m series --series-freq season
+  
   # Exemple pour votre projet
   python generate_square_map.py "game_resources_data/*.nc" game_map.json 0.5
+  
+  # Avec les biomes précalculés pour server.js
+  python generate_square_map.py "game_resources_data/*.nc" game_map.json 0.5 --biomes mapping/var_biome_map.json
         """)
         sys.exit(1)
     
-    input_pattern = sys.argv[1]
-    output_file = sys.argv[2]
-    cell_size = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
-    variables = sys.argv[4].split(',') if len(sys.argv) > 4 else None
-    time_agg = sys.argv[5] if len(sys.argv) > 5 else 'first'
+    input_pattern = args[0]
+    output_file = args[1]
+    cell_size = float(args[2]) if len(args) > 2 else 1.0
+    variables = args[3].split(',') if len(args) > 3 else None
+    time_agg = args[4] if len(args) > 4 else 'first'
     
+    start = time.perf_counter()
     try:
-        process_multiple_netcdf(input_pattern, output_file, cell_size, variables, time_agg)
+        process_multiple_netcdf(input_pattern, output_file, cell_size, variables, time_agg,
+                                chunk_size=int(chunk_size) if chunk_size else None,
+                                workers=int(workers) if workers else None,
+                                output_format=output_format, bbox=bbox, time_range=time_range,
+                                pyramid_levels=pyramid_levels, state_dir=state_dir, series_freq=series_freq,
+                                biome_map=biome_map, biome_top_k=biome_top_k, store_dir=store_dir,
+                                histograms=histograms, spill_dir=spill_dir, diff_tolerance=diff_tolerance,
+                                catalog_file=catalog_file)
     except Exception as e:
         print(f"\n❌ ERREUR: {e}")
         import traceback
         traceback.print_exc()
         sys.exit(1)
+    
+    if profile:
+        wall_time = time.perf_counter() - start
+        print(f"\n⏱️  Profil par étape (durée totale {wall_time:.2f} s, étapes cumulées sur tous les processus)")
+        print(METRICS.table(wall_time))
 
         
 """python generate_square_map.py "game_resources_data/*.nc" game_map.json 0.5"""
\ No newline at end of file
@@ -1,63 +1,118 @@
-import xarray as xr
+from glob import glob
+from pathlib import Path
 
-def inspect_netcdf(file_path):
+from netcdf_catalog import NetCDFCatalog
+
+def load_entries(files, catalog_file=None):
+    """
+    Métadonnées des fichiers (voir netcdf_catalog.py), ouverts en parallèle
+
+    Avec catalog_file, seuls les fichiers nouveaux ou modifiés depuis le
+    dernier passage sont ouverts ; sans, rien n'est écrit sur disque.
+
+    Returns:
+        dict: {fichier: entrée du catalogue}
+    """
+    catalog = NetCDFCatalog(catalog_file)
+    scanned = catalog.refresh(files)
+    catalog.prune()
+    try:
+        catalog.save()
+    except OSError as e:
+        print(f"⚠️  Catalogue non enregistré ({catalog.path}): {e}")
+    if scanned and catalog.path:
+        print(f"🗂️  {len(scanned)} fichier(s) scanné(s), catalogue {catalog.path}\n")
+    return {f: catalog.entry(f) for f in files}
+
+def inspect_netcdf(file_path, catalog_file=None):
     """Inspecte un fichier NetCDF et affiche sa structure"""
     print(f"🔍 Inspection de {file_path}\n")
-    
-    ds = xr.open_dataset(file_path)
-    
+
+    entry = load_entries([file_path], catalog_file)[file_path]
+    if entry is None:
+        raise FileNotFoundError(f"❌ Fichier introuvable: {file_path}")
+    if 'error' in entry:
+        raise ValueError(f"❌ Impossible d'ouvrir {file_path}: {entry['error']}")
+
     print("=" * 60)
     print("📐 DIMENSIONS")
     print("=" * 60)
-    for dim, size in ds.dims.items():
+    for dim, size in entry['dims'].items():
         print(f"  {dim}: {size}")
-    
+
     print("\n" + "=" * 60)
     print("📍 COORDONNÉES")
     print("=" * 60)
-    for coord in ds.coords:
-        coord_data = ds.coords[coord]
+    for coord, coord_data in entry['coords'].items():
         print(f"  {coord}:")
-        print(f"    - Dimensions: {coord_data.dims}")
-        print(f"    - Taille: {coord_data.size}")
-        if coord_data.size < 10:
-            print(f"    - Valeurs: {coord_data.values}")
-        else:
-            print(f"    - Min: {coord_data.min().values}, Max: {coord_data.max().values}")
-    
+        print(f"    - Dimensions: {tuple(coord_data['dims'])}")
+        print(f"    - Taille: {coord_data['size']}")
+        if 'values' in coord_data:
+            print(f"    - Valeurs: {coord_data['values']}")
+        elif 'min' in coord_data:
+            print(f"    - Min: {coord_data['min']}, Max: {coord_data['max']}")
+
     print("\n" + "=" * 60)
     print("📊 VARIABLES DE DONNÉES")
     print("=" * 60)
-    for var in ds.data_vars:
-        var_data = ds[var]
+    for var, var_data in entry['variables'].items():
         print(f"  {var}:")
-        print(f"    - Dimensions: {var_data.dims}")
-        print(f"    - Shape: {var_data.shape}")
-        print(f"    - Type: {var_data.dtype}")
-        if 'long_name' in var_data.attrs:
-            print(f"    - Description: {var_data.attrs['long_name']}")
-        if 'units' in var_data.attrs:
-            print(f"    - Unités: {var_data.attrs['units']}")
-    
+        print(f"    - Dimensions: {tuple(var_data['dims'])}")
+        print(f"    - Shape: {tuple(var_data['shape'])}")
+        print(f"    - Type: {var_data['dtype']}")
+        if 'long_name' in var_data:
+            print(f"    - Description: {var_data['long_name']}")
+        if 'units' in var_data:
+            print(f"    - Unités: {var_data['units']}")
+
     print("\n" + "=" * 60)
     print("📝 ATTRIBUTS GLOBAUX")
     print("=" * 60)
-    for attr, value in ds.attrs.items():
+    for attr, value in entry['attributes'].items():
         print(f"  {attr}: {value}")
-    
-    ds.close()
-    
+
     print("\n" + "=" * 60)
     print("💡 SUGGESTION DE COMMANDE")
     print("=" * 60)
-    variables = list(ds.data_vars.keys())
+    variables = list(entry['variables'])
     if variables:
         print(f"python generate_hex_map.py {file_path} game_map.json 0.5 {','.join(variables[:3])}")
 
+def inspect_directory(directory, catalog_file=None):
+    """Résume tous les fichiers .nc d'un dossier (une ligne par fichier et variable)"""
+    files = sorted(glob(str(Path(directory) / '*.nc')))
+    if not files:
+        raise ValueError(f"❌ Aucun fichier .nc dans {directory}")
+    print(f"🔍 Inspection de {directory} ({len(files)} fichiers)\n")
+
+    for file_path, entry in load_entries(files, catalog_file).items():
+        print(f"📄 {Path(file_path).name}")
+        if 'error' in entry:
+            print(f"   ⚠️  Illisible: {entry['error']}")
+            continue
+        if entry['lat_bounds'] and entry['lon_bounds']:
+            print(f"   📍 Lat {entry['lat_bounds'][0]} à {entry['lat_bounds'][1]}, "
+                  f"lon {entry['lon_bounds'][0]} à {entry['lon_bounds'][1]}")
+        if entry['time_span']:
+            print(f"   🕒 {entry['time_span'][0]} → {entry['time_span'][1]} ({entry['coords'][entry['time']]['size']} pas)")
+        for var, var_data in entry['variables'].items():
+            description = f" - {var_data['long_name']}" if 'long_name' in var_data else ''
+            units = f" [{var_data['units']}]" if 'units' in var_data else ''
+            print(f"   📊 {var} {tuple(var_data['shape'])} {var_data['dtype']}{description}{units}")
+
 if __name__ == '__main__':
     import sys
-    if len(sys.argv) < 2:
-        print("Usage: python inspect_netcdf.py <fichier.nc>")
+    args = sys.argv[1:]
+    catalog_file = None
+    if '--catalog' in args:
+        index = args.index('--catalog')
+        catalog_file = args[index + 1]
+        del args[index:index + 2]
+    if len(args) < 1:
+        print("Usage: python inspect_netcdf.py <fichier.nc|dossier> [--catalog F]")
         sys.exit(1)
-    
-    inspect_netcdf(sys.argv[1])
\ No newline at end of file
+
+    if Path(args[0]).is_dir():
+        inspect_directory(args[0], catalog_file)
+    else:
+        inspect_netcdf(args[0], catalog_file)
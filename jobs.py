@@ -0,0 +1,233 @@
+"""
+File de jobs asynchrones pour les traitements NetCDF longs
+
+Les agrégations tournent dans un pool de processus borné (le GIL n'est
+pas partagé avec les requêtes Flask) et la file refuse les nouveaux jobs
+au-delà d'une profondeur maximale, pour appliquer une contre-pression
+(HTTP 429) plutôt que d'accumuler les uploads en mémoire.
+
+Configuration par variables d'environnement :
+    JOB_WORKERS     : nombre de processus (défaut: 2)
+    JOB_MAX_PENDING : jobs en attente ou en cours acceptés (défaut: 8)
+    JOB_KEEP_DONE   : jobs terminés conservés pour consultation (défaut: 100)
+"""
+import io
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import METRICS, run_with_metrics, stage
+from netcdf_io import open_upload
+from square_processing import process_dataset
+
+
+class QueueFull(Exception):
+    """La file de jobs a atteint sa profondeur maximale"""
+
+
+def run_process_job(job_id, data, params, progress):
+    """
+    Exécute un job /process dans un processus worker
+
+    Args:
+        job_id: Identifiant du job
+        data: Contenu du fichier NetCDF (bytes)
+        params: Paramètres de process_dataset
+        progress: Dict partagé {job_id: fraction} mis à jour pendant le calcul
+
+    Returns:
+        tuple: (réponse JSON encodée, même format que /process ;
+                instantané des mesures du job, voir metrics.py)
+    """
+    def report(fraction):
+        progress[job_id] = fraction
+
+    def run():
+        with open_upload(io.BytesIO(data)) as ds:
+            payload = process_dataset(ds, progress=report, **params)
+        with stage('serialization'):
+            return json.dumps(payload, sort_keys=True).encode('utf-8')
+
+    return run_with_metrics(run)
+
+
+class JobQueue:
+    """
+    File de jobs adossée à un ProcessPoolExecutor
+
+    Args:
+        max_workers: Nombre de processus du pool
+        max_pending: Nombre maximal de jobs en attente ou en cours
+        keep_done: Nombre de jobs terminés conservés
+        on_done: Fonction appelée avec (job, body) quand un job réussit
+    """
+
+    def __init__(self, max_workers=2, max_pending=8, keep_done=100, on_done=None):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.keep_done = keep_done
+        self.on_done = on_done
+
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._executor = None
+        self._manager = None
+        self._progress = None
+
+    @classmethod
+    def from_env(cls, on_done=None):
+        """Crée la file à partir des variables d'environnement"""
+        return cls(
+            max_workers=int(os.getenv('JOB_WORKERS', '2')),
+            max_pending=int(os.getenv('JOB_MAX_PENDING', '8')),
+            keep_done=int(os.getenv('JOB_KEEP_DONE', '100')),
+            on_done=on_done
+        )
+
+    def _start(self):
+        # Démarrage paresseux : aucun processus tant qu'aucun job n'est soumis.
+        # 'spawn' évite de forker un serveur qui a déjà des threads.
+        if self._executor is None:
+            context = multiprocessing.get_context('spawn')
+            self._manager = context.Manager()
+            self._progress = self._manager.dict()
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+
+    def _restart(self):
+        """
+        Remplace un pool cassé (worker tué, ex: par le manque de mémoire)
+
+        Les jobs encore en attente ou en cours dans l'ancien pool sont
+        marqués en échec : leurs résultats sont perdus.
+        """
+        for job in self._jobs.values():
+            if job['status'] in ('queued', 'running'):
+                job['status'] = 'failed'
+                job['error'] = "Processus worker interrompu"
+                job['future'] = None
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+        self._start()
+
+    def _active(self):
+        return sum(1 for job in self._jobs.values() if job['status'] in ('queued', 'running'))
+
+    def submit(self, data, params, cache_key=None):
+        """
+        Soumet un job /process
+
+        Raises:
+            QueueFull: si la profondeur maximale est atteinte
+
+        Returns:
+            dict: Job créé
+        """
+        with self._lock:
+            active = self._active()
+            if active >= self.max_pending:
+                raise QueueFull(f"File pleine ({active}/{self.max_pending} jobs)")
+
+            self._start()
+            job = {
+                'id': uuid.uuid4().hex,
+                'status': 'queued',
+                'created': time.time(),
+                'cache_key': cache_key,
+                'future': None,
+                'body': None,
+                'error': None
+            }
+            try:
+                job['future'] = self._executor.submit(run_process_job, job['id'], data, params, self._progress)
+            except BrokenProcessPool:
+                self._restart()
+                job['future'] = self._executor.submit(run_process_job, job['id'], data, params, self._progress)
+            # Enregistré seulement une fois soumis : pas de job fantôme compté dans _active
+            self._jobs[job['id']] = job
+
+        job['future'].add_done_callback(lambda future: self._finish(job, future))
+        return job
+
+    def add_done(self, body, cache_key=None):
+        """Enregistre un job déjà terminé (ex: résultat trouvé dans le cache)"""
+        job = {'id': uuid.uuid4().hex, 'status': 'done', 'created': time.time(),
+               'cache_key': cache_key, 'future': None, 'body': body, 'error': None}
+        with self._lock:
+            self._jobs[job['id']] = job
+            self._trim()
+        return job
+
+    def _finish(self, job, future):
+        try:
+            body, snapshot = future.result()
+        except BrokenProcessPool:
+            with self._lock:
+                job['status'] = 'failed'
+                job['error'] = "Processus worker interrompu"
+        except Exception as e:
+            with self._lock:
+                job['status'] = 'failed'
+                job['error'] = str(e)
+        else:
+            METRICS.merge(snapshot)
+            with self._lock:
+                job['status'] = 'done'
+                job['body'] = body
+            if self.on_done:
+                self.on_done(job, body)
+
+        with self._lock:
+            if self._progress is not None:
+                self._progress.pop(job['id'], None)
+            job['future'] = None
+            self._trim()
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job['status'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - self.keep_done)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        """
+        État d'un job
+
+        Returns:
+            dict: {'id', 'status', 'progress', 'error'} et 'body' (bytes) si
+                  terminé, ou None si le job est inconnu
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job['status'] == 'queued' and job['future'] is not None and job['future'].running():
+                job['status'] = 'running'
+            status = job['status']
+            body = job['body']
+            error = job['error']
+
+        if status == 'done':
+            progress = 1.0
+        elif status == 'running':
+            progress = self._progress.get(job_id, 0.0)
+        else:
+            progress = 0.0
+
+        return {'id': job_id, 'status': status, 'progress': progress, 'error': error, 'body': body}
+
+    def stats(self):
+        """Compteurs de la file (pour /health)"""
+        with self._lock:
+            statuses = [job['status'] for job in self._jobs.values()]
+        return {
+            'workers': self.max_workers,
+            'max_pending': self.max_pending,
+            'pending': sum(1 for s in statuses if s in ('queued', 'running')),
+            'done': statuses.count('done'),
+            'failed': statuses.count('failed')
+        }
@@ -0,0 +1,246 @@
+"""
+Différences entre deux versions d'une carte
+
+Un diff est lui-même une carte (colonnes au format de
+square_stats.tile_columns) qui ne contient que les tuiles ajoutées ou
+modifiées ; ses métadonnées ont en plus 'diff' :
+
+    {'base_version', 'version', 'tolerance',
+     'added': nombre de tuiles ajoutées, 'changed': nombre de tuiles
+     modifiées, 'removed': coordonnées "x,y" des tuiles supprimées}
+
+Une tuile est modifiée si son nombre de valeurs ou le count d'une
+variable change, ou si une autre statistique (centroïde, mean/min/max/std,
+percentiles, histogramme, série, biomes) s'écarte de plus de `tolerance`
+en relatif de l'ancienne valeur. Si les variables de la carte changent
+(ajout, périodes de série, classes d'histogramme, biomes), toutes les
+tuiles sont considérées modifiées.
+
+Les diffs successifs publiés dans un magasin (map_store.py) se composent
+(compose_diffs) pour servir en un seul diff les changements depuis une
+version quelconque encore connue (route /tiles/diff du backend).
+"""
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from map_format import load_map_columns, write_binary_map
+from square_grid import format_keys, pack_keys, parse_coords
+from square_stats import sort_columns, take_columns, tiles_from_columns
+
+TILE_FIELDS = ('x', 'y', 'count', 'lat', 'lon')
+# Colonnes comparées exactement (les autres le sont avec la tolérance)
+EXACT_FIELDS = ('count', 'index')
+
+
+def _schema(columns):
+    """Ce qui doit être identique pour comparer deux cartes tuile à tuile"""
+    return {
+        'variables': {var: sorted(var_columns) for var, var_columns in columns['variables'].items()},
+        'series_labels': columns.get('series_labels', {}),
+        'histogram_edges': columns.get('histogram_edges', {}),
+        'biomes': columns['biomes']['names'] if 'biomes' in columns else None
+    }
+
+
+def _changed_rows(old, new, tolerance, exact=False):
+    """Lignes où deux colonnes alignées diffèrent (NaN == NaN)"""
+    old = np.asarray(old)
+    new = np.asarray(new)
+    if exact or not np.issubdtype(new.dtype, np.floating):
+        differs = old != new
+    else:
+        differs = ~np.isclose(new, old, rtol=tolerance, atol=0.0, equal_nan=True)
+    return differs.reshape(len(differs), -1).any(axis=1)
+
+
+def _tile_keys(columns):
+    return pack_keys(np.asarray(columns['x']), np.asarray(columns['y']))
+
+
+def diff_columns(old, new, tolerance=0.0):
+    """
+    Différences entre deux cartes
+
+    Args:
+        old, new: Colonnes au format de square_stats.tile_columns
+        tolerance: Écart relatif toléré sur les statistiques (0 = exact)
+
+    Returns:
+        tuple: (colonnes des tuiles ajoutées puis modifiées, chacune triée
+                par (x, y), {'added', 'changed', 'removed'} comme metadata['diff'])
+    """
+    old = sort_columns(old)
+    new = sort_columns(new)
+    old_keys = _tile_keys(old)
+    new_keys = _tile_keys(new)
+
+    common, old_rows, new_rows = np.intersect1d(old_keys, new_keys, assume_unique=True, return_indices=True)
+    changed = np.zeros(len(common), dtype=bool)
+    if _schema(old) != _schema(new):
+        changed[:] = True
+    elif len(common):
+        pairs = [(old[field], new[field], field == 'count') for field in TILE_FIELDS[2:]]
+        for var, var_columns in new['variables'].items():
+            pairs += [(old['variables'][var][field], values, field in EXACT_FIELDS)
+                      for field, values in var_columns.items()]
+        if 'biomes' in new:
+            pairs += [(old['biomes'][field], new['biomes'][field], field in EXACT_FIELDS)
+                      for field in ('index', 'score')]
+        for old_values, new_values, exact in pairs:
+            changed |= _changed_rows(np.asarray(old_values)[old_rows], np.asarray(new_values)[new_rows],
+                                     tolerance, exact)
+
+    added = np.ones(len(new_keys), dtype=bool)
+    added[new_rows] = False
+    removed = np.ones(len(old_keys), dtype=bool)
+    removed[old_rows] = False
+
+    # Tuiles ajoutées d'abord, puis modifiées, chacune dans l'ordre (x, y)
+    rows = np.concatenate([np.flatnonzero(added), np.sort(new_rows[changed])])
+    info = {
+        'added': int(added.sum()),
+        'changed': int(changed.sum()),
+        'removed': format_keys(old_keys[removed]) if removed.any() else []
+    }
+    return take_columns(new, rows), info
+
+
+def _concat_columns(parts):
+    """Concatène des colonnes de même schéma (voir _schema)"""
+    first = parts[0]
+    columns = {field: np.concatenate([np.asarray(p[field]) for p in parts]) for field in TILE_FIELDS}
+    columns['variables'] = {
+        var: {field: np.concatenate([np.asarray(p['variables'][var][field]) for p in parts])
+              for field in var_columns}
+        for var, var_columns in first['variables'].items()
+    }
+    columns['series_labels'] = first.get('series_labels', {})
+    columns['histogram_edges'] = first.get('histogram_edges', {})
+    if 'biomes' in first:
+        columns['biomes'] = {'names': first['biomes']['names'],
+                             **{field: np.concatenate([np.asarray(p['biomes'][field]) for p in parts])
+                                for field in ('index', 'score')}}
+    return columns
+
+
+def compose_diffs(diffs):
+    """
+    Compose des diffs successifs en un seul
+
+    Pour chaque tuile, le dernier diff qui la mentionne l'emporte : une
+    tuile modifiée puis supprimée est supprimée, une tuile supprimée puis
+    ajoutée est modifiée.
+
+    Args:
+        diffs: Liste chronologique de (metadata, colonnes) de diffs, chaque
+               diff ayant pour base la version du précédent
+
+    Raises:
+        ValueError: si les variables de la carte changent entre deux
+                    diffs (le client doit alors recharger la carte)
+
+    Returns:
+        tuple: (colonnes des tuiles à jour, ajoutées puis modifiées,
+                {'added', 'changed', 'removed'})
+    """
+    if len(diffs) == 1:
+        metadata, columns = diffs[0]
+        return columns, {field: metadata['diff'][field] for field in ('added', 'changed', 'removed')}
+
+    schema = _schema(diffs[-1][1])
+    if any(_schema(columns) != schema for _, columns in diffs):
+        raise ValueError("❌ Les variables de la carte changent entre ces versions : diff impossible")
+
+    # Événements (clé, diff, ligne dans la concaténation des colonnes ou -1
+    # pour une suppression, tuile ajoutée par ce diff)
+    keys, order, rows, added = [], [], [], []
+    offset = 0
+    for i, (metadata, columns) in enumerate(diffs):
+        removed = parse_coords(metadata['diff']['removed'])
+        tile_count = len(columns['x'])
+        keys += [removed, _tile_keys(columns)]
+        order += [np.full(len(removed) + tile_count, i)]
+        rows += [np.full(len(removed), -1), offset + np.arange(tile_count)]
+        added += [np.zeros(len(removed), dtype=bool), np.arange(tile_count) < metadata['diff']['added']]
+        offset += tile_count
+    keys, order, rows, added = (np.concatenate(values) for values in (keys, order, rows, added))
+    if len(keys) == 0:
+        return take_columns(diffs[-1][1], slice(0, 0)), {'added': 0, 'changed': 0, 'removed': []}
+
+    sort = np.lexsort((order, keys))
+    keys, rows, added = keys[sort], rows[sort], added[sort]
+    boundary = keys[1:] != keys[:-1]
+    first = np.concatenate([[True], boundary])
+    last = np.concatenate([boundary, [True]])
+
+    # La tuile existait dans la base si son premier événement n'est pas un
+    # ajout ; son état final est donné par son dernier événement
+    in_base = ~added[first]
+    rows, keys = rows[last], keys[last]
+    upserted = rows >= 0
+    new_tiles = upserted & ~in_base
+    changed = upserted & in_base
+    removed = ~upserted & in_base
+
+    merged = _concat_columns([columns for _, columns in diffs])
+    columns = take_columns(merged, np.concatenate([rows[new_tiles], rows[changed]]))
+    info = {
+        'added': int(new_tiles.sum()),
+        'changed': int(changed.sum()),
+        'removed': format_keys(keys[removed]) if removed.any() else []
+    }
+    return columns, info
+
+
+def diff_metadata(metadata, columns, info, base_version, version, tolerance):
+    """Métadonnées d'un diff : celles de la nouvelle carte et metadata['diff']"""
+    return {**metadata, 'tile_count': len(columns['x']),
+            'diff': {'base_version': base_version, 'version': version, 'tolerance': tolerance, **info}}
+
+
+def diff_maps(old_file, new_file, output_file, tolerance=0.0):
+    """
+    Calcule le diff entre deux cartes JSON ou binaires
+
+    Le diff est écrit au format de output_file : binaire (.bin) ou
+    game_map.json (les tuiles supprimées sont dans metadata['diff']).
+
+    Returns:
+        dict: metadata['diff'] du diff écrit
+    """
+    _, old_columns = load_map_columns(old_file)
+    metadata, new_columns = load_map_columns(new_file)
+    columns, info = diff_columns(old_columns, new_columns, tolerance)
+    metadata = diff_metadata(metadata, columns, info, str(old_file), str(new_file), tolerance)
+    if Path(output_file).suffix == '.bin':
+        write_binary_map(metadata, columns, output_file)
+    else:
+        with open(output_file, 'w') as f:
+            json.dump({'metadata': metadata, 'tiles': tiles_from_columns(columns)}, f, indent=2)
+    return metadata['diff']
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    tolerance = 0.0
+    if '--tolerance' in args:
+        i = args.index('--tolerance')
+        tolerance = float(args[i + 1])
+        del args[i:i + 2]
+    if len(args) != 3:
+        print("""
+Usage: python map_diff.py <ancienne_carte> <nouvelle_carte> <diff.json|diff.bin> [--tolerance T]
+
+Options:
+  --tolerance T   Écart relatif toléré sur les statistiques (défaut: 0, exact)
+
+Exemple:
+  python map_diff.py map/old_map.bin map/game_map.bin map/game_map_diff.bin --tolerance 0.001
+        """)
+        sys.exit(1)
+    diff = diff_maps(args[0], args[1], args[2], tolerance)
+    print(f"🧩 Diff: {diff['added']} tuiles ajoutées, {diff['changed']} modifiées, "
+          f"{len(diff['removed'])} supprimées → {args[2]}")
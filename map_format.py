@@ -0,0 +1,352 @@
+"""
+Format binaire colonnaire pour les cartes en grille carrée
+
+Alternative compacte à game_map.json : un en-tête JSON suivi de tableaux
+typés contigus little-endian (x, y, centroïde lat/lon, count, puis
+mean/min/max/std/count par variable). Les tableaux sont alignés sur 64
+octets et peuvent être mappés en mémoire sans désérialisation.
+
+Les variables produites en mode 'series' ont en plus un tableau 2D
+(tuiles, périodes) en float32, dont les périodes sont listées dans
+l'en-tête ('series_labels'). Les variables avec histogramme ont les
+tableaux p10/p50/p90 et un tableau 2D (tuiles, classes) 'histogram' en
+uint32 (int64 si un compte dépasse 2**32), les bornes des classes étant
+dans l'en-tête ('histogram_edges'). Une carte classée en biomes a les tableaux
+2D biomes/index (int16, -1 pour une place vide) et biomes/score (float64),
+les noms des biomes étant dans l'en-tête ('biome_names').
+
+Structure du fichier :
+    MAGIC (8 octets) | longueur de l'en-tête (uint32 LE) | en-tête JSON
+    | padding | tableaux...
+"""
+import json
+import struct
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from square_grid import parse_coords, unpack_keys
+from square_stats import PERCENTILE_FIELDS, STAT_FIELDS, tiles_from_columns
+
+MAGIC = b'TLHMAP01'
+ALIGNMENT = 64
+
+TILE_DTYPES = {
+    'x': '<i4',
+    'y': '<i4',
+    'count': '<i8',
+    'lat': '<f8',
+    'lon': '<f8'
+}
+VAR_DTYPES = {'count': '<i8', **{field: '<f8' for field in STAT_FIELDS}}
+SERIES_DTYPE = '<f4'
+STAT_DTYPE_FLOAT32 = '<f4'
+BIOME_DTYPES = {'index': '<i2', 'score': '<f8'}
+HISTOGRAM_DTYPE = '<u4'
+# Taille maximale (octets) des morceaux produits par iter_binary_map
+WRITE_BLOCK_SIZE = 1 << 24
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def iter_binary_map(metadata, columns, float32=False):
+    """
+    Encode une carte au format binaire, morceau par morceau
+
+    Args:
+        metadata: Métadonnées de la carte (même contenu que le JSON)
+        columns: Colonnes au format de square_stats.tile_columns
+        float32: Stocke mean/min/max/std en float32 au lieu de float64
+
+    Yields:
+        bytes: Morceaux successifs du fichier
+    """
+    var_dtypes = {**VAR_DTYPES, **({field: STAT_DTYPE_FLOAT32 for field in STAT_FIELDS} if float32 else {})}
+    # Tableaux source et type écrit : la conversion se fait bloc par bloc à
+    # l'écriture, sans copie complète des colonnes (ex: mappées en mémoire)
+    arrays = [(name, columns[name], dtype) for name, dtype in TILE_DTYPES.items()]
+    for var, var_columns in columns['variables'].items():
+        arrays += [(f"{var}/{field}", var_columns[field], dtype) for field, dtype in var_dtypes.items()]
+        if 'series' in var_columns:
+            arrays.append((f"{var}/series", var_columns['series'], SERIES_DTYPE))
+        if 'histogram' in var_columns:
+            arrays += [(f"{var}/{field}", var_columns[field], var_dtypes['mean']) for field in PERCENTILE_FIELDS]
+            histogram = np.asarray(var_columns['histogram'])
+            dtype = HISTOGRAM_DTYPE if histogram.size == 0 or histogram.max() < 2 ** 32 else '<i8'
+            arrays.append((f"{var}/histogram", histogram, dtype))
+    if 'biomes' in columns:
+        arrays += [(f"biomes/{field}", columns['biomes'][field], dtype) for field, dtype in BIOME_DTYPES.items()]
+    arrays = [(name, np.asarray(array), np.dtype(dtype)) for name, array, dtype in arrays]
+
+    # Les offsets sont relatifs au début de la zone de données
+    layout = []
+    offset = 0
+    for name, array, dtype in arrays:
+        entry = {'name': name, 'dtype': dtype.str, 'offset': offset, 'length': len(array)}
+        if array.ndim > 1:
+            entry['shape'] = list(array.shape)
+        layout.append(entry)
+        offset = _align(offset + array.size * dtype.itemsize)
+
+    header = json.dumps({
+        'metadata': metadata,
+        'tile_count': len(columns['x']),
+        'variables': list(columns['variables']),
+        'series_labels': columns.get('series_labels', {}),
+        'histogram_edges': columns.get('histogram_edges', {}),
+        'biome_names': columns['biomes']['names'] if 'biomes' in columns else None,
+        'arrays': layout
+    }).encode('utf-8')
+    data_start = _align(len(MAGIC) + 4 + len(header))
+
+    yield MAGIC + struct.pack('<I', len(header)) + header
+    position = len(MAGIC) + 4 + len(header)
+    for (name, array, dtype), entry in zip(arrays, layout):
+        padding = data_start + entry['offset'] - position
+        if padding:
+            yield b'\0' * padding
+        row_size = max(1, array[:1].size * dtype.itemsize)
+        rows = max(1, WRITE_BLOCK_SIZE // row_size)
+        for start in range(0, len(array), rows):
+            yield np.ascontiguousarray(array[start:start + rows], dtype=dtype).tobytes()
+        position += padding + array.size * dtype.itemsize
+
+
+def write_binary_map(metadata, columns, output_file, float32=False):
+    """
+    Écrit une carte au format binaire
+
+    Args:
+        metadata: Métadonnées de la carte (même contenu que le JSON)
+        columns: Colonnes au format de square_stats.tile_columns
+        output_file: Chemin du fichier de sortie
+        float32: Stocke mean/min/max/std en float32 au lieu de float64
+    """
+    with open(output_file, 'wb') as f:
+        for chunk in iter_binary_map(metadata, columns, float32):
+            f.write(chunk)
+
+
+def encode_binary_map(metadata, columns, float32=False):
+    """Encode une carte au format binaire en mémoire (bytes)"""
+    return b''.join(iter_binary_map(metadata, columns, float32))
+
+
+class BinaryMap:
+    """
+    Carte binaire mappée en mémoire
+
+    Attributes:
+        metadata: Métadonnées de la carte
+        columns: Colonnes (vues np.memmap) au format de tile_columns
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._load(np.memmap(path, dtype=np.uint8, mode='r'))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Lit une carte binaire contenue dans un buffer (ex: réponse HTTP)"""
+        binary_map = cls.__new__(cls)
+        binary_map.path = None
+        binary_map._load(np.frombuffer(data, dtype=np.uint8))
+        return binary_map
+
+    def _load(self, buffer):
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"❌ {self.path or 'Le buffer'} n'est pas une carte binaire")
+        header_size, = struct.unpack('<I', bytes(buffer[len(MAGIC):len(MAGIC) + 4]))
+        header = json.loads(bytes(buffer[len(MAGIC) + 4:len(MAGIC) + 4 + header_size]))
+
+        data_start = _align(len(MAGIC) + 4 + header_size)
+        self.metadata = header['metadata']
+        self.tile_count = header['tile_count']
+        self.variables = header['variables']
+
+        self._buffer = buffer
+        arrays = {}
+        for entry in header['arrays']:
+            start = data_start + entry['offset']
+            dtype = np.dtype(entry['dtype'])
+            shape = entry.get('shape', [entry['length']])
+            size = int(np.prod(shape)) * dtype.itemsize
+            arrays[entry['name']] = self._buffer[start:start + size].view(dtype).reshape(shape)
+
+        self.columns = {name: arrays[name] for name in TILE_DTYPES}
+        self.columns['variables'] = {
+            var: {field: arrays[f"{var}/{field}"] for field in VAR_DTYPES}
+            for var in self.variables
+        }
+        self.columns['series_labels'] = header.get('series_labels', {})
+        for var in self.columns['series_labels']:
+            self.columns['variables'][var]['series'] = arrays[f"{var}/series"]
+        self.columns['histogram_edges'] = header.get('histogram_edges', {})
+        for var in self.columns['histogram_edges']:
+            for field in PERCENTILE_FIELDS + ('histogram',):
+                self.columns['variables'][var][field] = arrays[f"{var}/{field}"]
+        if header.get('biome_names') is not None:
+            self.columns['biomes'] = {'names': header['biome_names'],
+                                      **{field: arrays[f"biomes/{field}"] for field in BIOME_DTYPES}}
+
+    def __len__(self):
+        return self.tile_count
+
+    def to_tiles(self):
+        """Reconstruit le dictionnaire de tuiles "x,y" du format JSON"""
+        return tiles_from_columns(self.columns, include_var_count=True, empty_value=None)
+
+    def to_json_data(self):
+        """Reconstruit la structure complète de game_map.json"""
+        return {'metadata': self.metadata, 'tiles': self.to_tiles()}
+
+
+def load_binary_map(path):
+    """Ouvre une carte binaire en mémoire mappée"""
+    return BinaryMap(path)
+
+
+def columns_from_tiles(tiles, series_labels=None, biome_names=None, histogram_edges=None):
+    """
+    Convertit un dictionnaire de tuiles JSON en colonnes
+
+    Args:
+        tiles: dict {square_coord: tile} au format de game_map.json
+        series_labels: {variable: périodes} des variables avec série
+                       (metadata['series_labels'] de game_map.json)
+        biome_names: Noms des biomes si la carte est classée
+                     (metadata['biomes']['names'] de game_map.json)
+        histogram_edges: {variable: bornes des classes} des variables avec
+                         histogramme (metadata['histogram_edges'])
+
+    Returns:
+        dict: Colonnes au format de square_stats.tile_columns
+    """
+    coords = list(tiles)
+    xs, ys = unpack_keys(parse_coords(coords))
+    columns = {
+        'x': xs,
+        'y': ys,
+        'count': np.array([tiles[c]['count'] for c in coords], dtype=np.int64),
+        'lat': np.array([tiles[c]['lat'] for c in coords], dtype=np.float64),
+        'lon': np.array([tiles[c]['lon'] for c in coords], dtype=np.float64),
+        'variables': {},
+        'series_labels': dict(series_labels or {}),
+        'histogram_edges': dict(histogram_edges or {})
+    }
+
+    variables = sorted({key for tile in tiles.values() for key in tile} - {'count', 'lat', 'lon', 'biomes'})
+    for var in variables:
+        var_columns = {'count': np.full(len(coords), -1, dtype=np.int64)}
+        var_columns.update({field: np.full(len(coords), np.nan) for field in STAT_FIELDS})
+        if var in columns['series_labels']:
+            var_columns['series'] = np.full((len(coords), len(columns['series_labels'][var])), np.nan)
+        if var in columns['histogram_edges']:
+            var_columns.update({field: np.full(len(coords), np.nan) for field in PERCENTILE_FIELDS})
+            var_columns['histogram'] = np.zeros((len(coords), len(columns['histogram_edges'][var]) - 1),
+                                                dtype=np.int64)
+        for i, coord in enumerate(coords):
+            if var not in tiles[coord]:
+                continue
+            stats = tiles[coord][var]
+            if not stats:
+                var_columns['count'][i] = 0
+                continue
+            var_columns['count'][i] = stats['count']
+            for field in STAT_FIELDS:
+                var_columns[field][i] = stats[field]
+            if 'series' in var_columns:
+                var_columns['series'][i] = [np.nan if v is None else v for v in stats['series']]
+            if 'histogram' in var_columns:
+                for field in PERCENTILE_FIELDS:
+                    var_columns[field][i] = stats[field]
+                var_columns['histogram'][i] = stats['histogram']
+        columns['variables'][var] = var_columns
+
+    if biome_names is not None:
+        positions = {name: i for i, name in enumerate(biome_names)}
+        ranked = [tiles[c].get('biomes') or [] for c in coords]
+        top_k = max((len(entries) for entries in ranked), default=0)
+        # Les tuiles avec moins de top_k biomes sont complétées par -1 / NaN
+        index = np.full((len(coords), top_k), -1, dtype=np.int16)
+        score = np.full((len(coords), top_k), np.nan)
+        for i, entries in enumerate(ranked):
+            index[i, :len(entries)] = [positions[e['biome']] for e in entries]
+            score[i, :len(entries)] = [e['score'] for e in entries]
+        columns['biomes'] = {'names': list(biome_names), 'index': index, 'score': score}
+
+    return columns
+
+
+def columns_from_json_data(data):
+    """Colonnes d'une carte au format game_map.json ({'metadata', 'tiles'})"""
+    metadata = data['metadata']
+    return columns_from_tiles(data['tiles'], metadata.get('series_labels'),
+                              (metadata.get('biomes') or {}).get('names'), metadata.get('histogram_edges'))
+
+
+def is_binary_map(path):
+    """Indique si un fichier est une carte binaire (d'après son en-tête)"""
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_map_columns(path):
+    """
+    Charge une carte JSON ou binaire sous forme de colonnes
+
+    Returns:
+        tuple: (metadata, columns au format de square_stats.tile_columns)
+    """
+    if is_binary_map(path):
+        binary_map = load_binary_map(path)
+        return binary_map.metadata, binary_map.columns
+    with open(path) as f:
+        data = json.load(f)
+    return data['metadata'], columns_from_json_data(data)
+
+
+def pyramid_path(output_file, level):
+    """
+    Chemin du fichier d'un niveau de pyramide
+
+    Le niveau 0 est le fichier de sortie lui-même ; le niveau k est écrit à
+    côté avec le suffixe _z<k> (ex: game_map_z2.json).
+    """
+    if level == 0:
+        return Path(output_file)
+    path = Path(output_file)
+    return path.with_name(f"{path.stem}_z{level}{path.suffix}")
+
+
+def json_to_binary(json_file, binary_file):
+    """Convertit game_map.json vers le format binaire"""
+    with open(json_file) as f:
+        data = json.load(f)
+    write_binary_map(data['metadata'], columns_from_json_data(data), binary_file)
+
+
+def binary_to_json(binary_file, json_file):
+    """Convertit une carte binaire vers le format game_map.json"""
+    with open(json_file, 'w') as f:
+        json.dump(load_binary_map(binary_file).to_json_data(), f, indent=2)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] not in ('to-bin', 'to-json'):
+        print("""
+Usage: python map_format.py to-bin  <game_map.json> <game_map.bin>
+       python map_format.py to-json <game_map.bin> <game_map.json>
+        """)
+        sys.exit(1)
+
+    command, source, target = sys.argv[1:]
+    if command == 'to-bin':
+        json_to_binary(source, target)
+    else:
+        binary_to_json(source, target)
+
+    print(f"✅ {source} -> {target} ({Path(target).stat().st_size / 1024 / 1024:.2f} MB)")
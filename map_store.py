@@ -0,0 +1,207 @@
+"""
+Magasin de cartes partagé entre les workers du backend
+
+Le générateur publie chaque carte (tous ses niveaux de pyramide) dans une
+nouvelle version du magasin, au format binaire de map_format.py, tuiles
+triées par (x, y) :
+
+    <racine>/
+        CURRENT               nom de la version servie
+        <version>/level_0.bin, level_1.bin...
+        diffs/<version>/BASE  version précédente
+        diffs/<version>/level_0.bin...
+                              diffs depuis la version précédente (map_diff.py)
+
+Les workers mappent les fichiers en mémoire en lecture seule : les pages
+sont celles du cache du système, partagées par tous les processus, et les
+requêtes lisent directement les tableaux mappés (tile_index.TileLevel),
+sans désérialisation ni copie par worker.
+
+Une publication écrit d'abord la version dans un dossier temporaire, puis
+la renomme et remplace CURRENT par os.replace : les workers passent tous
+d'une carte complète à l'autre, jamais à un mélange de niveaux. Les
+KEEP_VERSIONS dernières versions sont conservées pour les workers qui
+n'ont pas encore basculé.
+
+Chaque publication enregistre aussi, niveau par niveau, le diff depuis la
+version courante précédente (tuiles ajoutées, modifiées, supprimées), avant
+que CURRENT ne change. Les KEEP_DIFFS derniers diffs sont conservés : un
+client qui a une version plus ancienne recharge la carte complète. La
+tolérance est appliquée entre versions successives ; des écarts cumulés
+sous la tolérance ne sont rattrapés que par un rechargement complet.
+"""
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from map_diff import diff_columns, diff_metadata
+from map_format import load_map_columns, write_binary_map
+from square_stats import sort_columns
+
+POINTER = 'CURRENT'
+KEEP_VERSIONS = 2
+DIFFS = 'diffs'
+DIFF_BASE = 'BASE'
+KEEP_DIFFS = 20
+
+
+def _fsync(path):
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+class StoreVersion:
+    """
+    Version en cours d'écriture (voir MapStore.publish)
+
+    Attributes:
+        diffs: metadata['diff'] de chaque niveau ajouté qui existe aussi
+               dans la version de base
+    """
+
+    def __init__(self, name, path, base=None, base_paths=(), diff_path=None, diff_tolerance=0.0):
+        self.name = name
+        self.path = path
+        self.levels = 0
+        self.base = base
+        self.base_paths = base_paths
+        self.diff_path = diff_path
+        self.diff_tolerance = diff_tolerance
+        self.diffs = []
+
+    def add_level(self, metadata, columns):
+        """Écrit le niveau suivant de la pyramide (0 = carte la plus fine)"""
+        columns = sort_columns(columns)
+        path = self.path / f"level_{self.levels}.bin"
+        write_binary_map(metadata, columns, path)
+        _fsync(path)
+        if self.levels < len(self.base_paths):
+            self._add_diff(metadata, columns)
+        self.levels += 1
+
+    def _add_diff(self, metadata, columns):
+        _, base_columns = load_map_columns(self.base_paths[self.levels])
+        diff, info = diff_columns(base_columns, columns, self.diff_tolerance)
+        metadata = diff_metadata(metadata, diff, info, self.base, self.name, self.diff_tolerance)
+        path = self.diff_path / f"level_{self.levels}.bin"
+        write_binary_map(metadata, diff, path)
+        _fsync(path)
+        self.diffs.append(metadata['diff'])
+
+
+class MapStore:
+    """
+    Versions publiées d'une carte
+
+    Args:
+        root: Dossier du magasin (créé à la première publication)
+        keep: Nombre de versions conservées, dont la version courante
+        keep_diffs: Nombre de diffs conservés
+        diff_tolerance: Écart relatif toléré par les diffs (voir map_diff.py)
+    """
+
+    def __init__(self, root, keep=KEEP_VERSIONS, keep_diffs=KEEP_DIFFS, diff_tolerance=0.0):
+        self.root = Path(root)
+        self.keep = max(1, keep)
+        self.keep_diffs = keep_diffs
+        self.diff_tolerance = diff_tolerance
+
+    def current_version(self):
+        """Nom de la version servie, None si rien n'a été publié"""
+        try:
+            return (self.root / POINTER).read_text().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def level_paths(self, version):
+        """Fichiers des niveaux d'une version, du plus fin au plus grossier"""
+        paths = []
+        while (self.root / version / f"level_{len(paths)}.bin").exists():
+            paths.append(self.root / version / f"level_{len(paths)}.bin")
+        return paths
+
+    def diff_paths(self, since, level=0, version=None):
+        """
+        Diffs à appliquer, dans l'ordre, pour passer de since à version
+
+        Args:
+            since: Version de départ
+            level: Niveau de la pyramide
+            version: Version d'arrivée (défaut: version courante)
+
+        Returns:
+            list: Chemins des diffs ([] si since est la version d'arrivée),
+                  None si la chaîne de diffs n'est plus (ou pas) disponible
+        """
+        version = version or self.current_version()
+        paths = []
+        while version != since:
+            path = self.root / DIFFS / version / f"level_{level}.bin"
+            try:
+                base = (self.root / DIFFS / version / DIFF_BASE).read_text().strip()
+            except FileNotFoundError:
+                return None
+            if not path.exists():
+                return None
+            paths.append(path)
+            version = base
+        return paths[::-1]
+
+    @contextmanager
+    def publish(self):
+        """
+        Publie une nouvelle version
+
+        Le bloc `with` reçoit un StoreVersion auquel ajouter les niveaux ;
+        la version devient courante à la sortie du bloc. En cas d'exception,
+        elle est supprimée et la version courante reste servie.
+
+        Yields:
+            StoreVersion
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        version = f"{time.strftime('%Y%m%dT%H%M%S')}-{time.time_ns() % 10 ** 9:09d}-{os.getpid()}"
+        staging = self.root / f".tmp-{version}"
+        staging.mkdir()
+        base = self.current_version()
+        diff_staging = self.root / DIFFS / f".tmp-{version}"
+        if base is not None:
+            diff_staging.mkdir(parents=True)
+            (diff_staging / DIFF_BASE).write_text(base)
+        try:
+            writer = StoreVersion(version, staging, base, self.level_paths(base) if base else [],
+                                  diff_staging, self.diff_tolerance)
+            yield writer
+            if writer.levels == 0:
+                raise ValueError("❌ Version vide : aucun niveau ajouté")
+            staging.rename(self.root / version)
+            if base is not None:
+                diff_staging.rename(self.root / DIFFS / version)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            shutil.rmtree(diff_staging, ignore_errors=True)
+            raise
+
+        pointer = self.root / f".{POINTER}-{version}"
+        pointer.write_text(version)
+        _fsync(pointer)
+        os.replace(pointer, self.root / POINTER)
+        self.prune()
+
+    def prune(self):
+        """Supprime les versions les plus anciennes au-delà de keep"""
+        current = self.current_version()
+        versions = sorted(path.name for path in self.root.iterdir()
+                          if path.is_dir() and not path.name.startswith('.') and path.name != DIFFS)
+        # Les noms commencent par la date : l'ordre alphabétique est chronologique
+        older = [name for name in versions if name != current]
+        for name in older[:max(0, len(older) - (self.keep - 1))]:
+            shutil.rmtree(self.root / name, ignore_errors=True)
+
+        diffs = self.root / DIFFS
+        if diffs.is_dir():
+            names = sorted(path.name for path in diffs.iterdir() if path.is_dir() and not path.name.startswith('.'))
+            for name in names[:max(0, len(names) - self.keep_diffs)]:
+                shutil.rmtree(diffs / name, ignore_errors=True)
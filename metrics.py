@@ -0,0 +1,206 @@
+"""
+Instrumentation des étapes du traitement NetCDF
+
+Chaque étape (lecture de l'upload, ouverture du Dataset, lecture des
+variables, affectation aux cellules, réduction, construction des tuiles,
+sérialisation) est chronométrée avec stage(). Le registre conserve par
+étape un histogramme des durées et la hausse du pic de mémoire (RSS)
+observée pendant l'étape.
+
+Le registre est exposé au format texte Prometheus (route /metrics du
+backend) et sous forme de tableau (option --profile du générateur). Il est
+propre à chaque processus : les workers renvoient un instantané
+(run_with_metrics) que le processus principal fusionne avec merge().
+"""
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Ordre d'affichage des étapes connues (les autres suivent, triées)
+STAGES = ('upload_spool', 'dataset_open', 'variable_read', 'binning', 'reduction', 'merge',
+          'tile_build', 'classification', 'serialization', 'compression')
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PREFIX = 'tradelhm'
+
+
+def peak_rss_bytes():
+    """Pic de mémoire résidente du processus, en octets"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss est en octets sur macOS, en kilo-octets ailleurs
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _labels(labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels)
+
+
+class StageMetrics:
+    """
+    Registre des durées par étape et de compteurs étiquetés
+
+    Args:
+        buckets: Bornes supérieures (secondes) des histogrammes
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Chronomètre le bloc `with` comme une exécution de l'étape `name`"""
+        rss_before = peak_rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, peak_rss_bytes() - rss_before)
+
+    def observe(self, name, seconds, rss_growth=0):
+        """Enregistre une exécution d'étape"""
+        with self._lock:
+            entry = self._stages.get(name)
+            if entry is None:
+                entry = self._stages[name] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'rss_growth': 0,
+                                              'buckets': [0] * len(self.buckets)}
+            entry['count'] += 1
+            entry['sum'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            entry['rss_growth'] += rss_growth
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry['buckets'][i] += 1
+
+    def inc(self, name, labels=(), value=1):
+        """
+        Incrémente un compteur
+
+        Args:
+            name: Nom du compteur (sans préfixe ni suffixe _total)
+            labels: Étiquettes [(nom, valeur)]
+        """
+        key = (name, tuple(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def snapshot(self):
+        """Copie sérialisable (pickle) du registre"""
+        with self._lock:
+            return {
+                'stages': {name: {**entry, 'buckets': list(entry['buckets'])} for name, entry in self._stages.items()},
+                'counters': dict(self._counters)
+            }
+
+    def merge(self, snapshot):
+        """Ajoute un instantané (ex: renvoyé par un worker) au registre"""
+        with self._lock:
+            for name, other in snapshot['stages'].items():
+                entry = self._stages.get(name)
+                if entry is None:
+                    self._stages[name] = {**other, 'buckets': list(other['buckets'])}
+                    continue
+                entry['count'] += other['count']
+                entry['sum'] += other['sum']
+                entry['max'] = max(entry['max'], other['max'])
+                entry['rss_growth'] += other['rss_growth']
+                entry['buckets'] = [a + b for a, b in zip(entry['buckets'], other['buckets'])]
+            for key, value in snapshot['counters'].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+
+    def _ordered_stages(self, stages):
+        return [name for name in STAGES if name in stages] + sorted(set(stages) - set(STAGES))
+
+    def render(self):
+        """
+        Registre au format texte d'exposition Prometheus
+
+        Returns:
+            str: Histogrammes tradelhm_stage_duration_seconds, compteurs
+                 tradelhm_stage_rss_growth_bytes_total et *_total, et jauge
+                 tradelhm_process_peak_rss_bytes
+        """
+        snapshot = self.snapshot()
+        stages = snapshot['stages']
+        histogram = f"{PREFIX}_stage_duration_seconds"
+        growth = f"{PREFIX}_stage_rss_growth_bytes_total"
+        lines = [
+            f"# HELP {histogram} Durée des étapes du traitement NetCDF",
+            f"# TYPE {histogram} histogram"
+        ]
+        for name in self._ordered_stages(stages):
+            entry = stages[name]
+            for bound, count in zip(self.buckets, entry['buckets']):
+                lines.append(f'{histogram}_bucket{{stage="{name}",le="{bound:g}"}} {count}')
+            lines.append(f'{histogram}_bucket{{stage="{name}",le="+Inf"}} {entry["count"]}')
+            lines.append(f'{histogram}_sum{{stage="{name}"}} {entry["sum"]:.6f}')
+            lines.append(f'{histogram}_count{{stage="{name}"}} {entry["count"]}')
+
+        lines += [
+            f"# HELP {growth} Hausse du pic de mémoire résidente pendant chaque étape",
+            f"# TYPE {growth} counter"
+        ]
+        lines += [f'{growth}{{stage="{name}"}} {stages[name]["rss_growth"]}' for name in self._ordered_stages(stages)]
+
+        for counter in sorted({name for name, _ in snapshot['counters']}):
+            lines.append(f"# TYPE {PREFIX}_{counter}_total counter")
+            for (name, labels), value in sorted(snapshot['counters'].items()):
+                if name == counter:
+                    lines.append(f"{PREFIX}_{name}_total{{{_labels(labels)}}} {value}" if labels
+                                 else f"{PREFIX}_{name}_total {value}")
+
+        lines += [
+            f"# HELP {PREFIX}_process_peak_rss_bytes Pic de mémoire résidente du processus",
+            f"# TYPE {PREFIX}_process_peak_rss_bytes gauge",
+            f"{PREFIX}_process_peak_rss_bytes {peak_rss_bytes()}"
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def table(self, wall_time=None):
+        """
+        Tableau récapitulatif par étape (pour --profile)
+
+        Args:
+            wall_time: Durée totale de référence pour la colonne %, en secondes
+                       (défaut: somme des étapes)
+        """
+        stages = self.snapshot()['stages']
+        total = wall_time or sum(entry['sum'] for entry in stages.values()) or 1.0
+        lines = [f"{'Étape':<16}{'Appels':>8}{'Total (s)':>12}{'Moyenne (ms)':>14}{'Max (ms)':>11}"
+                 f"{'%':>7}{'RSS + (Mo)':>12}"]
+        for name in self._ordered_stages(stages):
+            entry = stages[name]
+            lines.append(f"{name:<16}{entry['count']:>8}{entry['sum']:>12.3f}"
+                         f"{entry['sum'] / entry['count'] * 1000:>14.2f}{entry['max'] * 1000:>11.2f}"
+                         f"{entry['sum'] / total * 100:>7.1f}{entry['rss_growth'] / 1024 / 1024:>12.1f}")
+        return '\n'.join(lines)
+
+
+METRICS = StageMetrics()
+
+
+def stage(name):
+    """Chronomètre une étape dans le registre du processus (METRICS)"""
+    return METRICS.stage(name)
+
+
+def run_with_metrics(function, *args, **kwargs):
+    """
+    Exécute une fonction dans un worker et renvoie aussi ses mesures
+
+    Returns:
+        tuple: (résultat, instantané des mesures de cet appel)
+    """
+    METRICS.reset()
+    result = function(*args, **kwargs)
+    return result, METRICS.snapshot()
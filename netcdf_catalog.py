@@ -0,0 +1,314 @@
+"""
+Catalogue persistant des métadonnées des fichiers NetCDF d'un dossier
+
+Pour chaque fichier, le catalogue garde ses dimensions, ses coordonnées
+(taille, bornes des coordonnées 1D), ses variables (dimensions, forme, type,
+description, unités), l'emprise lat/lon, la période couverte et ses
+attributs globaux, avec la signature du fichier (taille, date de
+modification, voir build_state.file_signature).
+
+Seuls les fichiers nouveaux ou modifiés sont rouverts (en parallèle) ; les
+autres sont décrits depuis le catalogue sans ouvrir le fichier ni importer
+xarray. generate_square_map.py s'en sert pour écarter, avant toute
+ouverture, les fichiers sans variable demandée, hors bbox ou hors période,
+et inspect_netcdf.py pour décrire un fichier ou tout un dossier.
+
+Le catalogue est un fichier JSON choisi par l'utilisateur (--catalog) :
+rien n'est écrit dans le dossier des données. Sans fichier, il ne vit que
+le temps du processus.
+"""
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from build_state import file_signature
+from netcdf_io import TIME_NAMES, find_lat_lon, load_xarray
+from square_grid import normalize_lon
+
+CATALOG_VERSION = 2
+# Coordonnées dont les valeurs sont gardées en entier (toutes : min/max)
+MAX_LISTED_VALUES = 10
+
+
+def _json_value(value):
+    """Valeur d'attribut NetCDF sérialisable en JSON"""
+    if isinstance(value, np.ndarray):
+        return [_json_value(v) for v in value.tolist()]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (str, int, bool)) or value is None:
+        return value
+    if isinstance(value, float):
+        return value if np.isfinite(value) else str(value)
+    if isinstance(value, (list, tuple)):
+        return [_json_value(v) for v in value]
+    return str(value)
+
+
+def _scalar(value):
+    """Borne de coordonnée : date ISO pour les datetime64, sinon nombre"""
+    if np.issubdtype(np.asarray(value).dtype, np.datetime64):
+        return str(np.datetime_as_string(value))
+    return _json_value(np.asarray(value).item())
+
+
+def describe_dataset(ds):
+    """
+    Métadonnées d'un Dataset ouvert, sans lire les variables de données
+
+    Seules les coordonnées sont lues, pour leurs valeurs (moins de
+    MAX_LISTED_VALUES) et leurs bornes : 1D, elles sont déjà en mémoire comme
+    index dans xarray, 2D (lat/lon des grilles curvilignes), elles seraient
+    de toute façon lues par find_lat_lon et subset_dataset.
+
+    Returns:
+        dict: Entrée du catalogue (sans la signature du fichier)
+    """
+    coords = {}
+    for name in ds.coords:
+        coord = ds.coords[name]
+        entry = {'dims': list(coord.dims), 'size': int(coord.size), 'dtype': str(coord.dtype)}
+        if coord.size:
+            values = coord.values.ravel()
+            if coord.size < MAX_LISTED_VALUES:
+                entry['values'] = [_scalar(v) for v in values]
+            if np.issubdtype(values.dtype, np.floating):
+                if not np.isnan(values).all():
+                    entry['min'], entry['max'] = _scalar(np.nanmin(values)), _scalar(np.nanmax(values))
+            elif np.issubdtype(values.dtype, np.number) or np.issubdtype(values.dtype, np.datetime64):
+                entry['min'], entry['max'] = _scalar(values.min()), _scalar(values.max())
+        coords[name] = entry
+
+    lat_var, lon_var = find_lat_lon(ds)
+    time_var = next((name for name in TIME_NAMES if name in ds.coords and ds[name].ndim == 1), None)
+    variables = {}
+    for name in ds.data_vars:
+        var = ds[name]
+        variables[name] = {
+            'dims': list(var.dims),
+            'shape': list(var.shape),
+            'dtype': str(var.dtype),
+            **{key: _json_value(var.attrs[key]) for key in ('long_name', 'units') if key in var.attrs}
+        }
+
+    def bounds(name):
+        entry = coords.get(name) or {}
+        return [entry['min'], entry['max']] if 'min' in entry else None
+
+    return {
+        'dims': {dim: int(size) for dim, size in ds.sizes.items()},
+        'coords': coords,
+        'variables': variables,
+        'lat': lat_var,
+        'lon': lon_var,
+        'time': time_var,
+        'lat_bounds': bounds(lat_var),
+        'lon_bounds': bounds(lon_var),
+        'time_span': bounds(time_var),
+        'attributes': {key: _json_value(value) for key, value in ds.attrs.items()}
+    }
+
+
+def scan_file(file_path):
+    """
+    Ouvre un fichier et décrit son contenu (voir describe_dataset)
+
+    Returns:
+        dict: Entrée du catalogue ; {'signature', 'error'} si le fichier
+              ne peut pas être ouvert (gardée en mémoire seulement, voir
+              NetCDFCatalog.save)
+    """
+    signature = file_signature(file_path)
+    try:
+        with load_xarray().open_dataset(file_path) as ds:
+            return {'signature': signature, **describe_dataset(ds)}
+    except Exception as e:
+        return {'signature': signature, 'error': str(e)}
+
+
+def _lon_overlaps(lon_bounds, lon_min, lon_max):
+    if lon_max - lon_min >= 360:
+        return True
+    low, high = lon_bounds
+    positive = low >= 0 and high > 180
+    lo = normalize_lon(lon_min, positive)
+    hi = normalize_lon(lon_max, positive)
+    if lo <= hi:
+        return high >= lo and low <= hi
+    return high >= lo or low <= hi
+
+
+def _time_overlaps(time_span, time_range):
+    """
+    Indique si la période d'un fichier peut recouper time_range
+
+    Si les bornes ne se comparent pas à l'axe du fichier (ex: dates et axe
+    numérique non décodé), le fichier est gardé : subset_dataset tranchera.
+    """
+    start, end = time_range
+    if isinstance(time_span[0], str):
+        low, high = np.datetime64(time_span[0]), np.datetime64(time_span[1])
+        bound = np.datetime64
+    else:
+        low, high = time_span
+        bound = float
+    try:
+        return (start is None or high >= bound(start)) and (end is None or low <= bound(end))
+    except (TypeError, ValueError):
+        return True
+
+
+class NetCDFCatalog:
+    """
+    Catalogue des fichiers NetCDF (voir le module)
+
+    Args:
+        path: Fichier JSON du catalogue (créé au premier save), None = en
+              mémoire seulement
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self.files = {}
+        self.dirty = False
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as f:
+                catalog = json.load(f)
+            if catalog.get('version') == CATALOG_VERSION:
+                self.files = catalog['files']
+        except (FileNotFoundError, ValueError):
+            pass
+
+    @staticmethod
+    def _key(file_path):
+        return str(Path(file_path).resolve())
+
+    def entry(self, file_path):
+        """Entrée d'un fichier, None s'il n'est pas catalogué"""
+        return self.files.get(self._key(file_path))
+
+    def refresh(self, files, workers=None):
+        """
+        Met à jour les entrées des fichiers nouveaux ou modifiés
+
+        Args:
+            files: Fichiers à cataloguer
+            workers: Nombre de processus pour ouvrir les fichiers modifiés
+                     (None = nombre de cœurs, 1 = séquentiel)
+
+        Returns:
+            list: Fichiers (re)scannés
+        """
+        stale = []
+        for file_path in files:
+            try:
+                signature = file_signature(file_path)
+            except OSError:
+                # Fichier absent : laissé non catalogué, l'erreur viendra à son traitement
+                continue
+            entry = self.entry(file_path)
+            # Un échec d'ouverture n'est pas mémorisé : il peut être passager
+            if entry is None or 'error' in entry or entry['signature'] != signature:
+                stale.append(file_path)
+        if not stale:
+            return []
+
+        workers = min(workers or os.cpu_count() or 1, len(stale))
+        if workers <= 1:
+            entries = [scan_file(f) for f in stale]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                entries = list(executor.map(scan_file, stale))
+        for file_path, entry in zip(stale, entries):
+            self.files[self._key(file_path)] = entry
+        self.dirty = True
+        return stale
+
+    def prune(self):
+        """
+        Retire les fichiers disparus (supprimés ou renommés)
+
+        Returns:
+            list: Clés retirées
+        """
+        removed = [key for key in self.files if not os.path.exists(key)]
+        for key in removed:
+            del self.files[key]
+        self.dirty = self.dirty or bool(removed)
+        return removed
+
+    def save(self):
+        """
+        Écrit le catalogue (atomiquement) s'il a changé
+
+        Les échecs d'ouverture ne sont pas écrits : le fichier est rouvert
+        au prochain refresh.
+        """
+        if self.path is None or not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as f:
+            files = {key: entry for key, entry in self.files.items() if 'error' not in entry}
+            json.dump({'version': CATALOG_VERSION, 'files': files}, f, indent=2)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def select(self, files, variables=None, bbox=None, time_range=None):
+        """
+        Écarte les fichiers inutiles à une construction, sans les ouvrir
+
+        Un fichier est écarté s'il n'a pas de coordonnées lat/lon, aucune
+        variable demandée (au moins 2D), ou ne recoupe pas la bbox ou la
+        période. Les fichiers non catalogués ou qui n'ont pas pu être
+        ouverts sont gardés : leur traitement signalera l'erreur.
+
+        Args:
+            files: Fichiers candidats (catalogués par refresh)
+            variables: Variables demandées (None = toutes)
+            bbox: (lat_min, lat_max, lon_min, lon_max), ou None
+            time_range: (début, fin), ou None
+
+        Returns:
+            tuple: ({fichier: variables à lire}, {fichier: raison de l'écart})
+        """
+        selected, skipped = {}, {}
+        for file_path in files:
+            entry = self.entry(file_path)
+            if entry is None or 'error' in entry:
+                selected[file_path] = variables
+                continue
+            if not entry['lat'] or not entry['lon']:
+                skipped[file_path] = "coordonnées lat/lon non trouvées"
+                continue
+            # Même choix que process_single_file, sans ouvrir le fichier
+            if variables is None:
+                file_variables = [var for var, info in entry['variables'].items() if len(info['dims']) >= 2]
+            else:
+                file_variables = [var for var in variables if var in entry['variables']]
+            if not file_variables:
+                skipped[file_path] = "aucune variable demandée"
+                continue
+            if bbox:
+                lat_min, lat_max, lon_min, lon_max = bbox
+                lat_bounds, lon_bounds = entry['lat_bounds'], entry['lon_bounds']
+                if lat_bounds and (lat_bounds[1] < lat_min or lat_bounds[0] > lat_max):
+                    skipped[file_path] = "hors bbox (latitudes)"
+                    continue
+                if lon_bounds and not _lon_overlaps(lon_bounds, lon_min, lon_max):
+                    skipped[file_path] = "hors bbox (longitudes)"
+                    continue
+            if time_range:
+                if entry['time'] is None:
+                    skipped[file_path] = "pas de coordonnée temporelle"
+                    continue
+                if entry['time_span'] and not _time_overlaps(entry['time_span'], time_range):
+                    skipped[file_path] = "hors période"
+                    continue
+            selected[file_path] = file_variables
+        return selected, skipped
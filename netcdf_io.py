@@ -0,0 +1,247 @@
+"""
+Ouverture des fichiers NetCDF envoyés au backend
+
+Les fichiers sont ouverts directement depuis la mémoire quand leur taille
+le permet (NetCDF3 via scipy, NetCDF4/HDF5 via netCDF4 en mode mémoire ou
+h5netcdf). Au-delà du seuil UPLOAD_SPOOL_THRESHOLD_MB (défaut: 256), ils
+sont copiés dans un fichier temporaire supprimé à la fermeture.
+
+Le module fournit aussi la détection des coordonnées et le sous-ensemble
+bbox / fenêtre temporelle appliqué avant toute lecture de valeurs.
+
+xarray (et avec lui pandas et les moteurs NetCDF) n'est importé qu'à la
+première ouverture de fichier, ou par warm_up() : importer ce module ne
+coûte presque rien au démarrage du backend.
+"""
+import importlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+from metrics import stage
+from square_grid import normalize_lon
+
+NETCDF3_MAGIC = b'CDF'
+HDF5_MAGIC = b'\x89HDF'
+
+LAT_NAMES = ['lat', 'latitude', 'y']
+LON_NAMES = ['lon', 'longitude', 'x']
+TIME_NAMES = ['time', 'valid_time', 't']
+
+SPOOL_THRESHOLD = int(float(os.getenv('UPLOAD_SPOOL_THRESHOLD_MB', '256')) * 1024 * 1024)
+
+
+def load_xarray():
+    """Importe xarray à la première utilisation (les suivantes sont gratuites)"""
+    import xarray
+    return xarray
+
+
+def netcdf_loaded():
+    """Indique si xarray a déjà été importé dans ce processus"""
+    return 'xarray' in sys.modules
+
+
+def warm_up():
+    """
+    Importe à l'avance la pile NetCDF (xarray, pandas, moteurs scipy et
+    netCDF4), pour que la première requête ne paie pas ces imports
+    """
+    load_xarray().backends.list_engines()
+    for module in ('scipy.io', 'netCDF4'):
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+
+def stream_size(stream):
+    """Taille d'un flux positionnable, sans le lire"""
+    position = stream.tell()
+    stream.seek(0, io.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+
+def open_netcdf_bytes(data):
+    """
+    Ouvre un fichier NetCDF contenu dans un buffer mémoire
+
+    Args:
+        data: Contenu du fichier (bytes)
+
+    Returns:
+        xr.Dataset
+    """
+    xr = load_xarray()
+    if data.startswith(NETCDF3_MAGIC):
+        return xr.open_dataset(io.BytesIO(data), engine='scipy')
+
+    if data.startswith(HDF5_MAGIC):
+        try:
+            import netCDF4
+        except ImportError:
+            return xr.open_dataset(io.BytesIO(data), engine='h5netcdf')
+        nc = netCDF4.Dataset('upload.nc', mode='r', memory=data)
+        return xr.open_dataset(xr.backends.NetCDF4DataStore(nc))
+
+    raise ValueError('Format de fichier non reconnu (NetCDF3 ou NetCDF4 attendu)')
+
+
+@contextmanager
+def open_upload(stream, spool_threshold=None):
+    """
+    Ouvre un fichier envoyé, en mémoire ou via un fichier temporaire
+
+    Args:
+        stream: Flux binaire du fichier (ex: FileStorage.stream)
+        spool_threshold: Taille en octets au-delà de laquelle le fichier est
+                         copié sur disque (défaut: UPLOAD_SPOOL_THRESHOLD_MB)
+
+    Yields:
+        xr.Dataset
+    """
+    if spool_threshold is None:
+        spool_threshold = SPOOL_THRESHOLD
+
+    stream.seek(0)
+    if stream_size(stream) <= spool_threshold:
+        with stage('upload_spool'):
+            data = stream.read()
+        with stage('dataset_open'):
+            ds = open_netcdf_bytes(data)
+        try:
+            yield ds
+        finally:
+            ds.close()
+        return
+
+    with stage('upload_spool'), tempfile.NamedTemporaryFile(delete=False, suffix='.nc') as tmp_file:
+        shutil.copyfileobj(stream, tmp_file)
+        tmp_path = tmp_file.name
+
+    try:
+        with stage('dataset_open'):
+            ds = load_xarray().open_dataset(tmp_path)
+        try:
+            yield ds
+        finally:
+            ds.close()
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def find_lat_lon(ds):
+    """
+    Détecte les noms des coordonnées latitude et longitude
+
+    Returns:
+        tuple: (lat_var, lon_var), None pour une coordonnée absente
+    """
+    lat_var = next((name for name in LAT_NAMES if name in ds.coords), None)
+    lon_var = next((name for name in LON_NAMES if name in ds.coords), None)
+    return lat_var, lon_var
+
+
+def parse_bbox(text):
+    """
+    Lit une bbox "lat_min,lat_max,lon_min,lon_max"
+
+    Returns:
+        tuple: (lat_min, lat_max, lon_min, lon_max), ou None si vide
+    """
+    if not text:
+        return None
+    values = [float(v) for v in text.split(',')]
+    if len(values) != 4:
+        raise ValueError(f"bbox invalide: {text} (attendu: lat_min,lat_max,lon_min,lon_max)")
+    if values[0] > values[1]:
+        raise ValueError(f"bbox invalide: lat_min > lat_max ({text})")
+    return tuple(values)
+
+
+def parse_time_range(text):
+    """
+    Lit une fenêtre temporelle "début,fin" (une borne peut être vide)
+
+    Returns:
+        tuple: (début, fin) en chaînes ou None, ou None si vide
+    """
+    if not text:
+        return None
+    parts = text.split(',')
+    if len(parts) != 2:
+        raise ValueError(f"time_range invalide: {text} (attendu: début,fin)")
+    return tuple(part.strip() or None for part in parts)
+
+
+def _indexer(mask):
+    """Transforme un masque 1D en slice contigu, ou en tableau d'indices"""
+    indices = np.nonzero(mask)[0]
+    if len(indices) == 0:
+        raise ValueError("Aucune donnée dans la zone demandée")
+    if indices[-1] - indices[0] + 1 == len(indices):
+        return slice(int(indices[0]), int(indices[-1]) + 1)
+    return indices
+
+
+def _time_bound(value, times):
+    if np.issubdtype(times.dtype, np.datetime64):
+        return np.datetime64(value)
+    return float(value)
+
+
+def subset_dataset(ds, lat_var, lon_var, bbox=None, time_range=None):
+    """
+    Restreint un Dataset à une bbox et une fenêtre temporelle
+
+    La sélection est positionnelle (isel) sur les coordonnées 1D : elle reste
+    paresseuse, seul l'hyperslab demandé sera lu. Les latitudes décroissantes
+    et les conventions de longitude 0-360 / -180-180 sont gérées.
+
+    Args:
+        ds: Dataset ouvert
+        lat_var: Nom de la coordonnée latitude
+        lon_var: Nom de la coordonnée longitude
+        bbox: (lat_min, lat_max, lon_min, lon_max) en degrés, ou None
+        time_range: (début, fin) en chaînes ISO ou valeurs, ou None
+
+    Returns:
+        xr.Dataset: Vue restreinte (paresseuse)
+    """
+    indexers = {}
+
+    if bbox:
+        lat_min, lat_max, lon_min, lon_max = bbox
+        lats = ds[lat_var].values
+        indexers[ds[lat_var].dims[0]] = _indexer((lats >= lat_min) & (lats <= lat_max))
+
+        if lon_max - lon_min < 360:
+            lons = ds[lon_var].values
+            positive = lons.min() >= 0 and lons.max() > 180
+            lo = normalize_lon(lon_min, positive)
+            hi = normalize_lon(lon_max, positive)
+            mask = (lons >= lo) & (lons <= hi) if lo <= hi else (lons >= lo) | (lons <= hi)
+            indexers[ds[lon_var].dims[0]] = _indexer(mask)
+
+    if time_range:
+        time_var = next((name for name in TIME_NAMES if name in ds.coords and ds[name].ndim == 1), None)
+        if time_var is None:
+            raise ValueError(f"Coordonnée temporelle non trouvée. Coordonnées: {list(ds.coords.keys())}")
+        times = ds[time_var].values
+        start, end = time_range
+        mask = np.ones(len(times), dtype=bool)
+        if start is not None:
+            mask &= times >= _time_bound(start, times)
+        if end is not None:
+            mask &= times <= _time_bound(end, times)
+        indexers[ds[time_var].dims[0]] = _indexer(mask)
+
+    return ds.isel(indexers) if indexers else ds
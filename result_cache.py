@@ -0,0 +1,211 @@
+"""
+Cache de résultats adressé par contenu pour /process et /info
+
+La clé est un hash SHA-256 des octets du fichier envoyé et des paramètres
+de la requête. Les réponses JSON déjà encodées sont conservées :
+    - en mémoire, dans un LRU borné en octets
+    - optionnellement sur disque, dans un dossier borné en taille
+      (éviction des fichiers les moins récemment utilisés)
+
+Configuration par variables d'environnement :
+    RESULT_CACHE_MEMORY_MB : budget mémoire (défaut: 256, 0 = désactivé)
+    RESULT_CACHE_DIR       : dossier du cache disque (défaut: aucun)
+    RESULT_CACHE_DISK_MB   : budget disque (défaut: 2048)
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+HASH_BLOCK_SIZE = 1024 * 1024
+# Les réponses peuvent être en JSON, msgpack ou colonnaire : suffixe neutre
+DISK_SUFFIX = '.bin'
+# Entrées des versions précédentes, comptées et évincées comme les autres
+LEGACY_SUFFIXES = ('.json',)
+
+logger = logging.getLogger(__name__)
+
+
+def hash_stream(stream):
+    """
+    Calcule le SHA-256 d'un flux puis le rembobine
+
+    Args:
+        stream: Flux binaire positionnable (seek)
+
+    Returns:
+        str: Empreinte hexadécimale
+    """
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for block in iter(lambda: stream.read(HASH_BLOCK_SIZE), b''):
+        digest.update(block)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def make_key(content_hash, endpoint, **params):
+    """Construit la clé de cache d'une requête"""
+    raw = json.dumps({'content': content_hash, 'endpoint': endpoint, 'params': params}, sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    Cache à deux niveaux (mémoire LRU + disque) de réponses encodées
+
+    Args:
+        memory_budget: Taille maximale en octets du niveau mémoire
+        disk_dir: Dossier du niveau disque (None = désactivé)
+        disk_budget: Taille maximale en octets du niveau disque
+    """
+
+    def __init__(self, memory_budget=256 * 1024 * 1024, disk_dir=None, disk_budget=2048 * 1024 * 1024):
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self.counters = {'hits': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._disk_bytes = sum(path.stat().st_size for path in self._disk_entries())
+
+    @classmethod
+    def from_env(cls):
+        """Crée le cache à partir des variables d'environnement"""
+        return cls(
+            memory_budget=int(float(os.getenv('RESULT_CACHE_MEMORY_MB', '256')) * 1024 * 1024),
+            disk_dir=os.getenv('RESULT_CACHE_DIR') or None,
+            disk_budget=int(float(os.getenv('RESULT_CACHE_DISK_MB', '2048')) * 1024 * 1024)
+        )
+
+    def _disk_path(self, key):
+        return self.disk_dir / f"{key}{DISK_SUFFIX}"
+
+    def _disk_entries(self):
+        for suffix in (DISK_SUFFIX,) + LEGACY_SUFFIXES:
+            yield from self.disk_dir.glob(f"*{suffix}")
+
+    def get(self, key):
+        """
+        Cherche une réponse dans le cache
+
+        Returns:
+            bytes: Réponse encodée, ou None si absente
+        """
+        with self._lock:
+            body = self._memory.get(key)
+            if body is not None:
+                self._memory.move_to_end(key)
+                self.counters['hits'] += 1
+                self.counters['memory_hits'] += 1
+                return body
+
+        body = self._read_disk(key)
+        with self._lock:
+            if body is None:
+                self.counters['misses'] += 1
+                return None
+            self.counters['hits'] += 1
+            self.counters['disk_hits'] += 1
+            self._put_memory(key, body)
+        return body
+
+    def put(self, key, body):
+        """
+        Ajoute une réponse encodée (bytes) au cache
+
+        Une erreur d'écriture sur disque (disque plein, droits) est
+        journalisée sans faire échouer la requête : la réponse reste en
+        mémoire.
+        """
+        with self._lock:
+            self._put_memory(key, body)
+        try:
+            self._write_disk(key, body)
+        except OSError as e:
+            logger.warning("Cache disque non écrit pour %s: %s", key, e)
+
+    def _put_memory(self, key, body):
+        if len(body) > self.memory_budget:
+            return
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = body
+        self._memory_bytes += len(body)
+        while self._memory_bytes > self.memory_budget:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self.counters['evictions'] += 1
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            body = path.read_bytes()
+            # mtime sert d'horodatage LRU pour l'éviction
+            os.utime(path)
+            return body
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, key, body):
+        if not self.disk_dir or len(body) > self.disk_budget:
+            return
+        path = self._disk_path(key)
+        if path.exists():
+            return
+
+        # Écriture atomique : un worker tué ne laisse pas de fichier tronqué
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+        except OSError:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+        with self._lock:
+            self._disk_bytes += len(body)
+            if self._disk_bytes > self.disk_budget:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        entries = []
+        for path in self._disk_entries():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        self._disk_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self._disk_bytes <= self.disk_budget:
+                break
+            path.unlink(missing_ok=True)
+            self._disk_bytes -= size
+            self.counters['evictions'] += 1
+
+    def stats(self):
+        """Compteurs et occupation du cache (pour /health)"""
+        with self._lock:
+            return {
+                **self.counters,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'memory_budget': self.memory_budget,
+                'disk_bytes': self._disk_bytes if self.disk_dir else 0,
+                'disk_budget': self.disk_budget if self.disk_dir else 0
+            }
@@ -177,6 +177,9 @@ const oceanBiomes = [
   'ocean_polaire', 'ocean_tempere', 'ocean_tropical', 'ocean_profond'
 ];
 
+// Nombre de meilleurs biomes parmi lesquels la diversification choisit
+const TOP_BIOMES = 3;
+
 /**
  * NOUVELLE FONCTION : Détermine le biome avec diversification basée sur les coordonnées
  */
@@ -188,11 +191,23 @@ function determineBiomeWithDiversity(cell, q, r) {
   const biomeScores = [];
   const allowedBiomes = isLand ? landBiomes : oceanBiomes;
   
-  for (const [biomeName, biomeRanges] of Object.entries(biomeMappingData)) {
-    if (!allowedBiomes.includes(biomeName)) continue;
-    
-    const score = calculateBiomeScore(cell, biomeRanges);
-    biomeScores.push({ biome: biomeName, score });
+  // Scores précalculés par generate_square_map.py --biomes (triés par score décroissant).
+  // Ils mélangent terre et mer : on ne s'en sert que s'il reste assez de biomes
+  // autorisés pour le top, sinon la sélection différerait du calcul complet
+  const precomputed = Array.isArray(cell.biomes)
+    ? cell.biomes.filter(b => allowedBiomes.includes(b.biome))
+    : [];
+  const needed = Math.min(TOP_BIOMES, allowedBiomes.filter(b => b in biomeMappingData).length);
+
+  if (precomputed.length > 0 && precomputed.length >= needed) {
+    biomeScores.push(...precomputed);
+  } else {
+    for (const [biomeName, biomeRanges] of Object.entries(biomeMappingData)) {
+      if (!allowedBiomes.includes(biomeName)) continue;
+
+      const score = calculateBiomeScore(cell, biomeRanges);
+      biomeScores.push({ biome: biomeName, score });
+    }
   }
   
   // Si aucun biome trouvé, fallback
@@ -210,7 +225,7 @@ function determineBiomeWithDiversity(cell, q, r) {
   biomeScores.sort((a, b) => b.score - a.score);
   
   // 2. Obtenir les top 3 biomes
-  const topBiomes = biomeScores.slice(0, 3);
+  const topBiomes = biomeScores.slice(0, TOP_BIOMES);
   
   // 3. Filtrer pour garder seulement les biomes compatibles entre eux
   const primaryBiome = topBiomes[0].biome;
@@ -0,0 +1,347 @@
+"""
+Accumulateur hors mémoire pour les cartes très fines
+
+À très petite taille de cellule (ex: 0.05°), garder en mémoire les agrégats
+de tous les fichiers, puis les colonnes de toutes les tuiles, ne tient
+plus. Le SpillStore écrit chaque lot d'agrégats (ex: un fichier traité)
+sur disque, tableaux triés par clé de tuile, relus en mémoire mappée :
+
+    <racine>/
+        run_000001/index.json       types et formes des tableaux
+        run_000001/<variable>/keys.bin, count.bin, sum.bin...
+
+La fusion se fait par tranches de colonnes x de la grille (chunks) : seule
+une tranche de chaque lot est en mémoire à la fois. Au-delà de MAX_RUNS
+lots, ils sont compactés en un seul, tranche par tranche.
+
+Les colonnes de tuiles calculées pour chaque tranche sont ajoutées à un
+ColumnSpool, d'où la carte finale est écrite en flux (voir
+generate_square_map.process_multiple_netcdf, option --spill).
+"""
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from metrics import stage
+from square_grid import pack_keys, unpack_keys
+from square_stats import SeriesVarStats, VarStats, merge_var_stats
+
+# Nombre de lots au-delà duquel ils sont compactés en un seul
+MAX_RUNS = 8
+# Nombre approximatif de cellules par tranche de fusion
+CHUNK_CELLS = 1 << 20
+
+INDEX_NAME = 'index.json'
+# Champs des agrégats qui ne sont pas des tableaux alignés sur les clés
+SHARED_FIELDS = ('labels', 'edges')
+
+
+class ArraySpool:
+    """
+    Tableaux nommés écrits par morceaux, concaténés sur le premier axe
+
+    Chaque tableau est un fichier brut <nom>.bin ; index.json garde son
+    type, sa forme et des métadonnées libres. Les tableaux sont relus en
+    mémoire mappée (open_arrays) ou par tranches de lignes (read_rows).
+
+    Args:
+        path: Dossier du spool (créé)
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.arrays = {}
+        self.meta = {}
+
+    def append(self, arrays):
+        """Ajoute un morceau {nom: tableau} à la suite des précédents"""
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            spec = self.arrays.get(name)
+            if spec is None:
+                spec = self.arrays[name] = {'dtype': array.dtype.str, 'shape': [0, *array.shape[1:]]}
+                (self.path / f"{name}.bin").parent.mkdir(parents=True, exist_ok=True)
+            elif array.dtype.str != spec['dtype'] or list(array.shape[1:]) != spec['shape'][1:]:
+                raise ValueError(f"❌ Morceau incompatible pour {name}: {array.dtype}{array.shape}")
+            with open(self.path / f"{name}.bin", 'ab') as f:
+                f.write(array.tobytes())
+            spec['shape'][0] += len(array)
+
+    def close(self):
+        """Écrit index.json (à appeler après le dernier morceau)"""
+        with open(self.path / INDEX_NAME, 'w') as f:
+            json.dump({'arrays': self.arrays, 'meta': self.meta}, f)
+
+
+def open_arrays(path):
+    """
+    Relit un ArraySpool fermé
+
+    Returns:
+        tuple: ({nom: tableau en lecture seule mappé}, métadonnées)
+    """
+    path = Path(path)
+    index = _read_index(path)
+    arrays = {name: _map_array(path, name, spec) for name, spec in index['arrays'].items()}
+    return arrays, index['meta']
+
+
+def _read_index(path):
+    with open(Path(path) / INDEX_NAME) as f:
+        return json.load(f)
+
+
+def _map_array(path, name, spec):
+    shape = tuple(spec['shape'])
+    if shape[0] == 0:
+        return np.zeros(shape, dtype=spec['dtype'])
+    return np.memmap(Path(path) / f"{name}.bin", dtype=spec['dtype'], mode='r', shape=shape)
+
+
+def read_rows(path, name, spec, start, stop):
+    """
+    Lit les lignes [start, stop[ d'un tableau d'un ArraySpool fermé
+
+    Lecture explicite plutôt que mappée : les pages lues ne restent pas
+    attachées au processus une fois la tranche traitée.
+    """
+    dtype = np.dtype(spec['dtype'])
+    row_shape = tuple(spec['shape'][1:])
+    row_size = int(np.prod(row_shape, dtype=np.int64))
+    with open(Path(path) / f"{name}.bin", 'rb') as f:
+        values = np.fromfile(f, dtype=dtype, count=(stop - start) * row_size,
+                             offset=start * row_size * dtype.itemsize)
+    return values.reshape(stop - start, *row_shape)
+
+
+def _write_run(path, stats_by_var):
+    spool = ArraySpool(path)
+    for var, stats in stats_by_var.items():
+        _append_stats(spool, var, stats)
+    spool.close()
+
+
+def _append_stats(spool, var, stats):
+    spool.append({f"{var}/{field}": getattr(stats, field) for field in type(stats).fields()
+                  if field not in SHARED_FIELDS and getattr(stats, field) is not None})
+    spool.meta.setdefault(var, {
+        'series': isinstance(stats, SeriesVarStats),
+        **{field: np.asarray(getattr(stats, field)).tolist() for field in SHARED_FIELDS
+           if getattr(stats, field, None) is not None}
+    })
+
+
+class StoredStats:
+    """
+    Agrégat d'une variable dans un lot, lu par tranches de cellules
+
+    Attributes:
+        keys: Clés triées (mappées en mémoire, pour les recherches)
+        labels: Périodes si l'agrégat a une série, None sinon
+    """
+
+    def __init__(self, path, var, info, specs):
+        self.path = Path(path)
+        self.var = var
+        self.specs = {name.rsplit('/', 1)[1]: spec for name, spec in specs.items()
+                      if name.rsplit('/', 1)[0] == var}
+        self.keys = _map_array(path, f"{var}/keys", self.specs['keys'])
+        self.labels = np.asarray(info['labels'], dtype=str) if info['series'] else None
+        self.edges = np.asarray(info['edges'], dtype=np.float64) if 'edges' in info else None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def rows(self, start, stop):
+        """VarStats (ou SeriesVarStats) des cellules [start, stop[ du lot"""
+        fields = {field: read_rows(self.path, f"{self.var}/{field}", spec, start, stop)
+                  for field, spec in self.specs.items()}
+        if self.labels is not None:
+            return SeriesVarStats(labels=self.labels, edges=self.edges, **fields)
+        return VarStats(edges=self.edges, **fields)
+
+
+def _read_run(path):
+    index = _read_index(path)
+    return {var: StoredStats(path, var, info, index['arrays']) for var, info in index['meta'].items()}
+
+
+def _align_series(stats, labels):
+    """SeriesVarStats dont les périodes sont exactement labels (périodes absentes à 0)"""
+    if isinstance(stats, SeriesVarStats) and np.array_equal(stats.labels, labels):
+        return stats
+    shape = (len(stats), len(labels))
+    series_sum = np.zeros(shape)
+    series_count = np.zeros(shape)
+    if isinstance(stats, SeriesVarStats):
+        columns = np.searchsorted(labels, stats.labels)
+        series_sum[:, columns] = stats.series_sum
+        series_count[:, columns] = stats.series_count
+    return SeriesVarStats.from_base(stats, labels, series_sum, series_count)
+
+
+class SpillStore:
+    """
+    Agrégats partiels {variable: VarStats} accumulés sur disque
+
+    S'utilise comme gestionnaire de contexte : le dossier est supprimé à la
+    sortie du bloc `with`.
+
+    Args:
+        root: Dossier du store (créé, doit être propre à cette construction)
+        max_runs: Nombre de lots au-delà duquel ils sont compactés
+        chunk_cells: Nombre approximatif de cellules par tranche de fusion
+    """
+
+    def __init__(self, root, max_runs=MAX_RUNS, chunk_cells=CHUNK_CELLS):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_runs = max(2, max_runs)
+        self.chunk_cells = max(1, chunk_cells)
+        self.runs = []
+        self._next_run = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _run_path(self):
+        self._next_run += 1
+        return self.root / f"run_{self._next_run:06d}"
+
+    def add(self, stats_by_var):
+        """
+        Ajoute un lot d'agrégats (fusionné aux précédents à la lecture)
+
+        Args:
+            stats_by_var: dict {variable: VarStats}, ex: résultat d'un fichier
+        """
+        path = self._run_path()
+        _write_run(path, stats_by_var)
+        self.runs.append(path)
+        if len(self.runs) > self.max_runs:
+            self.compact()
+
+    def compact(self):
+        """Fusionne tous les lots en un seul, tranche par tranche"""
+        if len(self.runs) < 2:
+            return
+        path = self._run_path()
+        spool = ArraySpool(path)
+        for chunk in self.chunks():
+            for var, stats in chunk.items():
+                _append_stats(spool, var, stats)
+        spool.close()
+        for old in self.runs:
+            shutil.rmtree(old, ignore_errors=True)
+        self.runs = [path]
+
+    @property
+    def variables(self):
+        """Variables présentes dans au moins un lot, triées"""
+        return sorted({var for path in self.runs for var in _read_index(path)['meta']})
+
+    def _boundaries(self, runs, align):
+        # Colonnes x de début de tranche, multiples de align : une cellule
+        # parente (coarsen) ne chevauche jamais deux tranches
+        keys = [stats.keys for run in runs for stats in run.values() if len(stats)]
+        if not keys:
+            return np.zeros(0, dtype=np.int64)
+        first = min(unpack_keys(k[0])[0] for k in keys)
+        last = max(unpack_keys(k[-1])[0] for k in keys)
+        largest = max(keys, key=len)
+        xs, _ = unpack_keys(np.asarray(largest[::self.chunk_cells]))
+        starts = np.unique(np.concatenate([[first], xs]) // align * align)
+        return np.append(starts, last // align * align + align)
+
+    def chunks(self, align=1):
+        """
+        Agrégats fusionnés de tous les lots, par tranches de colonnes x
+
+        Chaque tranche contient toutes les variables (éventuellement sans
+        cellule) ; les séries d'une variable ont les mêmes périodes dans
+        toutes les tranches.
+
+        Args:
+            align: Les tranches commencent à une colonne multiple de align
+                   (2 ** niveaux de pyramide pour pouvoir agréger chaque
+                   tranche indépendamment)
+
+        Yields:
+            dict: {variable: VarStats} de la tranche, clés triées
+        """
+        runs = [_read_run(path) for path in self.runs]
+        variables = sorted({var for run in runs for var in run})
+        labels = {}
+        for var in variables:
+            series = [run[var].labels for run in runs if var in run and run[var].labels is not None]
+            if series:
+                labels[var] = np.unique(np.concatenate(series))
+
+        boundaries = pack_keys(self._boundaries(runs, align), -(1 << 31))
+        for low, high in zip(boundaries[:-1], boundaries[1:]):
+            chunk = {}
+            with stage('merge'):
+                for var in variables:
+                    parts = [run[var].rows(*np.searchsorted(run[var].keys, [low, high]))
+                             for run in runs if var in run]
+                    filled = [part for part in parts if len(part)]
+                    stats = merge_var_stats(filled) if filled else parts[0]
+                    chunk[var] = _align_series(stats, labels[var]) if var in labels else stats
+            if any(len(stats) for stats in chunk.values()):
+                yield chunk
+
+
+class ColumnSpool:
+    """
+    Colonnes de tuiles (format de square_stats.tile_columns) écrites par
+    tranches successives
+
+    Args:
+        path: Dossier du spool (créé)
+    """
+
+    def __init__(self, path):
+        self.spool = ArraySpool(path)
+        self.tile_count = 0
+
+    def append(self, columns):
+        """Ajoute les tuiles d'une tranche (toujours les mêmes colonnes)"""
+        arrays = {name: columns[name] for name in ('x', 'y', 'count', 'lat', 'lon')}
+        for var, var_columns in columns['variables'].items():
+            arrays.update({f"variables/{var}/{field}": values for field, values in var_columns.items()})
+        if 'biomes' in columns:
+            arrays.update({f"biomes/{field}": columns['biomes'][field] for field in ('index', 'score')})
+        self.spool.append(arrays)
+        self.tile_count += len(columns['x'])
+        self.spool.meta.setdefault('series_labels', columns.get('series_labels', {}))
+        self.spool.meta.setdefault('histogram_edges', columns.get('histogram_edges', {}))
+        if 'biomes' in columns:
+            self.spool.meta.setdefault('biome_names', columns['biomes']['names'])
+
+    def columns(self):
+        """
+        Colonnes de toutes les tranches, en mémoire mappée
+
+        Returns:
+            dict: Colonnes au format de square_stats.tile_columns
+        """
+        self.spool.close()
+        arrays, meta = open_arrays(self.spool.path)
+        columns = {name: arrays.get(name, np.zeros(0)) for name in ('x', 'y', 'count', 'lat', 'lon')}
+        columns['variables'] = {}
+        for name, values in arrays.items():
+            if name.startswith('variables/'):
+                var, field = name[len('variables/'):].rsplit('/', 1)
+                columns['variables'].setdefault(var, {})[field] = values
+        columns['series_labels'] = meta.get('series_labels', {})
+        columns['histogram_edges'] = meta.get('histogram_edges', {})
+        if 'biome_names' in meta:
+            columns['biomes'] = {'names': meta['biome_names'],
+                                 **{field: arrays[f"biomes/{field}"] for field in ('index', 'score')}}
+        return columns
@@ -0,0 +1,168 @@
+"""
+Index de la grille carrée : clés de tuiles et conversions vectorisées
+
+Une tuile (x, y) couvre [x * size, (x + 1) * size[ en longitude et
+[y * size, (y + 1) * size[ en latitude. Elle est identifiée par :
+    - sa clé int64 (pack_keys) : x sur les 32 bits de poids fort, y décalé
+      de 2**31 sur les 32 bits de poids faible, si bien que l'ordre des
+      clés est l'ordre (x, y)
+    - sa coordonnée texte "x,y", utilisée dans game_map.json
+
+Toutes les fonctions acceptent des scalaires ou des tableaux NumPy.
+"""
+import numpy as np
+
+# Décalage appliqué à y pour que les clés restent triées par (x, y)
+_Y_OFFSET = 1 << 31
+
+# Décalages (dx, dy) des 8 voisins, dans le sens horaire depuis le nord
+NEIGHBOR_OFFSETS = ((0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1))
+
+
+def square_indices(values, size):
+    """
+    Convertit un tableau de latitudes ou longitudes en indices de cellule
+
+    Args:
+        values: Tableau de coordonnées en degrés
+        size: Taille de la cellule en degrés
+
+    Returns:
+        np.ndarray: Indices entiers (int64)
+    """
+    return np.floor(np.asarray(values, dtype=np.float64) / size).astype(np.int64)
+
+
+def normalize_lon(lon, positive):
+    """
+    Ramène une longitude dans une convention donnée
+
+    Args:
+        lon: Longitude en degrés
+        positive: True pour la convention 0-360, False pour -180-180
+    """
+    if positive:
+        wrapped = lon % 360
+        return 360.0 if wrapped == 0 and lon > 0 else wrapped
+    wrapped = (lon + 180) % 360 - 180
+    return 180.0 if wrapped == -180 and lon > 0 else wrapped
+
+
+def pack_keys(x, y):
+    """Encode des coordonnées de cellule (x, y) en clés int64 triables"""
+    return (np.asarray(x, dtype=np.int64) << 32) + (np.asarray(y, dtype=np.int64) + _Y_OFFSET)
+
+
+def unpack_keys(keys):
+    """Décode des clés int64 en coordonnées de cellule (x, y)"""
+    keys = np.asarray(keys, dtype=np.int64)
+    return keys >> 32, (keys & 0xFFFFFFFF) - _Y_OFFSET
+
+
+def latlon_to_keys(lat, lon, size):
+    """
+    Clés des tuiles contenant des points lat/lon
+
+    Args:
+        lat, lon: Coordonnées en degrés (scalaires ou tableaux)
+        size: Taille des cellules en degrés
+
+    Returns:
+        np.ndarray: Clés int64
+    """
+    return pack_keys(square_indices(lon, size), square_indices(lat, size))
+
+
+def format_keys(keys):
+    """Coordonnées texte "x,y" de clés de tuiles (liste de str)"""
+    x, y = unpack_keys(np.atleast_1d(keys))
+    return [f"{i},{j}" for i, j in zip(x.tolist(), y.tolist())]
+
+
+def parse_coords(coords):
+    """
+    Clés de tuiles à partir de coordonnées texte "x,y"
+
+    Raises:
+        ValueError: si une coordonnée n'est pas de la forme "x,y"
+    """
+    xy = np.array([coord.split(',') for coord in coords], dtype=np.int64).reshape(-1, 2)
+    return pack_keys(xy[:, 0], xy[:, 1])
+
+
+def tile_bounds(keys, size):
+    """
+    Emprise des tuiles
+
+    Returns:
+        tuple: (lat_min, lat_max, lon_min, lon_max), tableaux en degrés
+    """
+    x, y = unpack_keys(keys)
+    return y * size, (y + 1) * size, x * size, (x + 1) * size
+
+
+def tile_centers(keys, size):
+    """
+    Centre géométrique des tuiles (le centroïde des données valides est
+    dans 'lat'/'lon' des tuiles)
+
+    Returns:
+        tuple: (lat, lon), tableaux en degrés
+    """
+    x, y = unpack_keys(keys)
+    return (y + 0.5) * size, (x + 0.5) * size
+
+
+def neighbors(keys, diagonal=True, wrap_columns=None, first_column=0):
+    """
+    Clés des tuiles voisines
+
+    Args:
+        keys: Clés des tuiles
+        diagonal: 8 voisins si True, 4 (N, E, S, O) sinon
+        wrap_columns: Nombre de colonnes faisant le tour de la Terre
+                      (round(360 / size)) pour raccorder les longitudes,
+                      None = pas de raccord
+        first_column: Indice x de la première colonne quand wrap_columns
+                      est donné (0 en 0-360, -wrap_columns // 2 en ±180)
+
+    Returns:
+        np.ndarray: Clés (tuiles, voisins), voisins dans l'ordre de
+                    NEIGHBOR_OFFSETS (sans les diagonales si diagonal=False)
+    """
+    offsets = np.array(NEIGHBOR_OFFSETS if diagonal else NEIGHBOR_OFFSETS[::2])
+    x, y = unpack_keys(np.atleast_1d(keys))
+    nx = x[:, None] + offsets[:, 0]
+    ny = y[:, None] + offsets[:, 1]
+    if wrap_columns:
+        nx = (nx - first_column) % wrap_columns + first_column
+    return pack_keys(nx, ny)
+
+
+def _spread_bits(values):
+    # Intercale des zéros entre les 32 bits de poids faible (Morton)
+    v = values.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def morton_codes(keys):
+    """Codes de la courbe en Z (Morton) des tuiles, en uint64"""
+    x, y = unpack_keys(keys)
+    return _spread_bits(x + _Y_OFFSET) | (_spread_bits(y + _Y_OFFSET) << np.uint64(1))
+
+
+def curve_order(keys):
+    """
+    Ordre de parcours des tuiles le long de la courbe en Z
+
+    Les tuiles proches dans l'espace restent proches dans cet ordre, ce qui
+    garde un parcours par blocs (cache, pagination, envoi par paquets)
+    local en x comme en y.
+
+    Returns:
+        np.ndarray: Indices qui trient `keys` selon la courbe
+    """
+    return np.argsort(morton_codes(keys), kind='stable')
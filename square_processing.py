@@ -0,0 +1,129 @@
+"""
+Traitement d'un Dataset NetCDF envoyé au backend
+
+Partagé par la route synchrone /process et par les workers de la file de
+jobs (jobs.py), qui l'exécutent dans des processus séparés. La réponse peut
+aussi être produite en NDJSON (iter_ndjson), tuile par tuile.
+"""
+import json
+
+from metrics import stage
+from netcdf_io import find_lat_lon, subset_dataset
+from square_grid import curve_order, pack_keys
+from square_stats import aggregate_grid, histogram_edges, iter_tiles, take_columns, tile_columns, tiles_from_columns
+
+NDJSON_CHUNK_SIZE = 2048
+
+
+class CoordinatesNotFound(ValueError):
+    """Le Dataset n'a pas de coordonnées lat/lon reconnues"""
+
+
+def aggregate_dataset(ds, cell_size, variables=None, bbox=None, time_range=None, progress=None, histograms=None):
+    """
+    Agrège la première période d'un Dataset sur la grille carrée, sans
+    construire le dictionnaire de tuiles
+
+    Args:
+        ds: Dataset ouvert
+        cell_size: Taille des cellules en degrés
+        variables: Liste des variables (None ou [''] = toutes les variables 2D+)
+        bbox: (lat_min, lat_max, lon_min, lon_max) à lire, ou None
+        time_range: (début, fin) à lire, ou None
+        progress: Fonction appelée avec la fraction de variables traitées
+        histograms: {variable: [min, max, classes]} des variables avec
+                    histogramme et percentiles (voir square_stats.parse_histograms)
+
+    Returns:
+        tuple: (colonnes au format de tile_columns, variables, metadata)
+    """
+    lat_var, lon_var = find_lat_lon(ds)
+
+    if not lat_var or not lon_var:
+        raise CoordinatesNotFound(f'Coordonnées non trouvées. Variables: {list(ds.coords.keys())}')
+
+    # Sous-ensemble appliqué avant toute lecture de valeurs
+    ds = subset_dataset(ds, lat_var, lon_var, bbox, time_range)
+
+    if not variables or variables == ['']:
+        variables = [var for var in ds.data_vars if len(ds[var].dims) >= 2]
+
+    lats = ds[lat_var].values
+    lons = ds[lon_var].values
+
+    stats_by_var = {}
+    for n, var in enumerate(variables, 1):
+        if var in ds.variables and len(ds[var].dims) >= 2:
+            # Première période uniquement : on ne lit que la tranche utile
+            field = ds[var]
+            if len(field.dims) > 2:
+                field = field.isel({dim: 0 for dim in field.dims[:-2]})
+
+            with stage('variable_read'):
+                values = field.values
+            stats_by_var[var] = aggregate_grid(values, lats, lons, cell_size,
+                                               histogram_edges((histograms or {}).get(var)))
+
+        if progress:
+            progress(n / len(variables))
+
+    with stage('tile_build'):
+        columns = tile_columns(stats_by_var)
+
+    metadata = {
+        'tile_count': len(columns['x']),
+        'cell_size': cell_size,
+        'grid_type': 'square'
+    }
+    if bbox:
+        metadata['bbox'] = list(bbox)
+    if time_range:
+        metadata['time_range'] = list(time_range)
+    if columns['histogram_edges']:
+        metadata['histogram_edges'] = columns['histogram_edges']
+
+    return columns, variables, metadata
+
+
+def process_dataset(ds, cell_size, variables=None, bbox=None, time_range=None, progress=None, histograms=None):
+    """
+    Agrège la première période d'un Dataset sur la grille carrée
+
+    Args: voir aggregate_dataset
+
+    Returns:
+        dict: Réponse de /process {'tiles', 'variables', 'metadata'}
+    """
+    columns, variables, metadata = aggregate_dataset(ds, cell_size, variables, bbox, time_range, progress, histograms)
+
+    with stage('tile_build'):
+        square_grid = tiles_from_columns(columns, include_var_count=False, empty_value=[])
+
+    return {
+        'tiles': square_grid,
+        'variables': variables,
+        'metadata': metadata
+    }
+
+
+def iter_ndjson(columns, variables, metadata, chunk_size=NDJSON_CHUNK_SIZE):
+    """
+    Encode la réponse de /process en NDJSON, paquet par paquet
+
+    La première ligne contient {'metadata', 'variables'}, puis chaque ligne
+    une tuile {'coord': "x,y", 'tile': {...}} (même contenu que 'tiles'
+    dans la réponse JSON). Seul un paquet de tuiles est encodé à la fois.
+    Les tuiles sont envoyées le long de la courbe en Z : chaque paquet
+    couvre une zone compacte, que le client peut afficher d'un bloc.
+
+    Yields:
+        bytes: Lignes encodées (terminées par un saut de ligne)
+    """
+    yield json.dumps({'metadata': metadata, 'variables': variables}, sort_keys=True).encode('utf-8') + b'\n'
+
+    columns = take_columns(columns, curve_order(pack_keys(columns['x'], columns['y'])))
+    for tiles in iter_tiles(columns, include_var_count=False, empty_value=[], chunk_size=chunk_size):
+        with stage('serialization'):
+            lines = ''.join(json.dumps({'coord': coord, 'tile': tile}, sort_keys=True) + '\n'
+                            for coord, tile in tiles.items())
+        yield lines.encode('utf-8')
@@ -0,0 +1,920 @@
+"""
+Moteur d'agrégation vectorisé pour les grilles carrées
+
+Les statistiques par cellule sont calculées en quelques réductions NumPy
+groupées (bincount / ufunc.at) au lieu d'une boucle Python par pixel, et
+conservées sous forme d'agrégats partiels fusionnables :
+count, sum, m2 (somme des carrés des écarts à la moyenne), min, max,
+plus les sommes de lat/lon des points valides pour le centroïde.
+
+Une variable peut en plus avoir un histogramme par cellule sur des classes
+fixes (voir parse_histograms) : de taille constante, il s'additionne entre
+blocs, fichiers et niveaux de pyramide, et donne des percentiles approchés
+(p10/p50/p90) sans conserver les valeurs brutes.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from metrics import stage
+from square_grid import pack_keys, square_indices, unpack_keys
+
+PERCENTILES = (10, 50, 90)
+PERCENTILE_FIELDS = tuple(f"p{q}" for q in PERCENTILES)
+HISTOGRAM_BINS = 32
+
+
+class VarStats:
+    """
+    Agrégats partiels d'une variable sur un ensemble de cellules
+
+    Tous les tableaux sont alignés sur `keys` (clés int64 triées). Une
+    cellule peut avoir count == 0 : elle a été couverte par la grille mais
+    ne contenait que des NaN.
+
+    Avec histogramme, `edges` contient les bornes des classes et `hist` le
+    nombre de valeurs par (cellule, classe) ; les valeurs hors des bornes
+    comptent dans la première ou la dernière classe. Sinon, les deux valent
+    None.
+    """
+
+    __slots__ = ('keys', 'count', 'sum', 'm2', 'min', 'max', 'lat_sum', 'lon_sum', 'edges', 'hist')
+
+    def __init__(self, keys, count, sum, m2, min, max, lat_sum, lon_sum, edges=None, hist=None):
+        self.keys = keys
+        self.count = count
+        self.sum = sum
+        self.m2 = m2
+        self.min = min
+        self.max = max
+        self.lat_sum = lat_sum
+        self.lon_sum = lon_sum
+        self.edges = edges
+        self.hist = hist
+
+    @classmethod
+    def empty(cls):
+        zeros = np.zeros(0, dtype=np.float64)
+        return cls(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                   zeros, zeros, zeros, zeros, zeros, zeros)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def fields(cls):
+        """Noms de tous les tableaux de l'agrégat (classes parentes comprises)"""
+        return tuple(name for klass in reversed(cls.__mro__) for name in getattr(klass, '__slots__', ()))
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.fields() if getattr(self, name) is not None)
+
+    def mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum / self.count
+
+    def std(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(self.m2 / self.count)
+
+    def percentiles(self, qs=PERCENTILES):
+        """
+        Percentiles approchés tirés de l'histogramme
+
+        Interpolation linéaire dans la classe qui contient le rang cherché,
+        bornée par le min et le max exacts de la cellule : l'erreur est au
+        plus la largeur d'une classe.
+
+        Args:
+            qs: Percentiles voulus, dans ]0, 100]
+
+        Returns:
+            np.ndarray: (cellules, len(qs)), NaN pour une cellule sans valeur
+        """
+        n, bins = self.hist.shape
+        total = self.hist.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.cumsum(self.hist, axis=1) / total[:, None]
+        # Fractions cumulées de toutes les cellules à la suite, décalées de 2
+        # par cellule : une seule recherche dichotomique pour toutes
+        offsets = 2.0 * np.arange(n)
+        flat = (np.nan_to_num(fraction, nan=1.0) + offsets[:, None]).ravel()
+        rows = np.arange(n)
+
+        result = np.full((n, len(qs)), np.nan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for j, q in enumerate(qs):
+                target = q / 100.0
+                index = np.minimum(np.searchsorted(flat, offsets + target) - rows * bins, bins - 1)
+                before = np.where(index > 0, fraction[rows, np.maximum(index - 1, 0)], 0.0)
+                within = (target - before) / (fraction[rows, index] - before)
+                value = self.edges[index] + within * (self.edges[index + 1] - self.edges[index])
+                result[:, j] = np.where(total > 0, np.clip(value, self.min, self.max), np.nan)
+        return result
+
+    @classmethod
+    def merge(cls, parts):
+        """
+        Fusionne plusieurs agrégats partiels en un seul (formule de Chan)
+
+        Args:
+            parts: Liste de VarStats
+
+        Returns:
+            VarStats: Agrégat couvrant l'union des cellules
+        """
+        parts = [p for p in parts if len(p)]
+        if not parts:
+            return cls.empty()
+        if len(parts) == 1:
+            return parts[0]
+        return cls._combine(np.concatenate([p.keys for p in parts]), parts)
+
+    def coarsen(self, factor):
+        """
+        Agrège les cellules par blocs de factor x factor (niveau plus grossier)
+
+        Les statistiques parentes sont obtenues en fusionnant les agrégats des
+        cellules enfants, sans relire les pixels.
+        """
+        x, y = unpack_keys(self.keys)
+        return VarStats._combine(pack_keys(x // factor, y // factor), [self])
+
+    @classmethod
+    def _combine(cls, part_keys, parts):
+        """Fusionne les entrées de parts regroupées selon part_keys (alignées)"""
+        keys, inverse = np.unique(part_keys, return_inverse=True)
+        n = len(keys)
+
+        def cat(name):
+            return np.concatenate([getattr(p, name) for p in parts])
+
+        part_count = cat('count')
+        part_sum = cat('sum')
+        count = np.bincount(inverse, weights=part_count, minlength=n).astype(np.int64)
+        total = np.bincount(inverse, weights=part_sum, minlength=n)
+
+        mean = total / np.maximum(count, 1)
+        part_mean = part_sum / np.maximum(part_count, 1)
+        m2 = np.bincount(inverse, weights=cat('m2') + part_count * (part_mean - mean[inverse]) ** 2,
+                         minlength=n)
+
+        minimum = np.full(n, np.inf)
+        np.minimum.at(minimum, inverse, cat('min'))
+        maximum = np.full(n, -np.inf)
+        np.maximum.at(maximum, inverse, cat('max'))
+
+        edges, hist = _combine_histograms(inverse, n, parts)
+        return cls(keys, count, total, m2, minimum, maximum,
+                   np.bincount(inverse, weights=cat('lat_sum'), minlength=n),
+                   np.bincount(inverse, weights=cat('lon_sum'), minlength=n), edges, hist)
+
+
+def _combine_histograms(inverse, n, parts):
+    """Additionne les histogrammes de parts regroupés selon inverse (voir _combine)"""
+    with_hist = [p for p in parts if p.hist is not None]
+    if not with_hist:
+        return None, None
+    edges = with_hist[0].edges
+    if any(not np.array_equal(p.edges, edges) for p in with_hist):
+        raise ValueError("❌ Histogrammes de classes différentes : impossible de les fusionner")
+
+    bins = len(edges) - 1
+    hist = np.zeros(n * bins)
+    start = 0
+    for p in parts:
+        if p.hist is not None:
+            flat = (inverse[start:start + len(p)][:, None] * bins + np.arange(bins)).ravel()
+            hist += np.bincount(flat, weights=p.hist.ravel(), minlength=n * bins)
+        start += len(p)
+    return edges, hist.astype(np.int64).reshape(n, bins)
+
+
+class SeriesVarStats(VarStats):
+    """
+    Agrégats partiels d'une variable, avec une série temporelle par cellule
+
+    En plus des statistiques globales de VarStats, conserve pour chaque
+    cellule la somme et le nombre de valeurs de chaque période (`labels`,
+    triés). Les séries restent ainsi fusionnables entre fichiers, blocs et
+    niveaux de pyramide.
+
+    series_sum et series_count ont la forme (cellules, périodes).
+    """
+
+    __slots__ = ('labels', 'series_sum', 'series_count')
+
+    def __init__(self, keys, count, sum, m2, min, max, lat_sum, lon_sum, labels, series_sum, series_count,
+                 edges=None, hist=None):
+        super().__init__(keys, count, sum, m2, min, max, lat_sum, lon_sum, edges, hist)
+        self.labels = labels
+        self.series_sum = series_sum
+        self.series_count = series_count
+
+    @classmethod
+    def from_base(cls, base, labels, series_sum, series_count):
+        return cls(**{name: getattr(base, name) for name in VarStats.__slots__},
+                   labels=labels, series_sum=series_sum, series_count=series_count)
+
+    def series_mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.series_sum / self.series_count
+
+    @classmethod
+    def merge(cls, parts):
+        """Fusionne des agrégats (les VarStats sans série sont acceptés)"""
+        parts = [p for p in parts if len(p)]
+        if len(parts) == 1 and isinstance(parts[0], SeriesVarStats):
+            return parts[0]
+        base = VarStats.merge(parts)
+        series_parts = [p for p in parts if isinstance(p, SeriesVarStats)]
+
+        labels = np.unique(np.concatenate([p.labels for p in series_parts] or [np.zeros(0, dtype=str)]))
+        size = len(base) * len(labels)
+        series_sum = np.zeros(size)
+        series_count = np.zeros(size)
+        for p in series_parts:
+            flat = (np.searchsorted(base.keys, p.keys)[:, None] * len(labels)
+                    + np.searchsorted(labels, p.labels)[None, :]).ravel()
+            series_sum += np.bincount(flat, weights=p.series_sum.ravel(), minlength=size)
+            series_count += np.bincount(flat, weights=p.series_count.ravel(), minlength=size)
+
+        shape = (len(base), len(labels))
+        return cls.from_base(base, labels, series_sum.reshape(shape), series_count.reshape(shape))
+
+    def coarsen(self, factor):
+        base = VarStats.coarsen(self, factor)
+        x, y = unpack_keys(self.keys)
+        parents = np.searchsorted(base.keys, pack_keys(x // factor, y // factor))
+        series_sum = np.zeros((len(base), len(self.labels)))
+        series_count = np.zeros((len(base), len(self.labels)))
+        np.add.at(series_sum, parents, self.series_sum)
+        np.add.at(series_count, parents, self.series_count)
+        return SeriesVarStats.from_base(base, self.labels, series_sum, series_count)
+
+    def rolling(self, window):
+        """
+        Remplace chaque période par la fenêtre glissante des `window`
+        périodes qui la terminent (les labels doivent être chronologiques)
+        """
+        def windowed(values):
+            cumulative = np.cumsum(values, axis=1)
+            shifted = np.zeros_like(cumulative)
+            shifted[:, window:] = cumulative[:, :-window]
+            return cumulative - shifted
+
+        return SeriesVarStats.from_base(self, self.labels, windowed(self.series_sum), windowed(self.series_count))
+
+
+def merge_var_stats(parts):
+    """Fusionne des agrégats d'une même variable, avec ou sans série"""
+    if any(isinstance(p, SeriesVarStats) for p in parts):
+        return SeriesVarStats.merge(parts)
+    return VarStats.merge(parts)
+
+
+SEASONS = np.array(['DJF', 'DJF', 'MAM', 'MAM', 'MAM', 'JJA', 'JJA', 'JJA', 'SON', 'SON', 'SON', 'DJF'])
+
+
+def time_labels(times, freq='step'):
+    """
+    Étiquette de période de chaque pas de temps
+
+    Args:
+        times: Valeurs de la coordonnée temporelle
+        freq: 'step' (chaque pas), 'month' (AAAA-MM) ou 'season'
+              (saison climatologique DJF/MAM/JJA/SON)
+
+    Returns:
+        np.ndarray: Étiquettes (chaînes), triables chronologiquement
+                    pour 'step' et 'month'
+    """
+    times = np.asarray(times)
+    is_datetime = np.issubdtype(times.dtype, np.datetime64)
+
+    if freq == 'step':
+        if is_datetime:
+            return np.datetime_as_string(times, unit='s')
+        return np.array([f"{int(t):010d}" if float(t).is_integer() else str(t) for t in times])
+
+    if not is_datetime:
+        raise ValueError(f"❌ Fréquence '{freq}' impossible sans coordonnée temporelle datée")
+    if freq == 'month':
+        return np.datetime_as_string(times.astype('datetime64[M]'), unit='M')
+    if freq == 'season':
+        months = times.astype('datetime64[M]').astype(np.int64) % 12
+        return SEASONS[months]
+    raise ValueError(f"❌ Fréquence inconnue: {freq} (step, month, season)")
+
+
+def save_stats(path, stats_by_var):
+    """
+    Sauvegarde un dict {variable: VarStats} dans un fichier .npz
+
+    Args:
+        path: Chemin du fichier (ou objet fichier)
+        stats_by_var: dict {variable: VarStats}
+    """
+    np.savez(path, **{
+        f"{var}/{field}": getattr(stats, field)
+        for var, stats in stats_by_var.items()
+        for field in type(stats).fields()
+        if getattr(stats, field) is not None
+    })
+
+
+def load_stats(path):
+    """
+    Recharge un dict {variable: VarStats} sauvegardé par save_stats
+    """
+    with np.load(path) as archive:
+        fields = {}
+        for name in archive.files:
+            var, field = name.rsplit('/', 1)
+            fields.setdefault(var, {})[field] = archive[name]
+    return {var: (SeriesVarStats if 'labels' in values else VarStats)(**values)
+            for var, values in fields.items()}
+
+
+def merge_stats_dicts(a, b):
+    """Fusionne deux dict {variable: VarStats}"""
+    merged = dict(a)
+    for var, stats in b.items():
+        merged[var] = merge_var_stats([merged[var], stats]) if var in merged else stats
+    return merged
+
+
+def tree_reduce(items, combine):
+    """
+    Réduit une liste par fusions deux à deux (arbre équilibré)
+
+    Chaque niveau fusionne des agrégats de taille comparable, ce qui évite
+    de refusionner sans cesse un accumulateur qui grossit.
+    """
+    items = list(items)
+    if not items:
+        return None
+    while len(items) > 1:
+        paired = [combine(items[i], items[i + 1]) for i in range(0, len(items) - 1, 2)]
+        if len(items) % 2:
+            paired.append(items[-1])
+        items = paired
+    return items[0]
+
+
+def _merge_band(target, part, first, shape):
+    """
+    Fusionne en place (formule de Chan) l'agrégat d'une bande de lignes de
+    cellules dans l'agrégat de toute la grille
+
+    Args:
+        target: VarStats sur toutes les cellules de la grille
+        part: VarStats sur les lignes first.. de chaque colonne (reduce_pixels)
+        first: Indice de la première ligne de cellules de la bande
+        shape: (colonnes, lignes) de cellules de la grille
+    """
+    columns, rows = shape
+    band = len(part) // columns
+
+    def view(values):
+        return values.reshape(columns, rows, *values.shape[1:])[:, first:first + band]
+
+    def part_view(values):
+        return values.reshape(columns, band, *values.shape[1:])
+
+    count, total, m2 = view(target.count), view(target.sum), view(target.m2)
+    part_count, part_sum = part_view(part.count), part_view(part.sum)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = np.where((count > 0) & (part_count > 0), part_sum / part_count - total / count, 0.0)
+        merged_count = count + part_count
+        m2 += part_view(part.m2) + delta ** 2 * np.where(merged_count > 0, count * part_count / merged_count, 0.0)
+    count += part_count
+    total += part_sum
+    np.minimum(view(target.min), part_view(part.min), out=view(target.min))
+    np.maximum(view(target.max), part_view(part.max), out=view(target.max))
+    view(target.lat_sum)[...] += part_view(part.lat_sum)
+    view(target.lon_sum)[...] += part_view(part.lon_sum)
+    if target.hist is not None:
+        view(target.hist)[...] += part_view(part.hist)
+
+
+# Nombre de grilles dont l'affectation pixel -> cellule reste en mémoire
+CELL_INDEX_CACHE_SIZE = 4
+
+
+class CellIndex:
+    """
+    Affectation pixel -> cellule d'une grille régulière lat/lon
+
+    Calculée une seule fois par (latitudes, longitudes, taille de cellule)
+    et partagée par toutes les variables et tous les fichiers de la même
+    grille (voir cell_index).
+
+    Attributes:
+        keys: Clés int64 triées des cellules couvertes, colonne par colonne
+        shape: (colonnes, lignes) de cellules : la cellule (colonne c,
+               ligne r) est keys[c * lignes + r]
+        pixel_cells: (lat, lon) indice dans keys de la cellule de chaque pixel
+        rows, columns: Ligne de cellule de chaque latitude, colonne de
+                       cellule de chaque longitude
+    """
+
+    def __init__(self, lats, lons, cell_size):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+
+        xs, col = np.unique(square_indices(self.lons, cell_size), return_inverse=True)
+        ys, row = np.unique(square_indices(self.lats, cell_size), return_inverse=True)
+
+        # Cellules ordonnées par (x, y) pour que les clés soient triées
+        self.keys = pack_keys(np.repeat(xs, len(ys)), np.tile(ys, len(xs)))
+        self.shape = (len(xs), len(ys))
+        self.rows = row
+        self.columns = col
+        self.pixel_cells = col[None, :] * len(ys) + row[:, None]
+
+
+_cell_indexes = OrderedDict()
+_cell_indexes_lock = threading.Lock()
+
+
+def cell_index(lats, lons, cell_size):
+    """
+    CellIndex d'une grille, réutilisé tant que la grille reste en cache
+
+    La clé du cache est une empreinte des tableaux de latitudes et de
+    longitudes et la taille de cellule : les fichiers d'un même lot, qui
+    partagent leurs coordonnées, ne refont pas l'affectation.
+    """
+    lats = np.ascontiguousarray(lats, dtype=np.float64)
+    lons = np.ascontiguousarray(lons, dtype=np.float64)
+    digest = hashlib.sha1(lats.tobytes())
+    digest.update(lons.tobytes())
+    key = (digest.hexdigest(), len(lats), len(lons), float(cell_size))
+
+    with _cell_indexes_lock:
+        index = _cell_indexes.get(key)
+        if index is not None:
+            _cell_indexes.move_to_end(key)
+            return index
+    index = CellIndex(lats, lons, cell_size)
+    with _cell_indexes_lock:
+        _cell_indexes[key] = index
+        while len(_cell_indexes) > CELL_INDEX_CACHE_SIZE:
+            _cell_indexes.popitem(last=False)
+    return index
+
+
+def _valid_pixels(mask):
+    # Indices des pixels retenus, ou tous les pixels (sans copie) si aucun n'est masqué
+    pixels = np.flatnonzero(mask)
+    return slice(None) if len(pixels) == len(mask) else pixels
+
+
+def reduce_pixels(index, values, lat_start=0, edges=None):
+    """
+    Réduit un bloc de lignes de la grille sur ses cellules
+
+    Les échantillons sont d'abord réduits pixel par pixel (count, somme,
+    m2, min, max), puis les pixels sur leurs cellules : les réductions
+    groupées portent sur un tableau de la taille du bloc, quel que soit le
+    nombre d'échantillons. Les pixels sans aucune valeur valide (masque
+    terre/mer d'une variable océanique, zone hors domaine...) sont écartés
+    avant les réductions groupées. Seules les lignes de cellules que couvre
+    le bloc (la bande) sont calculées, pas toute la grille.
+
+    Args:
+        index: CellIndex de la grille
+        values: (échantillons, lignes du bloc, lon), NaN ignorés
+        lat_start: Indice de la première ligne de latitude du bloc
+        edges: Bornes des classes de l'histogramme, None = sans histogramme
+
+    Returns:
+        tuple: (première ligne de cellules de la bande, VarStats sur les
+                cellules de la bande, clés triées)
+    """
+    columns = index.shape[0]
+    rows = values.shape[1]
+    block_rows = index.rows[lat_start:lat_start + rows]
+    first = int(block_rows.min())
+    band = int(block_rows.max()) - first + 1
+    n = columns * band
+    block_cells = index.columns[None, :] * band + (block_rows - first)[:, None]
+    valid = ~np.isnan(values)
+
+    if len(values) == 1:
+        # Un seul échantillon : chaque pixel est son propre agrégat
+        pixels = _valid_pixels(valid.ravel())
+        pixel_count = 1
+        pixel_sum = pixel_min = pixel_max = values.ravel()[pixels]
+        pixel_m2 = 0.0
+    else:
+        pixel_count = valid.sum(axis=0).ravel()
+        pixels = _valid_pixels(pixel_count)
+        pixel_count = pixel_count[pixels]
+        filled = np.where(valid, values, 0.0)
+        pixel_sum = filled.sum(axis=0).ravel()[pixels]
+        # m2 de chaque pixel autour de sa propre moyenne
+        pixel_mean = np.zeros(valid.shape[1:])
+        pixel_mean.ravel()[pixels] = pixel_sum / pixel_count
+        np.subtract(values, pixel_mean, out=filled, where=valid)
+        pixel_m2 = (filled ** 2).sum(axis=0).ravel()[pixels]
+        # fmin/fmax ignorent les NaN
+        pixel_min = np.fmin.reduce(values, axis=0).ravel()[pixels]
+        pixel_max = np.fmax.reduce(values, axis=0).ravel()[pixels]
+
+    cells = block_cells.ravel()[pixels]
+    count = np.bincount(cells, weights=None if len(values) == 1 else pixel_count, minlength=n)
+    total = np.bincount(cells, weights=pixel_sum, minlength=n)
+    mean = total / np.maximum(count, 1)
+    m2 = np.bincount(cells, weights=pixel_m2 + pixel_count * (pixel_sum / pixel_count - mean[cells]) ** 2,
+                     minlength=n)
+
+    minimum = np.full(n, np.inf)
+    np.minimum.at(minimum, cells, pixel_min)
+    maximum = np.full(n, -np.inf)
+    np.maximum.at(maximum, cells, pixel_max)
+
+    pixel_lats = np.broadcast_to(index.lats[lat_start:lat_start + rows, None], block_cells.shape)
+    pixel_lons = np.broadcast_to(index.lons[None, :], block_cells.shape)
+
+    hist = None
+    if edges is not None:
+        bins = len(edges) - 1
+        classes = np.clip(np.searchsorted(edges, values[valid], side='right') - 1, 0, bins - 1)
+        flat = np.broadcast_to(block_cells * bins, values.shape)[valid] + classes
+        hist = np.bincount(flat, minlength=n * bins).reshape(n, bins)
+
+    keys = index.keys.reshape(index.shape)[:, first:first + band].ravel()
+    return first, VarStats(keys, count.astype(np.int64), total, m2, minimum, maximum,
+                           np.bincount(cells, weights=pixel_lats.ravel()[pixels] * pixel_count, minlength=n),
+                           np.bincount(cells, weights=pixel_lons.ravel()[pixels] * pixel_count, minlength=n),
+                           edges, hist)
+
+
+class GridAccumulator:
+    """
+    Accumulateurs par cellule pour une grille régulière lat/lon
+
+    L'assignation pixel -> cellule vient du cache de cell_index : elle est
+    partagée par toutes les variables et tous les fichiers de même grille.
+    Les valeurs sont ajoutées par blocs de lignes de latitude, ce qui
+    permet de lire une variable par morceaux avec une mémoire bornée par la
+    taille du bloc et le nombre de cellules : chaque bloc n'est réduit que
+    sur sa bande de lignes de cellules, fusionnée en place.
+
+    Args:
+        edges: Bornes des classes de l'histogramme, None = sans histogramme
+    """
+
+    def __init__(self, lats, lons, cell_size, edges=None):
+        self.index = cell_index(lats, lons, cell_size)
+        self.lats = self.index.lats
+        self.lons = self.index.lons
+        self.keys = self.index.keys
+        self.pixel_cells = self.index.pixel_cells
+        self.edges = edges
+        self.stats = None
+
+    def add(self, data, lat_start=0):
+        """
+        Ajoute un bloc de valeurs (..., lat, lon)
+
+        Args:
+            data: Bloc dont les deux derniers axes sont lat, lon ; les axes
+                  en tête sont des échantillons supplémentaires
+            lat_start: Indice de la première ligne de latitude du bloc
+        """
+        data = np.asarray(data, dtype=np.float64)
+        if not data.size:
+            return
+        # (échantillons, lat, lon) : les axes en tête sont aplatis
+        values = data.reshape(-1, *data.shape[-2:])
+        first, part = reduce_pixels(self.index, values, lat_start, self.edges)
+        if self.stats is None:
+            n = len(self.keys)
+            hist = None if self.edges is None else np.zeros((n, len(self.edges) - 1), dtype=np.int64)
+            self.stats = VarStats(self.keys, np.zeros(n, dtype=np.int64), np.zeros(n), np.zeros(n),
+                                  np.full(n, np.inf), np.full(n, -np.inf), np.zeros(n), np.zeros(n),
+                                  self.edges, hist)
+        _merge_band(self.stats, part, first, self.index.shape)
+
+    def result(self):
+        """Retourne les agrégats accumulés (VarStats)"""
+        return self.stats if self.stats is not None else VarStats.empty()
+
+
+class SeriesAccumulator(GridAccumulator):
+    """
+    GridAccumulator qui conserve en plus une série par cellule
+
+    Les blocs ajoutés doivent couvrir toutes les périodes : (temps, lat, lon).
+
+    Args:
+        labels: Étiquette de période de chaque pas de temps (voir time_labels)
+        edges: voir GridAccumulator
+    """
+
+    def __init__(self, lats, lons, cell_size, labels, edges=None):
+        super().__init__(lats, lons, cell_size, edges)
+        self.labels, self.step_labels = np.unique(np.asarray(labels), return_inverse=True)
+        size = len(self.keys) * len(self.labels)
+        self.series_sum = np.zeros(size)
+        self.series_count = np.zeros(size)
+
+    def add(self, data, lat_start=0):
+        data = np.asarray(data, dtype=np.float64)
+        super().add(data, lat_start)
+
+        rows = data.shape[-2]
+        cells = self.pixel_cells[lat_start:lat_start + rows].ravel()
+        # (temps, autres dimensions, pixels) : les dimensions intermédiaires
+        # (ex: niveaux) sont des échantillons supplémentaires de la période
+        values = data.reshape(len(self.step_labels), -1, len(cells))
+        flat = np.broadcast_to(cells[None, None, :] * len(self.labels) + self.step_labels[:, None, None],
+                               values.shape)
+        valid = ~np.isnan(values)
+
+        size = len(self.series_sum)
+        self.series_sum += np.bincount(flat[valid], weights=values[valid], minlength=size)
+        self.series_count += np.bincount(flat[valid], minlength=size)
+
+    def result(self):
+        shape = (len(self.keys), len(self.labels))
+        return SeriesVarStats.from_base(super().result(), self.labels,
+                                        self.series_sum.reshape(shape), self.series_count.reshape(shape))
+
+
+def aggregate_grid(data, lats, lons, cell_size, edges=None):
+    """
+    Agrège un champ régulier (..., lat, lon) sur la grille carrée
+
+    Les dimensions en tête (temps, etc.) sont traitées comme des
+    échantillons supplémentaires de chaque pixel.
+
+    Args:
+        data: Tableau de valeurs dont les deux derniers axes sont lat, lon
+        lats: Latitudes 1D
+        lons: Longitudes 1D
+        cell_size: Taille des cellules en degrés
+        edges: Bornes des classes de l'histogramme, None = sans histogramme
+
+    Returns:
+        VarStats
+    """
+    with stage('binning'):
+        accumulator = GridAccumulator(lats, lons, cell_size, edges)
+    with stage('reduction'):
+        accumulator.add(data)
+        return accumulator.result()
+
+
+STAT_FIELDS = ('mean', 'min', 'max', 'std')
+
+
+def parse_histograms(spec, bins=HISTOGRAM_BINS):
+    """
+    Lit les classes d'histogramme demandées par variable
+
+    Les classes sont fixées à l'avance pour que les histogrammes de tous les
+    fichiers et blocs s'additionnent.
+
+    Args:
+        spec: "var=min:max[:classes],..." (ex: "t2m=200:330,tp=0:0.05:64"),
+              ou None
+        bins: Nombre de classes quand il n'est pas précisé
+
+    Raises:
+        ValueError: si la spécification est invalide
+
+    Returns:
+        dict: {variable: [min, max, classes]} (vide si spec est vide)
+    """
+    histograms = {}
+    for item in filter(None, (spec or '').split(',')):
+        try:
+            var, bounds = item.split('=')
+            parts = bounds.split(':')
+            low, high = float(parts[0]), float(parts[1])
+            count = int(parts[2]) if len(parts) > 2 else bins
+            if len(parts) > 3:
+                raise ValueError
+        except (ValueError, IndexError):
+            raise ValueError(f"Histogramme invalide: {item} (attendu: var=min:max[:classes])")
+        if not low < high or count < 1:
+            raise ValueError(f"Histogramme invalide: {item} (min < max et au moins une classe)")
+        histograms[var.strip()] = [low, high, count]
+    return histograms
+
+
+def histogram_edges(histogram):
+    """Bornes des classes d'une entrée de parse_histograms (None = pas d'histogramme)"""
+    if histogram is None:
+        return None
+    low, high, bins = histogram
+    return np.linspace(low, high, bins + 1)
+
+
+def tile_columns(stats_by_var):
+    """
+    Calcule les colonnes finales des tuiles non vides, sans dictionnaire
+
+    Args:
+        stats_by_var: dict {variable: VarStats}
+
+    Returns:
+        dict: {'x', 'y', 'count', 'lat', 'lon': tableaux alignés,
+               'variables': {variable: {'mean', 'min', 'max', 'std', 'count'}}}
+               Le count d'une variable vaut -1 si elle ne couvre pas la tuile.
+               Pour les SeriesVarStats, la variable a en plus une colonne 2D
+               'series' (moyenne par période) et ses périodes sont listées
+               dans 'series_labels': {variable: [étiquettes]}.
+               Une variable avec histogramme a en plus p10/p50/p90 et une
+               colonne 2D 'histogram' (nombre de valeurs par classe) ; les
+               bornes de ses classes sont dans 'histogram_edges'.
+    """
+    keys = np.unique(np.concatenate([stats.keys for stats in stats_by_var.values()] or [np.zeros(0, np.int64)]))
+    count = np.zeros(len(keys), dtype=np.int64)
+    lat_sum = np.zeros(len(keys))
+    lon_sum = np.zeros(len(keys))
+
+    positions = {}
+    for var, stats in stats_by_var.items():
+        pos = np.searchsorted(keys, stats.keys)
+        count[pos] += stats.count
+        lat_sum[pos] += stats.lat_sum
+        lon_sum[pos] += stats.lon_sum
+        positions[var] = pos
+
+    kept = np.nonzero(count)[0]
+    xs, ys = unpack_keys(keys[kept])
+    columns = {
+        'x': xs,
+        'y': ys,
+        'count': count[kept],
+        'lat': lat_sum[kept] / count[kept],
+        'lon': lon_sum[kept] / count[kept],
+        'variables': {},
+        'series_labels': {},
+        'histogram_edges': {}
+    }
+
+    for var, stats in stats_by_var.items():
+        pos = positions[var]
+        var_count = np.full(len(keys), -1, dtype=np.int64)
+        var_count[pos] = stats.count
+        var_columns = {'count': var_count[kept]}
+        for field, values in zip(STAT_FIELDS, (stats.mean(), stats.min, stats.max, stats.std())):
+            column = np.full(len(keys), np.nan)
+            column[pos] = values
+            var_columns[field] = column[kept]
+        if isinstance(stats, SeriesVarStats):
+            series = np.full((len(keys), len(stats.labels)), np.nan)
+            series[pos] = stats.series_mean()
+            var_columns['series'] = series[kept]
+            columns['series_labels'][var] = stats.labels.tolist()
+        if stats.hist is not None:
+            for field, values in zip(PERCENTILE_FIELDS, stats.percentiles().T):
+                column = np.full(len(keys), np.nan)
+                column[pos] = values
+                var_columns[field] = column[kept]
+            histogram = np.zeros((len(keys), stats.hist.shape[1]), dtype=np.int64)
+            histogram[pos] = stats.hist
+            var_columns['histogram'] = histogram[kept]
+            columns['histogram_edges'][var] = stats.edges.tolist()
+        columns['variables'][var] = var_columns
+
+    return columns
+
+
+def take_columns(columns, index):
+    """
+    Sélectionne des lignes dans des colonnes au format tile_columns
+
+    Args:
+        columns: Colonnes au format de tile_columns
+        index: Indices, masque ou slice des tuiles à garder
+    """
+    selected = {name: np.asarray(columns[name])[index] for name in ('x', 'y', 'count', 'lat', 'lon')}
+    selected['variables'] = {
+        var: {field: np.asarray(values)[index] for field, values in var_columns.items()}
+        for var, var_columns in columns['variables'].items()
+    }
+    selected['series_labels'] = columns.get('series_labels', {})
+    selected['histogram_edges'] = columns.get('histogram_edges', {})
+    if 'biomes' in columns:
+        selected['biomes'] = {'names': columns['biomes']['names'],
+                              'index': np.asarray(columns['biomes']['index'])[index],
+                              'score': np.asarray(columns['biomes']['score'])[index]}
+    return selected
+
+
+def sort_columns(columns):
+    """Colonnes triées par (x, y), inchangées (sans copie) si elles le sont déjà"""
+    x = np.asarray(columns['x'])
+    y = np.asarray(columns['y'])
+    if len(x) > 1 and np.any((np.diff(x) < 0) | ((np.diff(x) == 0) & (np.diff(y) < 0))):
+        return take_columns(columns, np.lexsort((y, x)))
+    return columns
+
+
+def tiles_from_columns(columns, include_var_count=True, empty_value=None):
+    """
+    Construit le dictionnaire de tuiles "x,y" à partir de colonnes
+
+    Args:
+        columns: Colonnes au format de tile_columns
+        include_var_count: Ajouter 'count' aux statistiques de chaque variable
+        empty_value: Valeur d'une variable couverte mais sans donnée valide
+
+    Returns:
+        dict: {square_coord: {'count', 'lat', 'lon', variable: stats}}
+              Les variables avec série ont en plus 'series' : moyenne par
+              période (None pour une période sans donnée), celles avec
+              histogramme ont p10/p50/p90 et 'histogram'. Si les colonnes
+              ont une classification (biomes.BiomeRanges.classify), chaque
+              tuile a 'biomes' : [{'biome', 'score'}] par score décroissant
+    """
+    coords = [f"{x},{y}" for x, y in zip(np.asarray(columns['x']).tolist(), np.asarray(columns['y']).tolist())]
+    square_grid = {
+        coord: {'count': c, 'lat': lat, 'lon': lon}
+        for coord, c, lat, lon in zip(coords, np.asarray(columns['count']).tolist(),
+                                      np.asarray(columns['lat']).tolist(),
+                                      np.asarray(columns['lon']).tolist())
+    }
+
+    for var, var_columns in columns['variables'].items():
+        values = [np.asarray(var_columns[field]).tolist() for field in STAT_FIELDS]
+        if 'series' in var_columns:
+            series = np.asarray(var_columns['series'], dtype=object)
+            series[np.isnan(np.asarray(var_columns['series'], dtype=np.float64))] = None
+            series = series.tolist()
+        else:
+            series = None
+        if 'histogram' in var_columns:
+            percentiles = list(zip(*(np.asarray(var_columns[field]).tolist() for field in PERCENTILE_FIELDS)))
+            histogram = np.asarray(var_columns['histogram']).tolist()
+        else:
+            histogram = None
+        for i, (coord, c, mean, minimum, maximum, std) in enumerate(
+                zip(coords, np.asarray(var_columns['count']).tolist(), *values)):
+            if c < 0:
+                continue
+            if c == 0:
+                square_grid[coord][var] = empty_value
+                continue
+            entry = {'mean': mean, 'min': minimum, 'max': maximum, 'std': std}
+            if include_var_count:
+                entry['count'] = c
+            if series is not None:
+                entry['series'] = series[i]
+            if histogram is not None:
+                entry.update(zip(PERCENTILE_FIELDS, percentiles[i]))
+                entry['histogram'] = histogram[i]
+            square_grid[coord][var] = entry
+
+    if 'biomes' in columns:
+        names = columns['biomes']['names']
+        for coord, index, scores in zip(coords, np.asarray(columns['biomes']['index']).tolist(),
+                                        np.asarray(columns['biomes']['score']).tolist()):
+            square_grid[coord]['biomes'] = [{'biome': names[i], 'score': score}
+                                            for i, score in zip(index, scores) if i >= 0]
+
+    return square_grid
+
+
+def iter_tiles(columns, include_var_count=True, empty_value=None, chunk_size=4096):
+    """
+    Tuiles "x,y" construites par paquets, sans tout garder en mémoire
+
+    Args:
+        columns: Colonnes au format de tile_columns
+        include_var_count: Ajouter 'count' aux statistiques de chaque variable
+        empty_value: Valeur d'une variable couverte mais sans donnée valide
+        chunk_size: Nombre de tuiles construites à la fois
+
+    Yields:
+        dict: {square_coord: tile} de chaque paquet (mêmes tuiles que
+              tiles_from_columns)
+    """
+    for start in range(0, len(columns['x']), chunk_size):
+        chunk = take_columns(columns, slice(start, start + chunk_size))
+        yield tiles_from_columns(chunk, include_var_count, empty_value)
+
+
+def build_tiles(stats_by_var, include_var_count=True, empty_value=None):
+    """
+    Construit le dictionnaire de tuiles "x,y" à partir des agrégats
+
+    Args:
+        stats_by_var: dict {variable: VarStats}
+        include_var_count: Ajouter 'count' aux statistiques de chaque variable
+        empty_value: Valeur d'une variable couverte mais sans donnée valide
+
+    Returns:
+        dict: {square_coord: {'count', 'lat', 'lon', variable: stats}}
+    """
+    return tiles_from_columns(tile_columns(stats_by_var), include_var_count, empty_value)
@@ -0,0 +1,150 @@
+"""
+Index spatial en mémoire des niveaux de pyramide de la carte
+
+Chaque niveau est conservé sous forme de colonnes triées par (x, y) : une
+requête bbox se résout par recherche dichotomique sur x puis filtrage sur
+y, sans parcourir ni désérialiser toute la grille.
+"""
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from map_format import load_map_columns, pyramid_path
+from square_grid import normalize_lon
+from square_stats import sort_columns, take_columns
+
+# Délai entre deux vérifications de la version courante d'un magasin (secondes)
+STORE_POLL_INTERVAL = float(os.getenv('MAP_STORE_POLL', 1.0))
+
+
+class TileLevel:
+    """
+    Un niveau de la pyramide, indexé pour les requêtes bbox
+
+    Args:
+        metadata: Métadonnées du fichier de carte
+        columns: Colonnes au format de square_stats.tile_columns
+    """
+
+    def __init__(self, metadata, columns):
+        self.metadata = metadata
+        self.cell_size = float(metadata['cell_size'])
+
+        columns = sort_columns(columns)
+        self.columns = columns
+        self.x = np.asarray(columns['x'])
+        self.y = np.asarray(columns['y'])
+
+        lons = np.asarray(columns['lon'])
+        self.positive_lons = len(lons) > 0 and lons.min() >= 0 and lons.max() > 180
+
+    def __len__(self):
+        return len(self.x)
+
+    def _x_ranges(self, lon_min, lon_max):
+        if lon_max - lon_min >= 360:
+            return [(None, None)]
+        lo = normalize_lon(lon_min, self.positive_lons)
+        hi = normalize_lon(lon_max, self.positive_lons)
+        lo_x = int(np.floor(lo / self.cell_size))
+        hi_x = int(np.floor(hi / self.cell_size))
+        if lo <= hi:
+            return [(lo_x, hi_x)]
+        # La bbox traverse la limite de la convention (0/360 ou ±180)
+        return [(lo_x, None), (None, hi_x)]
+
+    def query(self, bbox=None):
+        """
+        Sélectionne les tuiles qui intersectent une bbox
+
+        Args:
+            bbox: (lat_min, lat_max, lon_min, lon_max), None = tout le niveau
+
+        Returns:
+            dict: Colonnes des tuiles sélectionnées
+        """
+        if bbox is None:
+            return self.columns
+
+        lat_min, lat_max, lon_min, lon_max = bbox
+        y_min = int(np.floor(lat_min / self.cell_size))
+        y_max = int(np.floor(lat_max / self.cell_size))
+
+        selected = []
+        for x_min, x_max in self._x_ranges(lon_min, lon_max):
+            start = 0 if x_min is None else np.searchsorted(self.x, x_min, side='left')
+            stop = len(self.x) if x_max is None else np.searchsorted(self.x, x_max, side='right')
+            candidates = np.arange(start, stop)
+            ys = self.y[start:stop]
+            selected.append(candidates[(ys >= y_min) & (ys <= y_max)])
+
+        return take_columns(self.columns, np.concatenate(selected))
+
+
+class TilePyramid:
+    """
+    Niveaux d'une carte chargés depuis game_map.json et ses fichiers _z<k>,
+    ou depuis la version courante d'un magasin (map_store.MapStore)
+
+    Le chargement est paresseux : les fichiers ne sont lus qu'à la première
+    requête. Avec un magasin, les niveaux sont des vues mappées en mémoire
+    partagées entre workers, et la version courante est revérifiée au plus
+    toutes les STORE_POLL_INTERVAL secondes : une nouvelle publication est
+    servie sans redémarrer le backend.
+    """
+
+    def __init__(self, map_file, store=None):
+        self.map_file = Path(map_file)
+        self.store = store
+        self.version = None
+        self._levels = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _load_files(self):
+        if not self.map_file.exists():
+            raise FileNotFoundError(f"Carte introuvable: {self.map_file}")
+        levels = []
+        path = self.map_file
+        while path.exists():
+            levels.append(TileLevel(*load_map_columns(path)))
+            path = pyramid_path(self.map_file, len(levels))
+        return levels
+
+    def _refresh_store(self):
+        now = time.monotonic()
+        if self._levels is not None and now - self._checked_at < STORE_POLL_INTERVAL:
+            return
+        self._checked_at = now
+        version = self.store.current_version()
+        if version is not None and version != self.version:
+            # Version déjà remplacée et supprimée : on garde la précédente
+            # jusqu'à la prochaine vérification
+            paths = self.store.level_paths(version)
+            if paths:
+                self._levels = [TileLevel(*load_map_columns(path)) for path in paths]
+                self.version = version
+        if self._levels is None:
+            raise FileNotFoundError(f"Aucune carte publiée dans {self.store.root}")
+
+    def levels(self):
+        """Liste des niveaux disponibles (chargés à la demande)"""
+        with self._lock:
+            if self.store is not None:
+                self._refresh_store()
+            elif self._levels is None:
+                self._levels = self._load_files()
+            return self._levels
+
+    def level(self, level):
+        """
+        Raises:
+            IndexError: si le niveau n'existe pas
+        """
+        levels = self.levels()
+        if not 0 <= level < len(levels):
+            raise IndexError(f"Niveau {level} indisponible (0 à {len(levels) - 1})")
+        return levels[level]
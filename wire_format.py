@@ -0,0 +1,163 @@
+"""
+Encodages des réponses de tuiles du backend
+
+Négociation de contenu pour /process et /tiles :
+    Format (Accept, ou paramètre format=) :
+        json     : application/json, schéma inchangé (défaut)
+        msgpack  : application/msgpack, même structure que le JSON
+                   (nécessite le paquet msgpack)
+        columnar : application/vnd.tradelhm.columns, colonnes typées au
+                   format binaire de map_format.py
+    Compression (Accept-Encoding) : zstd (paquet zstandard) ou gzip
+    Précision (paramètre precision=float32) : mean/min/max/std arrondis en
+        float32 (JSON plus court, floats 32 bits en msgpack et columnar)
+"""
+import gzip
+import json
+
+import numpy as np
+
+from map_format import encode_binary_map
+from metrics import stage
+from square_stats import PERCENTILE_FIELDS, STAT_FIELDS, tiles_from_columns
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MEDIA_TYPES = {
+    'json': 'application/json',
+    'msgpack': 'application/msgpack',
+    'columnar': 'application/vnd.tradelhm.columns'
+}
+MEDIA_ALIASES = {'application/x-msgpack': 'msgpack'}
+
+# En dessous, la compression coûte plus qu'elle ne rapporte
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 5
+ZSTD_LEVEL = 3
+
+
+class FormatNotAvailable(ValueError):
+    """Le format demandé est inconnu ou sa dépendance n'est pas installée"""
+
+
+def available_formats():
+    """Formats utilisables dans cet environnement"""
+    return [fmt for fmt in MEDIA_TYPES if fmt != 'msgpack' or msgpack is not None]
+
+
+def negotiate_format(accept_mimetypes, requested=None):
+    """
+    Choisit le format de réponse
+
+    Args:
+        accept_mimetypes: request.accept_mimetypes
+        requested: Valeur du paramètre format= (prioritaire), ou None
+
+    Raises:
+        FormatNotAvailable: si le format demandé explicitement est indisponible
+
+    Returns:
+        str: 'json', 'msgpack' ou 'columnar'
+    """
+    formats = available_formats()
+    if requested:
+        if requested not in formats:
+            raise FormatNotAvailable(f"Format indisponible: {requested} (disponibles: {', '.join(formats)})")
+        return requested
+
+    offers = [MEDIA_TYPES[fmt] for fmt in formats]
+    offers += [media for media, fmt in MEDIA_ALIASES.items() if fmt in formats]
+    best = accept_mimetypes.best_match(offers, default=MEDIA_TYPES['json'])
+    return MEDIA_ALIASES.get(best) or next(fmt for fmt, media in MEDIA_TYPES.items() if media == best)
+
+
+def negotiate_encoding(accept_encodings):
+    """
+    Choisit la compression d'après Accept-Encoding
+
+    Args:
+        accept_encodings: request.accept_encodings
+
+    Returns:
+        str: 'zstd', 'gzip' ou None (pas de compression)
+    """
+    offers = (['zstd'] if zstandard is not None else []) + ['gzip']
+    return accept_encodings.best_match(offers)
+
+
+def compress(body, encoding):
+    """Compresse une réponse encodée (None = inchangée)"""
+    if encoding is None or len(body) < MIN_COMPRESS_SIZE:
+        return body, None
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body), encoding
+    return gzip.compress(body, compresslevel=GZIP_LEVEL), encoding
+
+
+def round_float32(columns):
+    """
+    Arrondit mean/min/max/std (et p10/p50/p90) en float32, au plus court
+
+    Les valeurs restent des float64 mais valent exactement leur écriture
+    décimale la plus courte en float32 : le JSON produit est plus court
+    (ex: 0.1 au lieu de 0.10000000149011612).
+
+    Returns:
+        dict: Copie superficielle des colonnes avec les statistiques arrondies
+    """
+    rounded = {**columns, 'variables': {}}
+    for var, var_columns in columns['variables'].items():
+        rounded['variables'][var] = {
+            field: (np.asarray(values, dtype=np.float32).astype(str).astype(np.float64)
+                    if field in STAT_FIELDS + PERCENTILE_FIELDS else values)
+            for field, values in var_columns.items()
+        }
+    return rounded
+
+
+def encode_tiles(columns, variables, metadata, fmt='json', float32=False, include_var_count=True,
+                 empty_value=None, encode_json=None):
+    """
+    Encode une réponse de tuiles {'tiles', 'variables', 'metadata'}
+
+    Args:
+        columns: Colonnes au format de square_stats.tile_columns
+        variables: Liste des variables de la réponse
+        metadata: Métadonnées de la réponse
+        fmt: 'json', 'msgpack' ou 'columnar'
+        float32: Statistiques en précision float32 (en msgpack, tous les
+                 flottants sont alors écrits sur 32 bits)
+        include_var_count, empty_value: voir square_stats.tiles_from_columns
+        encode_json: Fonction d'encodage JSON, chronométrée par l'appelant
+                     (défaut: json.dumps trié)
+
+    Returns:
+        bytes
+    """
+    if fmt == 'columnar':
+        with stage('serialization'):
+            return encode_binary_map({**metadata, 'variables': variables}, columns, float32)
+
+    with stage('tile_build'):
+        if float32 and fmt == 'json':
+            columns = round_float32(columns)
+        payload = {
+            'tiles': tiles_from_columns(columns, include_var_count, empty_value),
+            'variables': variables,
+            'metadata': metadata
+        }
+    if fmt == 'msgpack':
+        with stage('serialization'):
+            return msgpack.packb(payload, use_single_float=float32)
+    if encode_json is None:
+        with stage('serialization'):
+            return json.dumps(payload, sort_keys=True).encode('utf-8')
+    return encode_json(payload)